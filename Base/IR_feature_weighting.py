@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 19/10/2026
+
+@author: Maurizio Ferrari Dacrema
+"""
+
+import numpy as np
+import scipy.sparse as sps
+import weakref
+
+from Base.Recommender_utils import check_matrix
+
+
+
+def okapi_BM_25(dataMatrix, K1=1.2, B=0.75):
+    """
+    Items are assumed to be on rows
+    :param dataMatrix:
+    :param K1:
+    :param B:
+    :return:
+    """
+
+    assert B>0 and B<1, "okapi_BM_25: B must be in (0,1)"
+    assert K1>0,  "okapi_BM_25: K1 must be > 0"
+
+    assert np.all(np.isfinite(dataMatrix.data)), \
+        "okapi_BM_25: Data matrix contains {} non finite values".format(np.sum(np.logical_not(np.isfinite(dataMatrix.data))))
+
+    # Weighs each row of a sparse matrix by OkapiBM25 weighting
+    # calculate idf per term (user)
+    dataMatrix = check_matrix(dataMatrix, 'coo', dtype=np.float32)
+
+    N = float(dataMatrix.shape[0])
+    idf = np.log(N / (1 + np.bincount(dataMatrix.col, minlength=dataMatrix.shape[1])))
+
+    # calculate length_norm per document
+    row_sums = np.bincount(dataMatrix.row, weights=dataMatrix.data, minlength=dataMatrix.shape[0])
+
+    average_length = row_sums.mean()
+    length_norm = (1.0 - B) + B * row_sums / average_length
+
+    # weight matrix rows by bm25
+    dataMatrix.data = dataMatrix.data * (K1 + 1.0) / (K1 * length_norm[dataMatrix.row] + dataMatrix.data) * idf[dataMatrix.col]
+
+    return check_matrix(dataMatrix, 'csr', dtype=np.float32)
+
+
+
+def TF_IDF(dataMatrix):
+    """
+    Items are assumed to be on rows
+    :param dataMatrix:
+    :return:
+    """
+
+    assert np.all(np.isfinite(dataMatrix.data)), \
+        "TF_IDF: Data matrix contains {} non finite values.".format(np.sum(np.logical_not(np.isfinite(dataMatrix.data))))
+
+    assert np.all(dataMatrix.data >= 0.0),\
+        "TF_IDF: Data matrix contains {} negative values, computing the square root is not possible.".format(np.sum(dataMatrix.data < 0.0))
+
+    # TFIDF each row of a sparse amtrix
+    dataMatrix = check_matrix(dataMatrix, 'coo', dtype=np.float32)
+
+    N = float(dataMatrix.shape[0])
+
+    # calculate IDF
+    idf = np.log(N / (1 + np.bincount(dataMatrix.col, minlength=dataMatrix.shape[1])))
+
+    # apply TF-IDF adjustment
+    dataMatrix.data = np.sqrt(dataMatrix.data) * idf[dataMatrix.col]
+
+    return check_matrix(dataMatrix, 'csr', dtype=np.float32)
+
+
+
+
+FEATURE_WEIGHTING_FUNCTIONS = {"BM25": okapi_BM_25,
+                               "TF-IDF": TF_IDF}
+
+
+# Weighted ICM already computed, key is (id(ICM), feature_weighting)
+# Entries are removed when the original ICM is garbage collected
+_weighted_ICM_cache = {}
+
+
+def _remove_ICM_from_cache(ICM_id):
+
+    for cache_key in list(_weighted_ICM_cache.keys()):
+        if cache_key[0] == ICM_id:
+            del _weighted_ICM_cache[cache_key]
+
+
+
+def apply_feature_weighting(ICM, feature_weighting, use_cache = True):
+    """
+    Returns the CSR float32 ICM weighted with the selected feature weighting.
+    The weighting of a given ICM object is computed only once and shared among all the callers,
+    the returned matrix must therefore NOT be modified, nor the original ICM after its weighting has been computed
+
+    :param ICM:
+    :param feature_weighting: "BM25", "TF-IDF" or "none"
+    :param use_cache:
+    :return:
+    """
+
+    if feature_weighting == "none":
+        return check_matrix(ICM, 'csr', dtype=np.float32)
+
+    if feature_weighting not in FEATURE_WEIGHTING_FUNCTIONS:
+        raise ValueError("Value for 'feature_weighting' not recognized. Acceptable values are {}, provided was '{}'".format(
+            list(FEATURE_WEIGHTING_FUNCTIONS.keys()) + ["none"], feature_weighting))
+
+    weighting_function = FEATURE_WEIGHTING_FUNCTIONS[feature_weighting]
+
+    if not use_cache:
+        return weighting_function(ICM)
+
+
+    cache_key = (id(ICM), feature_weighting)
+
+    if cache_key not in _weighted_ICM_cache:
+
+        if not any(key[0] == id(ICM) for key in _weighted_ICM_cache):
+            weakref.finalize(ICM, _remove_ICM_from_cache, id(ICM))
+
+        _weighted_ICM_cache[cache_key] = weighting_function(ICM)
+
+    return _weighted_ICM_cache[cache_key]
+
+
+
+def clear_feature_weighting_cache():
+
+    _weighted_ICM_cache.clear()
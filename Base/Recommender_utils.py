@@ -29,15 +29,20 @@ def check_matrix(X, format='csc', dtype=np.float32):
         return X.astype(dtype)
 
 
-def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose = False, inplace=True):
+def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose = False, inplace=True, block_size = None):
     """
     The function selects the TopK most similar elements, column-wise
 
+    Dense matrices are processed in blocks of columns with a partial sort, sparse matrices are processed
+    with a segmented sort over the CSC columns, without any per-column python loop
+
     :param item_weights:
     :param forceSparseOutput:
     :param k:
     :param verbose:
     :param inplace: Default True, WARNING matrix will be modified
+    :param block_size: Number of columns processed at once for dense input, if None it is chosen by the memory
+                        required by each block
     :return:
     """
 
@@ -56,20 +61,20 @@ def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose
 
     if not sparse_weights:
 
-        idx_sorted = np.argsort(item_weights, axis=0)  # sort data inside each column
-
         if inplace:
             W = item_weights
         else:
             W = item_weights.copy()
 
-        # index of the items that don't belong to the top-k similar items of each column
-        not_top_k = idx_sorted[:-k, :]
-        # use numpy fancy indexing to zero-out the values in sim without using a for loop
-        W[not_top_k, np.arange(nitems)] = 0.0
+        W_data, W_row_indices = _dense_column_top_k(np.asarray(W), k, block_size = block_size)
 
         if forceSparseOutput:
-            W_sparse = sps.csr_matrix(W, shape=(nitems, nitems))
+            # Each column has exactly k cells, the structure can be built directly
+            cols_indptr = np.arange(0, nitems*k + 1, k, dtype=np.int32)
+
+            W_sparse = sps.csc_matrix((W_data, W_row_indices, cols_indptr), shape=(nitems, nitems))
+            W_sparse.eliminate_zeros()
+            W_sparse = W_sparse.tocsr()
 
             if verbose:
                 print("Sparse TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
@@ -82,38 +87,143 @@ def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose
         return W
 
     else:
-        # iterate over each column and keep only the top-k similar items
-        data, rows_indices, cols_indptr = [], [], []
 
         item_weights = check_matrix(item_weights, format='csc', dtype=np.float32)
 
-        for item_idx in range(nitems):
+        data, rows_indices, cols_indptr = _sparse_column_top_k(item_weights, k)
 
-            cols_indptr.append(len(data))
+        # During testing CSR is faster
+        W_sparse = sps.csc_matrix((data, rows_indices, cols_indptr), shape=(nitems, nitems), dtype=np.float32)
+        W_sparse = W_sparse.tocsr()
 
-            start_position = item_weights.indptr[item_idx]
-            end_position = item_weights.indptr[item_idx+1]
+        if verbose:
+            print("Sparse TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
 
-            column_data = item_weights.data[start_position:end_position]
-            column_row_index = item_weights.indices[start_position:end_position]
+        return W_sparse
 
-            idx_sorted = np.argsort(column_data)  # sort by column
-            top_k_idx = idx_sorted[-k:]
 
-            data.extend(column_data[top_k_idx])
-            rows_indices.extend(column_row_index[top_k_idx])
 
+def _dense_column_top_k(W, k, block_size = None, max_block_bytes = 2e8):
+    """
+    Zeroes, in place, all the cells of the dense matrix W that are not among the k highest of their column.
+    Columns are processed in blocks with argpartition, to avoid sorting the whole matrix and to bound
+    the memory required by the temporary index arrays
 
-        cols_indptr.append(len(data))
+    :param W:
+    :param k:
+    :param block_size:
+    :param max_block_bytes:     Memory budget of the argpartition index array, used if block_size is None
+    :return:    data and row indices of the top-k cells, column by column, each column having exactly k cells
+    """
 
-        # During testing CSR is faster
-        W_sparse = sps.csc_matrix((data, rows_indices, cols_indptr), shape=(nitems, nitems), dtype=np.float32)
-        W_sparse = W_sparse.tocsr()
+    n_rows, n_cols = W.shape
 
-        if verbose:
-            print("Sparse TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
+    if block_size is None:
+        block_size = int(max_block_bytes / (n_rows * np.dtype(np.intp).itemsize))
 
-        return W_sparse
+    block_size = max(1, min(block_size, n_cols))
+
+    W_data = np.zeros((k, n_cols), dtype=W.dtype)
+    W_row_indices = np.zeros((k, n_cols), dtype=np.int32)
+
+    for start_col in range(0, n_cols, block_size):
+
+        end_col = min(start_col + block_size, n_cols)
+        W_block = W[:, start_col:end_col]
+
+        if k < n_rows:
+            top_k_idx = np.argpartition(W_block, n_rows - k, axis=0)[n_rows - k:, :]
+        else:
+            top_k_idx = np.broadcast_to(np.arange(n_rows).reshape((-1, 1)), W_block.shape)
+
+        top_k_data = np.take_along_axis(W_block, top_k_idx, axis=0)
+
+        # Write back the top-k values on a zeroed block
+        W_block[...] = 0.0
+        np.put_along_axis(W_block, top_k_idx, top_k_data, axis=0)
+
+        W_data[:, start_col:end_col] = top_k_data
+        W_row_indices[:, start_col:end_col] = top_k_idx
+
+    # Transposing gives the cells ordered column by column
+    return W_data.T.ravel(), W_row_indices.T.ravel()
+
+
+
+def _sparse_column_top_k(W_csc, k):
+    """
+    Selects the k highest cells of each column of a CSC matrix.
+    Columns having more than k cells are grouped by their length rounded to the next power of two,
+    each group is copied in a padded 2D block and partially sorted at once with argpartition
+
+    :param W_csc:
+    :param k:
+    :return:    data, row indices and column pointers of the selected cells
+    """
+
+    n_cols = W_csc.shape[1]
+
+    col_nnz = np.ediff1d(W_csc.indptr)
+
+    keep_mask = np.ones(len(W_csc.data), dtype=np.bool_)
+
+    # Only the columns exceeding k elements need to be pruned
+    to_prune_cols = np.flatnonzero(col_nnz > k)
+    to_prune_bucket = np.ceil(np.log2(col_nnz[to_prune_cols])).astype(np.int32)
+
+    for bucket in np.unique(to_prune_bucket):
+
+        bucket_cols = to_prune_cols[to_prune_bucket == bucket]
+        bucket_col_nnz = col_nnz[bucket_cols]
+        bucket_col_start = W_csc.indptr[bucket_cols]
+        max_col_nnz = bucket_col_nnz.max()
+
+        # Position of each cell in the padded block, row is the column of W and col its offset in the segment
+        block_row = np.repeat(np.arange(len(bucket_cols)), bucket_col_nnz)
+        block_col = np.arange(len(block_row)) - np.repeat(np.cumsum(bucket_col_nnz) - bucket_col_nnz, bucket_col_nnz)
+        bucket_cells = bucket_col_start[block_row] + block_col
+
+        block = np.full((len(bucket_cols), max_col_nnz), -np.inf, dtype=W_csc.data.dtype)
+        block[block_row, block_col] = W_csc.data[bucket_cells]
+
+        top_k_offset = np.argpartition(block, max_col_nnz - k, axis=1)[:, max_col_nnz - k:]
+
+        keep_mask[bucket_cells] = False
+        keep_mask[(bucket_col_start.reshape((-1, 1)) + top_k_offset).ravel()] = True
+
+    data = W_csc.data[keep_mask]
+    rows_indices = W_csc.indices[keep_mask]
+
+    cols_indptr = np.zeros(n_cols + 1, dtype=np.int64)
+    np.cumsum(np.minimum(col_nnz, k), out=cols_indptr[1:])
+
+    return data, rows_indices, cols_indptr
+
+
+
+
+def scoresArrayTopN(scores_array, n):
+    """
+    Ranks, row-wise, the n items with highest score of a dense 2D array of scores.
+    The whole batch is first partitioned to extract the n highest scores of each row, then only those are sorted
+
+    :param scores_array: users X items
+    :param n:
+    :return: users X n array of item indices, in descending score
+    """
+
+    n_items = scores_array.shape[1]
+    n = min(n, n_items)
+
+    if n < n_items:
+        relevant_items_partition = np.argpartition(-scores_array, n-1, axis=1)[:, 0:n]
+    else:
+        relevant_items_partition = np.broadcast_to(np.arange(n_items), scores_array.shape)
+
+    relevant_items_partition_scores = np.take_along_axis(scores_array, relevant_items_partition, axis=1)
+    relevant_items_partition_sorting = np.argsort(-relevant_items_partition_scores, axis=1, kind="stable")
+
+    return np.take_along_axis(relevant_items_partition, relevant_items_partition_sorting, axis=1)
 
 
 
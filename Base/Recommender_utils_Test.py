@@ -6,7 +6,7 @@ Created on 30/09/17
 @author: Maurizio Ferrari Dacrema
 """
 
-from Base.Recommender_utils import similarityMatrixTopK
+from Base.Recommender_utils import similarityMatrixTopK, scoresArrayTopN
 
 import numpy as np
 import scipy.sparse as sps
@@ -64,6 +64,67 @@ class MyTestCase(unittest.TestCase):
         sparse_output = similarityMatrixTopK(sparse_input, k=TopK, forceSparseOutput=True)
         self.assertTrue(np.all((dense_output - sparse_output.todense())<1e-6), "sparseToSparse CSC incorrect")
 
+
+    def test_similarityMatrixTopK_sparseUnevenColumns(self):
+
+        numRows = 100
+
+        TopK = 10
+
+        sparse_input = sps.random(numRows, numRows, density=0.08, format='csc')
+        dense_input = sparse_input.toarray()
+
+        sparse_output = similarityMatrixTopK(sparse_input, k=TopK, forceSparseOutput=True)
+
+        # Columns with less than TopK cells must be left untouched
+        for col_index in range(numRows):
+
+            column = dense_input[:, col_index]
+            column_nnz = np.sum(column != 0)
+
+            expected_column = np.zeros_like(column)
+            top_k = np.argsort(column)[-min(TopK, column_nnz):] if column_nnz > 0 else []
+            expected_column[top_k] = column[top_k]
+
+            self.assertTrue(np.allclose(expected_column, sparse_output[:, col_index].toarray().ravel()),
+                            "sparseUnevenColumns incorrect")
+
+
+    def test_similarityMatrixTopK_denseBlocks(self):
+
+        numRows = 50
+
+        TopK = 7
+
+        dense_input = np.random.random((numRows, numRows))
+
+        dense_output_single_block = similarityMatrixTopK(dense_input, k=TopK, forceSparseOutput=False, inplace=False)
+
+        for block_size in [1, 3, 13]:
+            dense_output = similarityMatrixTopK(dense_input, k=TopK, forceSparseOutput=False, inplace=False, block_size=block_size)
+            self.assertTrue(np.array_equal(dense_output_single_block, dense_output), "denseBlocks incorrect")
+
+    def test_scoresArrayTopN(self):
+
+        numRows = 30
+        numCols = 50
+
+        TopN = 10
+
+        scores_array = np.random.random((numRows, numCols))
+
+        ranking = scoresArrayTopN(scores_array, TopN)
+        ranking_control = np.argsort(-scores_array, axis=1)[:, 0:TopN]
+
+        self.assertTrue(np.array_equal(ranking, ranking_control), "scoresArrayTopN incorrect")
+
+        ranking = scoresArrayTopN(scores_array, numCols + 10)
+        ranking_control = np.argsort(-scores_array, axis=1)
+
+        self.assertTrue(np.array_equal(ranking, ranking_control), "scoresArrayTopN with n greater than the number of items incorrect")
+
+
+
 if __name__ == '__main__':
 
     unittest.main()
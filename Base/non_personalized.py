@@ -10,54 +10,110 @@ from Base.Recommender import Recommender
 from Base.Recommender_utils import check_matrix
 
 
-class TopPop(Recommender):
-    """Top Popular recommender"""
+class Global_Ranking_Recommender(Recommender):
+    """
+    Base class of the recommenders that rank the items of all users with the same precomputed item_ranking.
+    The recommendations of a user are the first n items of the ranking which are neither seen nor filtered,
+    found with a bitset of the excluded positions in the ranking, without scoring and sorting all items.
+    """
 
-    RECOMMENDER_NAME = "TopPop"
+    def _set_item_ranking(self, item_ranking):
 
-    def __init__(self, URM_train):
-        super(TopPop, self).__init__()
+        self.item_ranking = np.asarray(item_ranking, dtype=np.int32)
 
-        # convert to csc matrix for faster column-wise sum
-        self.URM_train = check_matrix(URM_train, 'csc', dtype=np.float32)
+        # Position of each item in the ranking
+        self.item_position = np.zeros(len(self.item_ranking), dtype=np.int32)
+        self.item_position[self.item_ranking] = np.arange(len(self.item_ranking), dtype=np.int32)
 
 
-    def fit(self):
+    def _rank_batch(self, users_in_batch, n, exclude_seen, filterTopPop, filterCustomItems):
+        """
+        :return: ranking of each user, number of items of the ranking which are not excluded
+        """
 
-        self.item_pop = (self.URM_train > 0).sum(axis=0)  # this command returns a numpy.matrix of size (1, nitems)
-        self.item_pop = np.asarray(self.item_pop).squeeze()  # necessary to convert it into a numpy.array of size (nitems,)
+        n_items = len(self.item_ranking)
 
+        if n is None:
+            n = n_items
 
-    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+        excluded_items = [np.array([], dtype=np.int32)]
 
-        scores = np.array(self.item_pop.copy(), dtype=np.float)
+        if filterTopPop:
+            excluded_items.append(self.filterTopPop_ItemsID)
+
+        if filterCustomItems:
+            excluded_items.append(self.filterCustomItems_ItemsID)
+
+        excluded_items = np.concatenate(excluded_items)
+
+        n_seen = np.zeros(len(users_in_batch), dtype=np.int32)
 
         if exclude_seen:
-            scores = self._filter_seen_on_scores(user_id, scores)
+            URM_batch = self.URM_train[users_in_batch]
+            n_seen = np.diff(URM_batch.indptr)
 
-        if filterTopPop:
-            scores = self._filter_TopPop_on_scores(scores)
+        # Only the first items of the ranking can be recommended, at most n plus the excluded ones
+        window = min(n + (n_seen.max() if len(n_seen) > 0 else 0) + len(excluded_items), n_items)
 
-        if filterCustomItems:
-            scores = self._filterCustomItems_on_scores(scores)
+        # One row of excluded positions in the window for each user
+        excluded = np.zeros((len(users_in_batch), window), dtype=bool)
 
+        if len(excluded_items) > 0:
+            excluded_position = self.item_position[excluded_items]
+            excluded[:, excluded_position[excluded_position < window]] = True
 
-        # rank items and mirror column to obtain a ranking in descending score
-        #ranking = scores.argsort()
-        #ranking = np.flip(ranking, axis=0)
+        if exclude_seen:
+            seen_position = self.item_position[URM_batch.indices]
+            seen_row = np.repeat(np.arange(len(users_in_batch)), n_seen)
 
-        # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
-        # - Partition the data to extract the set of relevant items
-        # - Sort only the relevant items
-        # - Get the original item index
-        relevant_items_partition = (-scores).argpartition(n)[0:n]
-        relevant_items_partition_sorting = np.argsort(-scores[relevant_items_partition])
-        ranking = relevant_items_partition[relevant_items_partition_sorting]
+            in_window = seen_position < window
+            excluded[seen_row[in_window], seen_position[in_window]] = True
 
+        n_allowed = window - excluded.sum(axis=1)
+
+        # Stable sort moves the excluded positions at the end, preserving the order of the others
+        ranking_position = np.argsort(excluded, axis=1, kind='stable')[:, :min(n, window)]
+
+        return self.item_ranking[ranking_position], n_allowed
+
+
+    def recommendBatch(self, users_in_batch, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+
+        ranking, _ = self._rank_batch(users_in_batch, n, exclude_seen, filterTopPop, filterCustomItems)
 
         return ranking
 
 
+    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+
+        ranking, n_allowed = self._rank_batch([user_id], n, exclude_seen, filterTopPop, filterCustomItems)
+
+        return ranking[0, :n_allowed[0]]
+
+
+
+
+
+class TopPop(Global_Ranking_Recommender):
+    """Top Popular recommender"""
+
+    RECOMMENDER_NAME = "TopPop"
+
+    def __init__(self, URM_train):
+        super(TopPop, self).__init__()
+
+        # csr matrix for the lookup of the seen items
+        self.URM_train = check_matrix(URM_train, 'csr', dtype=np.float32)
+
+
+    def fit(self):
+
+        # number of positive interactions of each item
+        self.item_pop = np.bincount(self.URM_train.indices[self.URM_train.data > 0], minlength=self.URM_train.shape[1])
+
+        self._set_item_ranking(np.argsort(-self.item_pop, kind='stable'))
+
+
 
     def __str__(self):
         return "TopPop"
@@ -121,7 +177,7 @@ class Random(Recommender):
 
 
 
-class GlobalEffects(Recommender):
+class GlobalEffects(Global_Ranking_Recommender):
     """docstring for GlobalEffects"""
 
     def __init__(self, lambda_user=10, lambda_item=25):
@@ -131,6 +187,7 @@ class GlobalEffects(Recommender):
 
     def fit(self, X):
         self.dataset = X
+        self.URM_train = check_matrix(X, 'csr', dtype=np.float32)
         # convert to csc matrix for faster column-wise sum
         X = check_matrix(X, 'csc', dtype=np.float32)
         # 1) global average
@@ -166,13 +223,7 @@ class GlobalEffects(Recommender):
 
         # 4) precompute the item ranking by using the item bias only
         # the global average and user bias won't change the ranking, so there is no need to use them
-        self.item_ranking = np.argsort(self.bi)[::-1]
-
-    def recommend(self, user_id, k=None, exclude_seen=True):
-        ranking = self.item_ranking
-        if exclude_seen:
-            ranking = self._filter_seen(user_id, ranking)
-        return ranking[:k]
+        self._set_item_ranking(np.argsort(-self.bi, kind='stable'))
 
     def __str__(self):
         return 'GlobalEffects'
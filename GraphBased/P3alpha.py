@@ -12,7 +12,7 @@ from Base.Recommender import Recommender
 from Base.Recommender_utils import check_matrix, similarityMatrixTopK
 
 from Base.Similarity_Matrix_Recommender import Similarity_Matrix_Recommender
-import time, sys
+from GraphBased.graph_walk_similarity import compute_graph_walk_similarity
 
 class P3alphaRecommender(Similarity_Matrix_Recommender, Recommender):
     """ P3alpha recommender """
@@ -31,7 +31,7 @@ class P3alphaRecommender(Similarity_Matrix_Recommender, Recommender):
                                                                             self.min_rating, self.topK, self.implicit,
                                                                             self.normalize_similarity)
 
-    def fit(self, topK=100, alpha=1., min_rating=0, implicit=False, normalize_similarity=False):
+    def fit(self, topK=100, alpha=1., min_rating=0, implicit=False, normalize_similarity=False, n_threads=1, max_block_memory_MB=500):
 
         self.topK = topK
         self.alpha = alpha
@@ -66,70 +66,9 @@ class P3alphaRecommender(Similarity_Matrix_Recommender, Recommender):
             Piu = Piu.power(self.alpha)
 
         # Final matrix is computed as Pui * Piu * Pui
-        # Multiplication unpacked for memory usage reasons
-        block_dim = 200
-        d_t = Piu
-
-        # Use array as it reduces memory requirements compared to lists
-        dataBlock = 10000000
-
-        rows = np.zeros(dataBlock, dtype=np.int32)
-        cols = np.zeros(dataBlock, dtype=np.int32)
-        values = np.zeros(dataBlock, dtype=np.float32)
-
-        numCells = 0
-
-
-        start_time = time.time()
-        start_time_printBatch = start_time
-
-        for current_block_start_row in range(0, Pui.shape[1], block_dim):
-
-            if current_block_start_row + block_dim > Pui.shape[1]:
-                block_dim = Pui.shape[1] - current_block_start_row
-
-            similarity_block = d_t[current_block_start_row:current_block_start_row + block_dim, :] * Pui
-            similarity_block = similarity_block.toarray()
-
-            for row_in_block in range(block_dim):
-                row_data = similarity_block[row_in_block, :]
-                row_data[current_block_start_row + row_in_block] = 0
-
-                best = row_data.argsort()[::-1][:self.topK]
-
-                notZerosMask = row_data[best] != 0.0
-
-                values_to_add = row_data[best][notZerosMask]
-                cols_to_add = best[notZerosMask]
-
-                for index in range(len(values_to_add)):
-
-                    if numCells == len(rows):
-                        rows = np.concatenate((rows, np.zeros(dataBlock, dtype=np.int32)))
-                        cols = np.concatenate((cols, np.zeros(dataBlock, dtype=np.int32)))
-                        values = np.concatenate((values, np.zeros(dataBlock, dtype=np.float32)))
-
-
-                    rows[numCells] = current_block_start_row + row_in_block
-                    cols[numCells] = cols_to_add[index]
-                    values[numCells] = values_to_add[index]
-
-                    numCells += 1
-
-
-            if time.time() - start_time_printBatch > 60:
-                print("Processed {} ( {:.2f}% ) in {:.2f} minutes. Rows per second: {:.0f}".format(
-                    current_block_start_row,
-                    100.0 * float(current_block_start_row) / Pui.shape[1],
-                    (time.time() - start_time) / 60,
-                    float(current_block_start_row) / (time.time() - start_time)))
-
-                sys.stdout.flush()
-                sys.stderr.flush()
-
-                start_time_printBatch = time.time()
-
-        self.W_sparse = sps.csr_matrix((values[:numCells], (rows[:numCells], cols[:numCells])), shape=(Pui.shape[1], Pui.shape[1]))
+        # Multiplication unpacked in blocks of rows for memory usage reasons
+        self.W_sparse = compute_graph_walk_similarity(Piu, Pui, self.topK, degree = None, n_threads = n_threads,
+                                               max_block_memory_MB = max_block_memory_MB)
 
 
         if self.normalize_similarity:
@@ -12,7 +12,7 @@ from Base.Recommender import Recommender
 from Base.Recommender_utils import check_matrix, similarityMatrixTopK
 
 from Base.Similarity_Matrix_Recommender import Similarity_Matrix_Recommender
-import time, sys
+from GraphBased.graph_walk_similarity import compute_graph_walk_similarity
 
 class RP3betaRecommender(Similarity_Matrix_Recommender, Recommender):
     """ RP3beta recommender """
@@ -31,7 +31,7 @@ class RP3betaRecommender(Similarity_Matrix_Recommender, Recommender):
                                                                                         self.beta, self.min_rating, self.topK,
                                                                                         self.implicit, self.normalize_similarity)
 
-    def fit(self, alpha=1., beta=0.6, min_rating=0, topK=100, implicit=False, normalize_similarity=True):
+    def fit(self, alpha=1., beta=0.6, min_rating=0, topK=100, implicit=False, normalize_similarity=True, n_threads=1, max_block_memory_MB=500):
 
         self.alpha = alpha
         self.beta = beta
@@ -77,72 +77,9 @@ class RP3betaRecommender(Similarity_Matrix_Recommender, Recommender):
             Piu = Piu.power(self.alpha)
 
         # Final matrix is computed as Pui * Piu * Pui
-        # Multiplication unpacked for memory usage reasons
-        block_dim = 200
-        d_t = Piu
-
-
-        # Use array as it reduces memory requirements compared to lists
-        dataBlock = 10000000
-
-        rows = np.zeros(dataBlock, dtype=np.int32)
-        cols = np.zeros(dataBlock, dtype=np.int32)
-        values = np.zeros(dataBlock, dtype=np.float32)
-
-        numCells = 0
-
-
-        start_time = time.time()
-        start_time_printBatch = start_time
-
-        for current_block_start_row in range(0, Pui.shape[1], block_dim):
-
-            if current_block_start_row + block_dim > Pui.shape[1]:
-                block_dim = Pui.shape[1] - current_block_start_row
-
-            similarity_block = d_t[current_block_start_row:current_block_start_row + block_dim, :] * Pui
-            similarity_block = similarity_block.toarray()
-
-            for row_in_block in range(block_dim):
-                row_data = np.multiply(similarity_block[row_in_block, :], degree)
-                row_data[current_block_start_row + row_in_block] = 0
-
-                best = row_data.argsort()[::-1][:self.topK]
-
-                notZerosMask = row_data[best] != 0.0
-
-                values_to_add = row_data[best][notZerosMask]
-                cols_to_add = best[notZerosMask]
-
-                for index in range(len(values_to_add)):
-
-                    if numCells == len(rows):
-                        rows = np.concatenate((rows, np.zeros(dataBlock, dtype=np.int32)))
-                        cols = np.concatenate((cols, np.zeros(dataBlock, dtype=np.int32)))
-                        values = np.concatenate((values, np.zeros(dataBlock, dtype=np.float32)))
-
-
-                    rows[numCells] = current_block_start_row + row_in_block
-                    cols[numCells] = cols_to_add[index]
-                    values[numCells] = values_to_add[index]
-
-                    numCells += 1
-
-
-            if time.time() - start_time_printBatch > 60:
-                print("Processed {} ( {:.2f}% ) in {:.2f} minutes. Rows per second: {:.0f}".format(
-                    current_block_start_row,
-                    100.0 * float(current_block_start_row) / Pui.shape[1],
-                    (time.time() - start_time) / 60,
-                    float(current_block_start_row) / (time.time() - start_time)))
-
-                sys.stdout.flush()
-                sys.stderr.flush()
-
-                start_time_printBatch = time.time()
-
-
-        self.W = sps.csr_matrix((values[:numCells], (rows[:numCells], cols[:numCells])), shape=(Pui.shape[1], Pui.shape[1]))
+        # Multiplication unpacked in blocks of rows for memory usage reasons
+        self.W = compute_graph_walk_similarity(Piu, Pui, self.topK, degree = degree, n_threads = n_threads,
+                                               max_block_memory_MB = max_block_memory_MB)
 
         if self.normalize_similarity:
             self.W = normalize(self.W, norm='l1', axis=1)
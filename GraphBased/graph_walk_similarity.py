@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 19/10/2026
+
+@author: Maurizio Ferrari Dacrema
+"""
+
+import numpy as np
+import scipy.sparse as sps
+import time, sys
+from multiprocessing.pool import ThreadPool
+
+
+
+def get_block_dim(n_items, max_block_memory_MB = 500):
+    """
+    Number of rows of each block such that the dense similarity block, the argpartition indices
+    and the temporary copies needed by the topK selection fit in the given memory budget
+    :param n_items:
+    :param max_block_memory_MB:
+    :return:
+    """
+
+    # float32 similarity block, its negated copy for argpartition and the int64 argpartition result
+    bytes_per_row = n_items * (4 + 4 + 8)
+
+    block_dim = int(max_block_memory_MB * 1e6 / bytes_per_row)
+
+    return max(1, min(block_dim, n_items))
+
+
+
+def _compute_block(start_row, end_row, Piu, Pui, topK, degree):
+    """
+    Computes the rows [start_row, end_row) of Piu * Pui, optionally weighted by degree, and keeps for each
+    row the topK highest nonzero values
+    :return: number of cells of each row, their column indices and values
+    """
+
+    n_items = Pui.shape[1]
+    block_dim = end_row - start_row
+
+    similarity_block = (Piu[start_row:end_row, :] * Pui).toarray()
+
+    if degree is not None:
+        similarity_block *= degree
+
+    # Remove the diagonal
+    similarity_block[np.arange(block_dim), np.arange(start_row, end_row)] = 0.0
+
+    if topK < n_items:
+        top_k_idx = np.argpartition(-similarity_block, topK-1, axis=1)[:, 0:topK]
+    else:
+        top_k_idx = np.broadcast_to(np.arange(n_items), similarity_block.shape)
+
+    top_k_values = np.take_along_axis(similarity_block, top_k_idx, axis=1)
+
+    not_zeros_mask = top_k_values != 0.0
+
+    row_nnz = not_zeros_mask.sum(axis=1)
+
+    return row_nnz, top_k_idx[not_zeros_mask].astype(np.int32), top_k_values[not_zeros_mask].astype(np.float32)
+
+
+
+
+def compute_graph_walk_similarity(Piu, Pui, topK, degree = None, n_threads = 1, max_block_memory_MB = 500, verbose = True):
+    """
+    Computes the item-item transition probability Piu * Pui of the random walks used by P3alpha and RP3beta,
+    keeping for each row only the topK highest values.
+    The rows are computed in blocks, whose size is chosen from the memory budget, and blocks are distributed over
+    a pool of threads. The CSR is built directly from the per-block outputs, in row order
+
+    :param Piu: items X users
+    :param Pui: users X items
+    :param topK: number of cells to keep for each row, False keeps all of them
+    :param degree: array of size n_items, if given each column j of the product is multiplied by degree[j]
+    :param n_threads:
+    :param max_block_memory_MB: memory budget of each block, each thread processes one block at a time
+    :param verbose:
+    :return: CSR items X items
+    """
+
+    n_items = Pui.shape[1]
+
+    if topK is False:
+        topK = n_items
+
+    topK = min(topK, n_items)
+
+    Piu = sps.csr_matrix(Piu, dtype=np.float32)
+    Pui = sps.csr_matrix(Pui, dtype=np.float32)
+
+    if degree is not None:
+        degree = np.asarray(degree, dtype=np.float32)
+
+    block_dim = get_block_dim(n_items, max_block_memory_MB = max_block_memory_MB)
+    block_start_rows = list(range(0, n_items, block_dim))
+
+    start_time = time.time()
+    start_time_printBatch = start_time
+
+    def _compute_block_by_start_row(start_row):
+        return _compute_block(start_row, min(start_row + block_dim, n_items), Piu, Pui, topK, degree)
+
+
+    if n_threads > 1:
+        pool = ThreadPool(processes=n_threads)
+        block_iterator = pool.imap(_compute_block_by_start_row, block_start_rows)
+    else:
+        pool = None
+        block_iterator = map(_compute_block_by_start_row, block_start_rows)
+
+
+    row_nnz_list, cols_list, values_list = [], [], []
+
+    for block_index, (row_nnz, cols, values) in enumerate(block_iterator):
+
+        row_nnz_list.append(row_nnz)
+        cols_list.append(cols)
+        values_list.append(values)
+
+        processed_rows = min((block_index + 1)*block_dim, n_items)
+
+        if verbose and (time.time() - start_time_printBatch > 60 or processed_rows == n_items):
+            print("Processed {} ( {:.2f}% ) in {:.2f} minutes. Rows per second: {:.0f}".format(
+                processed_rows,
+                100.0 * float(processed_rows) / n_items,
+                (time.time() - start_time) / 60,
+                float(processed_rows) / (time.time() - start_time)))
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            start_time_printBatch = time.time()
+
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+    indptr = np.zeros(n_items + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(row_nnz_list), out=indptr[1:])
+
+    W = sps.csr_matrix((np.concatenate(values_list), np.concatenate(cols_list), indptr), shape=(n_items, n_items))
+    W.sort_indices()
+
+    return W
+
+
+
+
+
+if __name__ == '__main__':
+
+    # Fit-time benchmark of the graph-based recommenders for an increasing number of threads
+
+    from GraphBased.P3alpha import P3alphaRecommender
+    from GraphBased.RP3beta import RP3betaRecommender
+
+    from data.Movielens_10m.Movielens10MReader import Movielens10MReader
+    from data.NetflixPrize.NetflixPrizeReader import NetflixPrizeReader
+    from data.DataSplitter import DataSplitter_Warm
+
+    import multiprocessing
+
+    n_threads_list = sorted({1, 2, multiprocessing.cpu_count()})
+
+    output_file = open("results/GraphBased_fit_time_benchmark.txt", "a")
+
+    for dataReader_class in [Movielens10MReader, NetflixPrizeReader]:
+
+        dataSplitter = DataSplitter_Warm(dataReader_class)
+        URM_train = dataSplitter.get_URM_train()
+
+        for recommender_class in [P3alphaRecommender, RP3betaRecommender]:
+
+            for n_threads in n_threads_list:
+
+                recommender = recommender_class(URM_train)
+
+                start_time = time.time()
+                recommender.fit(topK=100, n_threads=n_threads)
+                fit_time = time.time() - start_time
+
+                result_string = "{} on {}: {} threads, fit time {:.2f} sec\n".format(
+                    recommender_class.RECOMMENDER_NAME, dataReader_class.DATASET_SUBFOLDER[:-1], n_threads, fit_time)
+
+                print(result_string)
+                output_file.write(result_string)
+                output_file.flush()
+
+    output_file.close()
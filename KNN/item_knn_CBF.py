@@ -9,9 +9,7 @@ Created on 23/10/17
 from Base.Recommender import Recommender
 from Base.Recommender_utils import check_matrix
 from Base.Similarity_Matrix_Recommender import Similarity_Matrix_Recommender
-from Base.IR_feature_weighting import okapi_BM_25, TF_IDF
-
-import numpy as np
+from Base.IR_feature_weighting import apply_feature_weighting
 
 try:
     from Base.Cython.cosine_similarity import Cosine_Similarity
@@ -30,10 +28,11 @@ class ItemKNNCBFRecommender(Similarity_Matrix_Recommender, Recommender):
     def __init__(self, ICM, URM_train, sparse_weights=True):
         super(ItemKNNCBFRecommender, self).__init__()
 
-        self.ICM = ICM.copy()
+        # The ICM is never modified, the feature weighting is computed on a new matrix and cached for the given ICM
+        self.ICM = ICM
 
         # CSR is faster during evaluation
-        self.URM_train = check_matrix(URM_train.copy(), 'csr')
+        self.URM_train = check_matrix(URM_train, 'csr')
 
         self.sparse_weights = sparse_weights
 
@@ -46,17 +45,11 @@ class ItemKNNCBFRecommender(Similarity_Matrix_Recommender, Recommender):
         if feature_weighting not in self.FEATURE_WEIGHTING_VALUES:
             raise ValueError("Value for 'feature_weighting' not recognized. Acceptable values are {}, provided was '{}'".format(self.FEATURE_WEIGHTING_VALUES, feature_weighting))
 
+        self.feature_weighting = feature_weighting
 
-        if feature_weighting == "BM25":
-            self.ICM = self.ICM.astype(np.float32)
-            self.ICM = okapi_BM_25(self.ICM)
-
-        elif feature_weighting == "TF-IDF":
-            self.ICM = self.ICM.astype(np.float32)
-            self.ICM = TF_IDF(self.ICM)
-
+        ICM_weighted = apply_feature_weighting(self.ICM, self.feature_weighting)
 
-        self.similarity = Cosine_Similarity(self.ICM.T, shrink=shrink, topK=topK, normalize=normalize, mode = similarity)
+        self.similarity = Cosine_Similarity(ICM_weighted.T, shrink=shrink, topK=topK, normalize=normalize, mode = similarity)
 
 
         if self.sparse_weights:
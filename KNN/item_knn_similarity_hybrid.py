@@ -6,6 +6,10 @@ Created on 15/04/18
 @author: Maurizio Ferrari Dacrema
 """
 
+import numpy as np
+import scipy.sparse as sps
+from collections import OrderedDict
+
 from Base.Recommender import Recommender
 from Base.Recommender_utils import check_matrix, similarityMatrixTopK
 from Base.Similarity_Matrix_Recommender import Similarity_Matrix_Recommender
@@ -22,12 +26,17 @@ class ItemKNNSimilarityHybridRecommender(Similarity_Matrix_Recommender, Recommen
     """ ItemKNNSimilarityHybridRecommender
     Hybrid of two similarities S = S1*alpha + S2*(1-alpha)
 
+    If precompute_union is True the two similarities are aligned once on the union of their sparsity patterns,
+    each fit only blends the two aligned data arrays before selecting the topK.
+    If cache_fit is True the similarity obtained for each (alpha, topK) is kept and reused by subsequent fits,
+    at most fit_cache_size similarities are kept, the least recently used one is removed first
+
     """
 
     RECOMMENDER_NAME = "ItemKNNSimilarityHybridRecommender"
 
 
-    def __init__(self, URM_train, Similarity_1, Similarity_2, sparse_weights=True):
+    def __init__(self, URM_train, Similarity_1, Similarity_2, sparse_weights=True, precompute_union = False, cache_fit = False, fit_cache_size = 10):
         super(ItemKNNSimilarityHybridRecommender, self).__init__()
 
         if Similarity_1.shape != Similarity_2.shape:
@@ -35,24 +44,131 @@ class ItemKNNSimilarityHybridRecommender(Similarity_Matrix_Recommender, Recommen
                 Similarity_1.shape, Similarity_2.shape
             ))
 
-        # CSR is faster during evaluation
-        self.Similarity_1 = check_matrix(Similarity_1.copy(), 'csr')
-        self.Similarity_2 = check_matrix(Similarity_2.copy(), 'csr')
+        self.precompute_union = precompute_union
+
+        if self.precompute_union:
+            self._align_on_union_structure(Similarity_1, Similarity_2)
 
-        self.URM_train = check_matrix(URM_train.copy(), 'csr')
+        else:
+            # CSR is faster during evaluation, check_matrix already returns a copy
+            self.Similarity_1 = check_matrix(Similarity_1, 'csr')
+            self.Similarity_2 = check_matrix(Similarity_2, 'csr')
+
+        self.URM_train = check_matrix(URM_train, 'csr')
 
         self.sparse_weights = sparse_weights
 
+        if cache_fit and fit_cache_size < 1:
+            raise ValueError("ItemKNNSimilarityHybridRecommender: fit_cache_size must be a positive integer, provided was '{}'".format(fit_cache_size))
+
+        self.cache_fit = cache_fit
+        self.fit_cache_size = fit_cache_size
+        self._fit_cache = OrderedDict()
+
+
+
+    def _align_on_union_structure(self, Similarity_1, Similarity_2):
+        """
+        Builds the CSC structure of the union of the nonzero cells of the two similarities and two data arrays
+        aligned on it, a cell missing in one of the similarities has value 0 in the corresponding data array
+        :param Similarity_1:
+        :param Similarity_2:
+        :return:
+        """
+
+        Similarity_1 = check_matrix(Similarity_1, 'csc')
+        Similarity_2 = check_matrix(Similarity_2, 'csc')
+
+        # Cells with an explicit zero are not part of the union
+        for similarity in [Similarity_1, Similarity_2]:
+            similarity.sum_duplicates()
+            similarity.eliminate_zeros()
+
+        union_structure = check_matrix(Similarity_1, 'csc', dtype=np.bool_) + check_matrix(Similarity_2, 'csc', dtype=np.bool_)
+        union_structure = check_matrix(union_structure, 'csc', dtype=np.bool_)
+        union_structure.sort_indices()
+
+        self.union_shape = union_structure.shape
+        self.union_indptr = union_structure.indptr
+        self.union_indices = union_structure.indices
+
+        union_cell_key = self._get_cell_key(union_structure)
+
+        self.union_data_1 = np.zeros(len(union_cell_key), dtype=np.float32)
+        self.union_data_2 = np.zeros(len(union_cell_key), dtype=np.float32)
+
+        for similarity, union_data in [(Similarity_1, self.union_data_1), (Similarity_2, self.union_data_2)]:
+
+            union_position = np.searchsorted(union_cell_key, self._get_cell_key(similarity))
+            union_data[union_position] = similarity.data
+
+
+
+    def _get_cell_key(self, sparse_matrix_csc):
+        """
+        Unique key of each cell, ordered as the cells of a CSC with sorted indices
+        :param sparse_matrix_csc:
+        :return:
+        """
+
+        cell_col = np.repeat(np.arange(sparse_matrix_csc.shape[1], dtype=np.int64), np.ediff1d(sparse_matrix_csc.indptr))
+
+        return cell_col * sparse_matrix_csc.shape[0] + sparse_matrix_csc.indices
+
+
+
+    def _get_blended_similarity(self):
+
+        if self.precompute_union:
+
+            W_data = self.union_data_1*self.alpha + self.union_data_2*(1-self.alpha)
+
+            # eliminate_zeros works in place on the structure, so the union structure is copied
+            W = sps.csc_matrix((W_data, self.union_indices.copy(), self.union_indptr.copy()), shape=self.union_shape)
+
+            # Cells present in only one similarity, or where the two cancel out, can be zero after the blend
+            W.eliminate_zeros()
+
+            return W
+
+        return self.Similarity_1*self.alpha + self.Similarity_2*(1-self.alpha)
+
+
 
     def fit(self, topK=100, alpha = 0.5):
 
         self.topK = topK
         self.alpha = alpha
 
-        W = self.Similarity_1*self.alpha + self.Similarity_2*(1-self.alpha)
+        fit_key = (self.alpha, self.topK, self.sparse_weights)
+
+        if self.cache_fit and fit_key in self._fit_cache:
+
+            self._fit_cache.move_to_end(fit_key)
+
+            if self.sparse_weights:
+                self.W_sparse = self._fit_cache[fit_key]
+            else:
+                self.W = self._fit_cache[fit_key]
+
+            return
+
+
+        W = self._get_blended_similarity()
 
         if self.sparse_weights:
             self.W_sparse = similarityMatrixTopK(W, forceSparseOutput=True, k=self.topK)
         else:
             self.W = similarityMatrixTopK(W, forceSparseOutput=False, k=self.topK)
 
+
+        if self.cache_fit:
+            self._fit_cache[fit_key] = self.W_sparse if self.sparse_weights else self.W
+
+            if len(self._fit_cache) > self.fit_cache_size:
+                self._fit_cache.popitem(last=False)
+
+
+
+    def clear_fit_cache(self):
+        self._fit_cache = OrderedDict()
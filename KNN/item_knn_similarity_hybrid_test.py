@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 19/10/2026
+
+@author: Maurizio Ferrari Dacrema
+"""
+
+import unittest
+
+
+import numpy as np
+import scipy.sparse as sps
+
+
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_blend_paths(self):
+
+        from KNN.item_knn_similarity_hybrid import ItemKNNSimilarityHybridRecommender
+
+        n_items = 60
+
+        URM_train = sps.random(100, n_items, density=0.1, format='csr', dtype=np.float32, random_state=1)
+        Similarity_1 = sps.random(n_items, n_items, density=0.2, format='csr', dtype=np.float32, random_state=2)
+        Similarity_2 = sps.random(n_items, n_items, density=0.2, format='csr', dtype=np.float32, random_state=3)
+
+        # Cells that cancel out for alpha 0.5
+        Similarity_2 = Similarity_2.tolil()
+        Similarity_2[0, :10] = -Similarity_1[0, :10].toarray()
+        Similarity_2 = Similarity_2.tocsr()
+
+        recommender_plain = ItemKNNSimilarityHybridRecommender(URM_train, Similarity_1, Similarity_2)
+        recommender_union = ItemKNNSimilarityHybridRecommender(URM_train, Similarity_1, Similarity_2, precompute_union=True)
+        recommender_cache = ItemKNNSimilarityHybridRecommender(URM_train, Similarity_1, Similarity_2, precompute_union=True,
+                                                               cache_fit=True, fit_cache_size=2)
+
+        for alpha in [0.0, 0.5, 1.0, 0.5, 0.3, 0.0]:
+
+            recommender_plain.fit(topK=10, alpha=alpha)
+            recommender_union.fit(topK=10, alpha=alpha)
+            recommender_cache.fit(topK=10, alpha=alpha)
+
+            W_plain = recommender_plain.W_sparse.copy()
+            W_plain.eliminate_zeros()
+
+            for recommender in [recommender_union, recommender_cache]:
+
+                assert recommender.W_sparse.nnz == W_plain.nnz, "W_sparse nnz not matching control for alpha {}".format(alpha)
+                assert np.allclose(recommender.W_sparse.toarray(), W_plain.toarray()), "W_sparse not matching control for alpha {}".format(alpha)
+
+            assert len(recommender_cache._fit_cache) <= 2, "fit cache larger than fit_cache_size"
+
+
+
+
+if __name__ == '__main__':
+
+
+    unittest.main()
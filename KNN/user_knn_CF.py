@@ -9,7 +9,7 @@ Created on 23/10/17
 import numpy as np
 
 from Base.Recommender import Recommender
-from Base.Recommender_utils import check_matrix
+from Base.Recommender_utils import check_matrix, scoresArrayTopN
 from Base.Similarity_Matrix_Recommender import Similarity_Matrix_Recommender
 
 try:
@@ -35,6 +35,11 @@ class UserKNNCFRecommender(Similarity_Matrix_Recommender, Recommender):
 
         self.sparse_weights = sparse_weights
 
+        # Used to normalize the scores by the sum of the weights of the neighbours who rated each item,
+        # built on the first normalized scoring
+        self.URM_train_binary = None
+
+
     def fit(self, topK=50, shrink=100, similarity='cosine', normalize=True):
 
         self.topK = topK
@@ -43,43 +48,67 @@ class UserKNNCFRecommender(Similarity_Matrix_Recommender, Recommender):
         self.similarity = Cosine_Similarity(self.URM_train.T, shrink=shrink, topK=topK, normalize=normalize, mode = similarity)
 
         if self.sparse_weights:
-            self.W_sparse = self.similarity.compute_similarity()
+            # Neighbours of each user are stored as CSR rows, scoring a batch of users requires a single SpMM
+            self.W_sparse = check_matrix(self.similarity.compute_similarity(), 'csr')
         else:
             self.W = self.similarity.compute_similarity()
             self.W = self.W.toarray()
 
 
 
+    def _get_URM_train_binary(self):
 
+        if self.URM_train_binary is None:
+            self.URM_train_binary = self.URM_train.copy()
+            self.URM_train_binary.data = np.ones_like(self.URM_train_binary.data)
 
-    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+        return self.URM_train_binary
 
-        if n==None:
-            n=self.URM_train.shape[1]-1
 
-        # compute the scores using the dot product
+
+    def _compute_score_batch(self, users_in_batch):
+        """
+        Computes the scores of all items for a batch of users, score of item i for user u is the sum of the
+        interactions with i of the neighbours of u weighted by their similarity.
+        If normalize is True the score is divided by the sum of the weights of the neighbours who interacted with i
+        :param users_in_batch:
+        :return: users X items dense array
+        """
+
         if self.sparse_weights:
 
-            scores = self.W_sparse[user_id].dot(self.URM_train).toarray().ravel()
+            W_batch = self.W_sparse[users_in_batch]
+            scores_array = W_batch.dot(self.URM_train).toarray()
+
+            if self.normalize:
+                den = W_batch.dot(self._get_URM_train_binary()).toarray()
 
         else:
             # Numpy dot does not recognize sparse matrices, so we must
             # invoke the dot function on the sparse one
-            scores = self.URM_train.T.dot(self.W[user_id])
+            W_batch = self.W[users_in_batch]
+            scores_array = self.URM_train.T.dot(W_batch.T).T
+
+            if self.normalize:
+                den = self._get_URM_train_binary().T.dot(W_batch.T).T
 
         if self.normalize:
             # normalization will keep the scores in the same range
             # of value of the ratings in dataset
-            user_profile = self.URM_train[user_id]
-
-            rated = user_profile.copy()
-            rated.data = np.ones_like(rated.data)
-            if self.sparse_weights:
-                den = rated.dot(self.W_sparse).toarray().ravel()
-            else:
-                den = rated.dot(self.W).ravel()
             den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
-            scores /= den
+            scores_array /= den
+
+        return scores_array
+
+
+
+
+    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+
+        if n==None:
+            n=self.URM_train.shape[1]-1
+
+        scores = self._compute_score_batch([user_id]).ravel()
 
         if exclude_seen:
             scores = self._filter_seen_on_scores(user_id, scores)
@@ -111,20 +140,11 @@ class UserKNNCFRecommender(Similarity_Matrix_Recommender, Recommender):
 
     def recommendBatch(self, users_in_batch, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
 
-        # compute the scores using the dot product
-
-        if self.sparse_weights:
-
-            scores_array = self.W_sparse[users_in_batch].dot(self.URM_train)
-            scores_array = scores_array.toarray()
-
-        else:
-            # Numpy dot does not recognize sparse matrices, so we must
-            # invoke the dot function on the sparse one
-            scores_array = self.URM_train.T.dot(self.W[users_in_batch].T)
+        if n==None:
+            n=self.URM_train.shape[1]-1
 
-        if self.normalize:
-            raise ValueError("Not implemented")
+        # compute the scores using the dot product
+        scores_array = self._compute_score_batch(users_in_batch)
 
         # To exclude seen items perform a boolean indexing and replace their score with -inf
         # Seen items will be at the bottom of the list but there is no guarantee they'll NOT be
@@ -140,20 +160,7 @@ class UserKNNCFRecommender(Similarity_Matrix_Recommender, Recommender):
             scores_array[:, self.filterCustomItems_ItemsID] = -np.inf
 
 
-        # rank items and mirror column to obtain a ranking in descending score
-        #ranking = (-scores_array).argsort(axis=1)
-        #ranking = np.fliplr(ranking)
-        #ranking = ranking[:,0:n]
-
-        ranking = np.zeros((scores_array.shape[0],n), dtype=np.int)
-
-        for row_index in range(scores_array.shape[0]):
-            scores = scores_array[row_index]
-
-            relevant_items_partition = (-scores).argpartition(n)[0:n]
-            relevant_items_partition_sorting = np.argsort(-scores[relevant_items_partition])
-            ranking[row_index] = relevant_items_partition[relevant_items_partition_sorting]
-
+        # Partition and sort the whole batch at once
+        ranking = scoresArrayTopN(scores_array, n)
 
         return ranking
-
@@ -8,6 +8,7 @@ Created on 07/09/17
 
 from Base.Recommender_utils import similarityMatrixTopK
 from Base.Recommender import Recommender
+from MatrixFactorization.MIPS_Index import MIPS_Recommender_Mixin
 import subprocess
 import os, sys
 import time
@@ -23,7 +24,7 @@ def default_validation_function(self):
 
 
 
-class MF_BPR_Cython(Recommender):
+class MF_BPR_Cython(MIPS_Recommender_Mixin, Recommender):
 
     RECOMMENDER_NAME = "MF_BPR_Cython_Recommender"
 
@@ -41,6 +42,9 @@ class MF_BPR_Cython(Recommender):
 
         self.positive_threshold = positive_threshold
 
+        # Approximate topK index over the item factors, built on the first approximate recommendation
+        self.MIPS_index = None
+
         if URM_validation is not None:
             self.URM_validation = URM_validation.copy()
         else:
@@ -55,10 +59,10 @@ class MF_BPR_Cython(Recommender):
 
 
     def fit(self, epochs=30, logFile=None, URM_test=None, filterTopPop = False, filterCustomItems = np.array([], dtype=np.int), minRatingsPerUser=1,
-            batch_size = 1000, num_factors=10,
+            batch_size = 1, num_factors=10,
             learning_rate = 0.01, sgd_mode='sgd', user_reg = 0.0, positive_reg = 0.0, negative_reg = 0.0,
             stop_on_validation = False, lower_validatons_allowed = 5, validation_metric = "map",
-            validation_function = None, validation_every_n = 1):
+            validation_function = None, validation_every_n = 1, n_threads = 1, factors_precision = "float64"):
 
 
 
@@ -73,6 +77,10 @@ class MF_BPR_Cython(Recommender):
 
         self.sgd_mode = sgd_mode
 
+        # With n_threads > 1 each epoch runs lock-free (Hogwild), float32 factors halve the memory traffic
+        self.n_threads = n_threads
+        self.factors_precision = factors_precision
+
 
         # Import compiled module
         from MatrixFactorization.Cython.MF_BPR_Cython_Epoch import MF_BPR_Cython_Epoch
@@ -81,11 +89,13 @@ class MF_BPR_Cython(Recommender):
         self.cythonEpoch = MF_BPR_Cython_Epoch(URM_train_positive,
                                                  n_factors = self.num_factors,
                                                  learning_rate=learning_rate,
-                                                 batch_size=1,
+                                                 batch_size=batch_size,
                                                  sgd_mode = sgd_mode,
                                                  user_reg=user_reg,
                                                  positive_reg=positive_reg,
-                                                 negative_reg=negative_reg)
+                                                 negative_reg=negative_reg,
+                                                 n_threads = n_threads,
+                                                 factors_precision = factors_precision)
 
 
         if validation_function is None:
@@ -175,6 +185,8 @@ class MF_BPR_Cython(Recommender):
         self.W = self.W_best.copy()
         self.H = self.H_best.copy()
 
+        self.MIPS_index = None
+
 
         sys.stdout.flush()
 
@@ -232,7 +244,7 @@ class MF_BPR_Cython(Recommender):
 
         current_config = {'learn_rate': self.learning_rate,
                           'num_factors': self.num_factors,
-                          'batch_size': 1,
+                          'batch_size': self.batch_size,
                           'epoch': currentEpoch}
 
         print("Test case: {}\nResults {}\n".format(current_config, results_run))
@@ -246,7 +258,22 @@ class MF_BPR_Cython(Recommender):
 
 
 
-    def recommendBatch(self, users_in_batch, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+    def _get_MIPS_item_factors(self):
+        return self.H
+
+    def _get_MIPS_user_factors(self, user_id):
+        return self.W[user_id]
+
+
+
+    def recommendBatch(self, users_in_batch, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False,
+                       approximate = False):
+
+        if n is None:
+            n = self.URM_train.shape[1] - 1
+
+        if approximate:
+            return self._recommendBatch_approximate(users_in_batch, n, exclude_seen, filterTopPop, filterCustomItems)
 
         # compute the scores using the dot product
         user_profile_batch = self.URM_train[users_in_batch]
@@ -288,12 +315,19 @@ class MF_BPR_Cython(Recommender):
 
 
 
-    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False,
+                  approximate = False):
+        """
+        :param approximate: if True the topK is retrieved with the MIPS_Index, scoring only the candidate items
+        """
 
 
         if n==None:
             n=self.URM_train.shape[1]-1
 
+        if approximate:
+            return self._recommend_approximate(user_id, n, exclude_seen, filterTopPop, filterCustomItems)
+
         scores_array = np.dot(self.W[user_id], self.H.T)
 
         if self.normalize:
@@ -357,3 +391,5 @@ class MF_BPR_Cython(Recommender):
 
         for attrib_name in npzfile.files:
              self.__setattr__(attrib_name, npzfile[attrib_name])
+
+        self.MIPS_index = None
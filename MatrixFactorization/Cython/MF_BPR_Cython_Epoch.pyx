@@ -18,11 +18,14 @@ Created on 07/09/17
 from Base.Recommender_utils import check_matrix
 import numpy as np
 cimport numpy as np
+cimport cython
 import time
 import sys
 
 from libc.math cimport exp, sqrt
-from libc.stdlib cimport rand, RAND_MAX
+
+from cython cimport floating
+from cython.parallel import prange
 
 
 cdef struct BPR_sample:
@@ -31,6 +34,61 @@ cdef struct BPR_sample:
     long neg_item
 
 
+
+cdef inline np.uint64_t xorshift_rand(np.uint64_t * rng_state) nogil:
+    """
+    Xorshift64 random generator, each thread has its own state, which must not be 0
+    """
+
+    rng_state[0] ^= rng_state[0] << 13
+    rng_state[0] ^= rng_state[0] >> 7
+    rng_state[0] ^= rng_state[0] << 17
+
+    return rng_state[0]
+
+
+
+cdef inline double compute_x_uij(floating * W_u, floating * H_i, floating * H_j, int n_factors) nogil:
+
+    cdef int index
+    cdef double x_uij = 0.0
+
+    for index in range(n_factors):
+        x_uij += W_u[index] * (H_i[index] - H_j[index])
+
+    return x_uij
+
+
+
+cdef inline void update_factors(floating * W_u, floating * H_i, floating * H_j, int n_factors,
+                                double learning_rate, double sigmoid_user, double sigmoid_item_i, double sigmoid_item_j,
+                                double user_reg, double positive_reg, double negative_reg) nogil:
+    """
+    Updates the factors of a sample, all components are read before being written in a single loop over
+    contiguous rows, which the compiler can vectorize
+    """
+
+    cdef int index
+    cdef floating H_i_value, H_j_value, W_u_value
+
+    for index in range(n_factors):
+
+        # Copy original value to avoid messing up the updates
+        H_i_value = H_i[index]
+        H_j_value = H_j[index]
+        W_u_value = W_u[index]
+
+        W_u[index] = W_u_value + learning_rate * (sigmoid_user * ( H_i_value - H_j_value ) - user_reg * W_u_value)
+        H_i[index] = H_i_value + learning_rate * (sigmoid_item_i * ( W_u_value ) - positive_reg * H_i_value)
+        H_j[index] = H_j_value + learning_rate * (sigmoid_item_j * (-W_u_value ) - negative_reg * H_j_value)
+
+
+
+# Precisions available for the factors
+FACTORS_PRECISION_VALUES = ["float64", "float32"]
+
+
+@cython.final
 cdef class MF_BPR_Cython_Epoch:
 
     cdef int n_users, n_items, n_factors
@@ -38,11 +96,18 @@ cdef class MF_BPR_Cython_Epoch:
 
     cdef float learning_rate, user_reg, positive_reg, negative_reg
 
-    cdef int batch_size
+    cdef int batch_size, n_threads
 
     cdef int[:] URM_mask_indices, URM_mask_indptr
 
-    cdef double[:,:] W, H
+    # Factors are stored row-contiguous in the selected precision
+    cdef int factors_float32
+    cdef double[:, ::1] W_float64, H_float64
+    cdef float[:, ::1] W_float32, H_float32
+
+    # Samples and gradients of the current mini-batch of each thread
+    cdef long[:, :, ::1] batch_samples
+    cdef double[:, ::1] batch_sigmoid
 
 
     # Adaptive gradient
@@ -54,12 +119,12 @@ cdef class MF_BPR_Cython_Epoch:
     cdef double [:] sgd_cache_I_momentum_1, sgd_cache_I_momentum_2
     cdef double [:] sgd_cache_U_momentum_1, sgd_cache_U_momentum_2
     cdef double beta_1, beta_2, beta_1_power_t, beta_2_power_t
-    cdef double momentum_1, momentum_2
 
 
     def __init__(self, URM_mask, n_factors = 10,
                  learning_rate = 0.01, user_reg = 0.0, positive_reg = 0.0, negative_reg = 0.0,
-                 batch_size = 1, sgd_mode='sgd', gamma=0.995, beta_1=0.9, beta_2=0.999):
+                 batch_size = 1, sgd_mode='sgd', gamma=0.995, beta_1=0.9, beta_2=0.999,
+                 n_threads = 1, factors_precision = "float64"):
 
         super(MF_BPR_Cython_Epoch, self).__init__()
 
@@ -71,12 +136,23 @@ cdef class MF_BPR_Cython_Epoch:
         self.n_items = URM_mask.shape[1]
         self.n_factors = n_factors
 
-        self.URM_mask_indices = URM_mask.indices
-        self.URM_mask_indptr = URM_mask.indptr
+        self.URM_mask_indices = np.array(URM_mask.indices, dtype=np.int32)
+        self.URM_mask_indptr = np.array(URM_mask.indptr, dtype=np.int32)
+
+        if factors_precision not in FACTORS_PRECISION_VALUES:
+            raise ValueError(
+                "factors_precision not valid. Acceptable values are: {}. Provided value was '{}'".format(
+                    FACTORS_PRECISION_VALUES, factors_precision))
+
+        self.factors_float32 = factors_precision == "float32"
 
         # W and H cannot be initialized as zero, otherwise the gradient will always be zero
-        self.W = np.random.random((self.n_users, self.n_factors))
-        self.H = np.random.random((self.n_items, self.n_factors))
+        if self.factors_float32:
+            self.W_float32 = np.random.random((self.n_users, self.n_factors)).astype(np.float32)
+            self.H_float32 = np.random.random((self.n_items, self.n_factors)).astype(np.float32)
+        else:
+            self.W_float64 = np.random.random((self.n_users, self.n_factors))
+            self.H_float64 = np.random.random((self.n_items, self.n_factors))
 
 
 
@@ -128,106 +204,133 @@ cdef class MF_BPR_Cython_Epoch:
         self.positive_reg = positive_reg
         self.negative_reg = negative_reg
 
+        # With batch_size > 1 the gradients of all samples in a mini-batch are computed on the same factors
+        # and then applied. With n_threads > 1 each thread samples and updates the shared factors lock-free (Hogwild)
+        if batch_size < 1:
+            raise ValueError("batch_size not valid. Acceptable values are positive integers. Provided value was '{}'".format(batch_size))
 
-        if batch_size!=1:
-            print("MiniBatch not implemented, reverting to default value 1")
-        self.batch_size = 1
+        if n_threads < 1:
+            raise ValueError("n_threads not valid. Acceptable values are positive integers. Provided value was '{}'".format(n_threads))
 
+        self.batch_size = batch_size
+        self.n_threads = n_threads
 
-    # Using memoryview instead of the sparse matrix itself allows for much faster access
-    cdef int[:] getSeenItems(self, long index):
-        return self.URM_mask_indices[self.URM_mask_indptr[index]:self.URM_mask_indptr[index + 1]]
+        self.batch_samples = np.zeros((self.n_threads, self.batch_size, 3), dtype=np.int64)
+        self.batch_sigmoid = np.zeros((self.n_threads, self.batch_size), dtype=np.float64)
 
 
 
     def epochIteration_Cython(self):
 
-        # Get number of available interactions
-        cdef long totalNumberOfBatch = int(self.n_users / self.batch_size) + 1
+        # Uniform user sampling with replacement, one sample per user
+        cdef long n_samples = self.n_users
+        cdef long n_samples_thread = n_samples // self.n_threads
+        cdef long thread_id
 
+        cdef np.uint64_t[:] rng_state = np.random.randint(1, np.iinfo(np.int64).max, size=self.n_threads, dtype=np.uint64)
 
-        cdef BPR_sample sample
-        cdef long u, i, j
-        cdef long index, numCurrentBatch
-        cdef double x_uij, sigmoid_user, sigmoid_item
+        start_time_epoch = time.time()
 
-        cdef int numSeenItems
+        if self.n_threads == 1:
+            self.epochIteration_thread(0, n_samples, &rng_state[0])
 
+        else:
+            with nogil:
+                for thread_id in prange(self.n_threads, schedule='static', num_threads=self.n_threads):
+                    self.epochIteration_thread(thread_id, n_samples_thread, &rng_state[thread_id])
 
-        cdef double H_i, H_j, W_u
+            n_samples = n_samples_thread * self.n_threads
 
 
-        cdef long start_time_epoch = time.time()
-        cdef long start_time_batch = time.time()
+        print("Processed {} ( {:.2f}% ) in {:.2f} seconds. Sample per second: {:.0f}".format(
+            n_samples,
+            100.0* float(n_samples)/self.n_users,
+            time.time() - start_time_epoch,
+            float(n_samples) / (time.time() - start_time_epoch)))
 
-        for numCurrentBatch in range(totalNumberOfBatch):
+        sys.stdout.flush()
+        sys.stderr.flush()
 
-            # Uniform user sampling with replacement
-            sample = self.sampleBPR_Cython()
 
-            u = sample.user
-            i = sample.pos_item
-            j = sample.neg_item
 
-            x_uij = 0.0
+    cdef void epochIteration_thread(self, long thread_id, long n_samples_thread, np.uint64_t * rng_state) nogil:
 
-            for index in range(self.n_factors):
+        cdef BPR_sample sample
+        cdef long u, i, j
+        cdef long n_samples_batch, sample_index, processed_samples = 0
+        cdef double x_uij, sigmoid_item, sigmoid_user, sigmoid_item_i, sigmoid_item_j
 
-                x_uij = self.W[u,index] * (self.H[i,index] - self.H[j,index])
 
-            # Use gradient of log(sigm(-x_uij))
-            sigmoid_item = 1 / (1 + exp(x_uij))
-            sigmoid_user = sigmoid_item
+        while processed_samples < n_samples_thread:
 
-            #print(sample)
+            n_samples_batch = min(self.batch_size, n_samples_thread - processed_samples)
 
-            sigmoid_item_i = self.adaptive_gradient_item(sigmoid_item, i)
-            sigmoid_item_j = self.adaptive_gradient_item(sigmoid_item, j)
+            # Compute the gradient of all the samples in the batch on the same factors
+            for sample_index in range(n_samples_batch):
 
-            sigmoid_user = self.adaptive_gradient_user(sigmoid_user, u)
+                sample = self.sampleBPR_Cython(rng_state)
 
+                u = sample.user
+                i = sample.pos_item
+                j = sample.neg_item
 
+                self.batch_samples[thread_id, sample_index, 0] = u
+                self.batch_samples[thread_id, sample_index, 1] = i
+                self.batch_samples[thread_id, sample_index, 2] = j
 
+                if self.factors_float32:
+                    x_uij = compute_x_uij(&self.W_float32[u,0], &self.H_float32[i,0], &self.H_float32[j,0], self.n_factors)
+                else:
+                    x_uij = compute_x_uij(&self.W_float64[u,0], &self.H_float64[i,0], &self.H_float64[j,0], self.n_factors)
 
-            for index in range(self.n_factors):
+                # Use gradient of log(sigm(-x_uij))
+                self.batch_sigmoid[thread_id, sample_index] = 1 / (1 + exp(x_uij))
 
-                # Copy original value to avoid messing up the updates
-                H_i = self.H[i, index]
-                H_j = self.H[j, index]
-                W_u = self.W[u, index]
 
-                self.W[u, index] += self.learning_rate * (sigmoid_user * ( H_i - H_j ) - self.user_reg * W_u)
-                self.H[i, index] += self.learning_rate * (sigmoid_item_i * ( W_u ) - self.positive_reg * H_i)
-                self.H[j, index] += self.learning_rate * (sigmoid_item_j * (-W_u ) - self.negative_reg * H_j)
+            for sample_index in range(n_samples_batch):
 
-            #input()
+                u = self.batch_samples[thread_id, sample_index, 0]
+                i = self.batch_samples[thread_id, sample_index, 1]
+                j = self.batch_samples[thread_id, sample_index, 2]
 
-            if((numCurrentBatch%5000000==0 and not numCurrentBatch==0) or numCurrentBatch==totalNumberOfBatch-1):
-                print("Processed {} ( {:.2f}% ) in {:.2f} seconds. Sample per second: {:.0f}".format(
-                    numCurrentBatch*self.batch_size,
-                    100.0* float(numCurrentBatch*self.batch_size)/self.n_users,
-                    time.time() - start_time_batch,
-                    float(numCurrentBatch*self.batch_size + 1) / (time.time() - start_time_epoch)))
+                sigmoid_item = self.batch_sigmoid[thread_id, sample_index]
+                sigmoid_user = sigmoid_item
 
-                sys.stdout.flush()
-                sys.stderr.flush()
+                sigmoid_item_i = self.adaptive_gradient_item(sigmoid_item, i)
+                sigmoid_item_j = self.adaptive_gradient_item(sigmoid_item, j)
+
+                sigmoid_user = self.adaptive_gradient_user(sigmoid_user, u)
+
+                if self.factors_float32:
+                    update_factors(&self.W_float32[u,0], &self.H_float32[i,0], &self.H_float32[j,0], self.n_factors,
+                                   self.learning_rate, sigmoid_user, sigmoid_item_i, sigmoid_item_j,
+                                   self.user_reg, self.positive_reg, self.negative_reg)
+                else:
+                    update_factors(&self.W_float64[u,0], &self.H_float64[i,0], &self.H_float64[j,0], self.n_factors,
+                                   self.learning_rate, sigmoid_user, sigmoid_item_i, sigmoid_item_j,
+                                   self.user_reg, self.positive_reg, self.negative_reg)
+
+            processed_samples += n_samples_batch
 
-                start_time_batch = time.time()
 
 
     def get_W(self):
-        return np.array(self.W)
+        if self.factors_float32:
+            return np.array(self.W_float32)
+        return np.array(self.W_float64)
 
 
     def get_H(self):
-        return np.array(self.H)
+        if self.factors_float32:
+            return np.array(self.H_float32)
+        return np.array(self.H_float64)
 
 
 
-    cdef double adaptive_gradient_item(self, double gradient, long item_id):
+    cdef inline double adaptive_gradient_item(self, double gradient, long item_id) nogil:
 
 
-        cdef double gradient_update
+        cdef double gradient_update, momentum_1, momentum_2
 
 
         if self.useAdaGrad:
@@ -251,10 +354,10 @@ cdef class MF_BPR_Cython_Epoch:
                 self.sgd_cache_I_momentum_2[item_id] * self.beta_2 + (1 - self.beta_2) * gradient**2
 
 
-            self.momentum_1 = self.sgd_cache_I_momentum_1[item_id]/ (1 - self.beta_1_power_t)
-            self.momentum_2 = self.sgd_cache_I_momentum_2[item_id]/ (1 - self.beta_2_power_t)
+            momentum_1 = self.sgd_cache_I_momentum_1[item_id]/ (1 - self.beta_1_power_t)
+            momentum_2 = self.sgd_cache_I_momentum_2[item_id]/ (1 - self.beta_2_power_t)
 
-            gradient_update = self.momentum_1/ (sqrt(self.momentum_2) + 1e-8)
+            gradient_update = momentum_1/ (sqrt(momentum_2) + 1e-8)
 
 
         else:
@@ -266,10 +369,10 @@ cdef class MF_BPR_Cython_Epoch:
 
 
 
-    cdef double adaptive_gradient_user(self, double gradient, long user_id):
+    cdef inline double adaptive_gradient_user(self, double gradient, long user_id) nogil:
 
 
-        cdef double gradient_update
+        cdef double gradient_update, momentum_1, momentum_2
 
         if self.useAdaGrad:
             self.sgd_cache_U[user_id] += gradient ** 2
@@ -292,10 +395,10 @@ cdef class MF_BPR_Cython_Epoch:
                 self.sgd_cache_U_momentum_2[user_id] * self.beta_2 + (1 - self.beta_2) * gradient**2
 
 
-            self.momentum_1 = self.sgd_cache_U_momentum_1[user_id]/ (1 - self.beta_1_power_t)
-            self.momentum_2 = self.sgd_cache_U_momentum_2[user_id]/ (1 - self.beta_2_power_t)
+            momentum_1 = self.sgd_cache_U_momentum_1[user_id]/ (1 - self.beta_1_power_t)
+            momentum_2 = self.sgd_cache_U_momentum_2[user_id]/ (1 - self.beta_2_power_t)
 
-            gradient_update = self.momentum_1/ (sqrt(self.momentum_2) + 1e-8)
+            gradient_update = momentum_1/ (sqrt(momentum_2) + 1e-8)
 
 
         else:
@@ -309,9 +412,9 @@ cdef class MF_BPR_Cython_Epoch:
 
 
 
-    cdef BPR_sample sampleBPR_Cython(self):
+    cdef BPR_sample sampleBPR_Cython(self, np.uint64_t * rng_state) nogil:
 
-        cdef BPR_sample sample = BPR_sample(-1,-1,-1)
+        cdef BPR_sample sample
         cdef long index, start_pos_seen_items, end_pos_seen_items
 
         cdef int negItemSelected, numSeenItems = 0
@@ -320,7 +423,7 @@ cdef class MF_BPR_Cython_Epoch:
         # Skip users with no interactions or with no negative items
         while numSeenItems == 0 or numSeenItems == self.n_items:
 
-            sample.user = rand() % self.n_users
+            sample.user = xorshift_rand(rng_state) % self.n_users
 
             start_pos_seen_items = self.URM_mask_indptr[sample.user]
             end_pos_seen_items = self.URM_mask_indptr[sample.user+1]
@@ -328,7 +431,7 @@ cdef class MF_BPR_Cython_Epoch:
             numSeenItems = end_pos_seen_items - start_pos_seen_items
 
 
-        index = rand() % numSeenItems
+        index = xorshift_rand(rng_state) % numSeenItems
 
         sample.pos_item = self.URM_mask_indices[start_pos_seen_items + index]
 
@@ -340,7 +443,7 @@ cdef class MF_BPR_Cython_Epoch:
         # for every user
         while (not negItemSelected):
 
-            sample.neg_item = rand() % self.n_items
+            sample.neg_item = xorshift_rand(rng_state) % self.n_items
 
             index = 0
             while index < numSeenItems and self.URM_mask_indices[start_pos_seen_items + index]!=sample.neg_item:
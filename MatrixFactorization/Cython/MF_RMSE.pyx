@@ -22,6 +22,41 @@ import scipy.sparse as sps
 import time
 import sys
 
+from libc.math cimport sqrt
+from cython.parallel import prange
+
+
+def get_row_indices(R):
+    """
+    Expands the indptr of the csr R into the row index of each nonzero.
+    The result only depends on the structure of R, therefore it can be computed once and reused across calls
+    """
+
+    return np.repeat(np.arange(R.shape[0], dtype=np.int32), np.diff(R.indptr)).astype(np.int32)
+
+
+
+def get_strata(row_indices, col_indices, n_rows, n_cols, n_threads, sample_order):
+    """
+    DSGD blocking of the samples. Rows and columns are randomly assigned to n_threads blocks each and
+    the samples are grouped, keeping their order, in the n_threads x n_threads strata (row block, column block).
+    Stratum (t, (t + sub_epoch) % n_threads) is processed by thread t, so in each sub epoch
+    the threads never update the same row or column factors
+    :return: sample_order grouped by stratum, indptr of the strata
+    """
+
+    row_block = (np.random.permutation(n_rows) % n_threads).astype(np.int64)
+    col_block = (np.random.permutation(n_cols) % n_threads).astype(np.int64)
+
+    stratum = row_block[row_indices[sample_order]] * n_threads + col_block[col_indices[sample_order]]
+
+    sample_order = sample_order[np.argsort(stratum, kind='stable')].astype(np.int32)
+
+    stratum_indptr = np.zeros(n_threads**2 + 1, dtype=np.int64)
+    np.cumsum(np.bincount(stratum, minlength=n_threads**2), out=stratum_indptr[1:])
+
+    return sample_order, stratum_indptr
+
 
 @cython.boundscheck(False)
 def FunkSVD_sgd(R, int num_factors=50, double lrate=0.01,
@@ -114,6 +149,121 @@ def FunkSVD_sgd(R, int num_factors=50, double lrate=0.01,
     return U, V
 
 
+cdef void FunkSVD_sgd_stratum(int * sample_order, long start, long end, int * row_indices, int * col_indices,
+                              float * data, float * U, float * V, int num_factors,
+                              float lrate, float reg, double * loss) nogil:
+
+    cdef long n
+    cdef int idx, f
+    cdef float rij_pred, err, U_if, V_jf
+    cdef float * U_i
+    cdef float * V_j
+
+    for n in range(start, end):
+
+        idx = sample_order[n]
+
+        U_i = U + <long> row_indices[idx] * num_factors
+        V_j = V + <long> col_indices[idx] * num_factors
+
+        rij_pred = 0.0
+
+        for f in range(num_factors):
+            rij_pred += U_i[f] * V_j[f]
+
+        err = data[idx] - rij_pred
+        loss[0] += err * err
+
+        for f in range(num_factors):
+            U_if = U_i[f]
+            V_jf = V_j[f]
+            U_i[f] += lrate * (err * V_jf - reg * U_if)
+            V_j[f] += lrate * (err * U_if - reg * V_jf)
+
+
+
+@cython.boundscheck(False)
+def FunkSVD_sgd_parallel(R, int num_factors=50, float lrate=0.01, float reg=0.015, int n_iterations=10,
+                         init_mean=0.0, init_std=0.1, float lrate_decay=1.0, rnd_seed=42, int n_threads=1,
+                         row_indices=None):
+    """
+    FunkSVD_sgd with float32 factors on n_threads.
+    The shuffled nonzeros are split in DSGD strata, each epoch is made of n_threads sub epochs in which the threads
+    process strata sharing no user nor item, without locks and without the GIL.
+    :param row_indices: output of get_row_indices(R), if None it is computed
+    """
+
+    if not isinstance(R, sps.csr_matrix):
+        raise ValueError('R must be an instance of scipy.sparse.csr_matrix')
+
+    cdef int n_users = R.shape[0], n_items = R.shape[1]
+    cdef long nnz = R.nnz
+
+    if row_indices is None:
+        row_indices = get_row_indices(R)
+
+    cdef int [:] row_indices_view = np.asarray(row_indices, dtype=np.int32)
+    cdef int [:] col_indices = np.asarray(R.indices, dtype=np.int32)
+    cdef float [:] data = np.asarray(R.data, dtype=np.float32)
+
+    # set the seed of the random number generator
+    np.random.seed(rnd_seed)
+
+    # randomly initialize the user and item latent factors
+    U_array = np.random.normal(init_mean, init_std, (n_users, num_factors)).astype(np.float32)
+    V_array = np.random.normal(init_mean, init_std, (n_items, num_factors)).astype(np.float32)
+
+    cdef float[:,::1] U = U_array
+    cdef float[:,::1] V = V_array
+
+    # build random index to iterate over the non-zero elements in R, grouped by stratum
+    sample_order_array, stratum_indptr_array = get_strata(np.asarray(row_indices_view), np.asarray(col_indices),
+                                                          n_users, n_items, n_threads, np.random.permutation(nnz))
+
+    cdef int[:] sample_order = sample_order_array
+    cdef long[:] stratum_indptr = stratum_indptr_array
+    cdef double[:] thread_loss = np.zeros(n_threads, dtype=np.float64)
+
+    cdef int currentIteration, sub_epoch, thread_id, stratum
+    cdef double loss
+
+    start_time_batch = time.time()
+
+    for currentIteration in range(n_iterations):
+
+        thread_loss[:] = 0.0
+
+        for sub_epoch in range(n_threads):
+            with nogil:
+                for thread_id in prange(n_threads, schedule='static', num_threads=n_threads):
+
+                    stratum = thread_id * n_threads + (thread_id + sub_epoch) % n_threads
+
+                    FunkSVD_sgd_stratum(&sample_order[0], stratum_indptr[stratum], stratum_indptr[stratum + 1],
+                                        &row_indices_view[0], &col_indices[0], &data[0],
+                                        &U[0,0], &V[0,0], num_factors, lrate, reg, &thread_loss[thread_id])
+
+        loss = np.sum(thread_loss) / nnz
+
+        # update the learning rate
+        lrate *= lrate_decay
+
+        print("Iteration {} of {} completed in {:.2f} minutes. Loss is {:.4f}. Sample per second: {:.0f}".format(
+                    currentIteration, n_iterations,
+                    (time.time() - start_time_batch)/60,
+                    loss,
+                    float(nnz) / (time.time() - start_time_batch)))
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        start_time_batch = time.time()
+
+
+    return U_array, V_array
+
+
+
 @cython.boundscheck(False)
 def AsySVD_sgd(R, num_factors=50, lrate=0.01, reg=0.015, iters=10, init_mean=0.0, init_std=0.1, lrate_decay=1.0, rnd_seed=42):
     if not isinstance(R, sps.csr_matrix):
@@ -216,6 +366,135 @@ def AsySVD_compute_user_factors(user_profile, Y):
     return Y_acc
 
 
+
+cdef void AsySVD_sgd_stratum(int * sample_order, long start, long end, int * row_indices, int * col_indices,
+                             int * indptr, float * data, float * X, float * Y, float * X_j_old, float * Y_acc,
+                             int num_factors, float lrate, float reg, double * loss) nogil:
+
+    cdef long n
+    cdef int idx, i, f, l, l_index, n_rated
+    cdef float rij_pred, err, x_il, norm
+    cdef float * X_j
+    cdef float * Y_l
+
+    for n in range(start, end):
+
+        idx = sample_order[n]
+        i = row_indices[idx]
+
+        X_j = X + <long> col_indices[idx] * num_factors
+
+        # accumulate the item latent factors over the items rated by i
+        for f in range(num_factors):
+            Y_acc[f] = 0.0
+
+        for l_index in range(indptr[i], indptr[i+1]):
+            Y_l = Y + <long> col_indices[l_index] * num_factors
+            x_il = data[l_index]
+
+            for f in range(num_factors):
+                Y_acc[f] += x_il * Y_l[f]
+
+        n_rated = indptr[i+1] - indptr[i]
+
+        if n_rated > 0:
+            norm = 1.0 / sqrt(n_rated)
+
+            for f in range(num_factors):
+                Y_acc[f] *= norm
+
+        rij_pred = 0.0
+
+        for f in range(num_factors):
+            rij_pred += X_j[f] * Y_acc[f]
+
+        err = data[idx] - rij_pred
+        loss[0] += err * err
+
+        for f in range(num_factors):
+            X_j_old[f] = X_j[f]
+            X_j[f] += lrate * (err * Y_acc[f] - reg * X_j_old[f])
+
+        for l_index in range(indptr[i], indptr[i+1]):
+            Y_l = Y + <long> col_indices[l_index] * num_factors
+
+            for f in range(num_factors):
+                Y_l[f] += lrate * (err * X_j_old[f] - reg * Y_l[f])
+
+
+
+@cython.boundscheck(False)
+def AsySVD_sgd_parallel(R, int num_factors=50, float lrate=0.01, float reg=0.015, int iters=10, init_mean=0.0,
+                        init_std=0.1, float lrate_decay=1.0, rnd_seed=42, int n_threads=1, row_indices=None):
+    """
+    AsySVD_sgd with float32 factors on n_threads.
+    The shuffled nonzeros are split in DSGD strata of users and target items, so the threads never update the same
+    item factor in X, while the item factors in Y of the user profiles, which span all items, are updated lock free.
+    :param row_indices: output of get_row_indices(R), if None it is computed
+    """
+
+    if not isinstance(R, sps.csr_matrix):
+        raise ValueError('R must be an instance of scipy.sparse.csr_matrix')
+
+    cdef int M = R.shape[0], N = R.shape[1]
+    cdef long nnz = R.nnz
+
+    if row_indices is None:
+        row_indices = get_row_indices(R)
+
+    cdef int [:] row_indices_view = np.asarray(row_indices, dtype=np.int32)
+    cdef int [:] col_indices = np.asarray(R.indices, dtype=np.int32)
+    cdef int [:] indptr = np.asarray(R.indptr, dtype=np.int32)
+    cdef float [:] data = np.asarray(R.data, dtype=np.float32)
+
+    # set the seed of the random number generator
+    np.random.seed(rnd_seed)
+
+    # randomly initialize the item latent factors
+    X_array = np.random.normal(init_mean, init_std, (N, num_factors)).astype(np.float32)
+    Y_array = np.random.normal(init_mean, init_std, (N, num_factors)).astype(np.float32)
+
+    cdef float[:,::1] X = X_array
+    cdef float[:,::1] Y = Y_array
+
+    # build random index to iterate over the non-zero elements in R, grouped by stratum
+    sample_order_array, stratum_indptr_array = get_strata(np.asarray(row_indices_view), np.asarray(col_indices),
+                                                          M, N, n_threads, np.random.permutation(nnz))
+
+    cdef int[:] sample_order = sample_order_array
+    cdef long[:] stratum_indptr = stratum_indptr_array
+    cdef double[:] thread_loss = np.zeros(n_threads, dtype=np.float64)
+
+    # Buffers of each thread
+    cdef float[:,::1] X_j_old = np.zeros((n_threads, num_factors), dtype=np.float32)
+    cdef float[:,::1] Y_acc = np.zeros((n_threads, num_factors), dtype=np.float32)
+
+    cdef int it, sub_epoch, thread_id, stratum
+    cdef double loss
+
+    for it in range(iters):
+
+        thread_loss[:] = 0.0
+
+        for sub_epoch in range(n_threads):
+            with nogil:
+                for thread_id in prange(n_threads, schedule='static', num_threads=n_threads):
+
+                    stratum = thread_id * n_threads + (thread_id + sub_epoch) % n_threads
+
+                    AsySVD_sgd_stratum(&sample_order[0], stratum_indptr[stratum], stratum_indptr[stratum + 1],
+                                       &row_indices_view[0], &col_indices[0], &indptr[0], &data[0],
+                                       &X[0,0], &Y[0,0], &X_j_old[thread_id, 0], &Y_acc[thread_id, 0],
+                                       num_factors, lrate, reg, &thread_loss[thread_id])
+
+        loss = np.sum(thread_loss) / nnz
+        print('Iter {} - loss: {:.4f}'.format(it+1, loss))
+        # update the learning rate
+        lrate *= lrate_decay
+
+    return X_array, Y_array
+
+
 from libc.math cimport exp, log
 
 @cython.boundscheck(False)
@@ -291,6 +570,122 @@ def BPRMF_sgd(R, num_factors=50, lrate=0.01, user_reg=0.015, pos_reg=0.015, neg_
 
     return X, Y
 
+cdef void BPRMF_sgd_stratum(int * sample_order, long start, long end, long * sample, float * X, float * Y,
+                            int num_factors, float lrate, float user_reg, float pos_reg, float neg_reg,
+                            double * loss) nogil:
+
+    cdef long n, idx
+    cdef int f
+    cdef double zijk, sig
+    cdef float deriv, X_if, Y_jf, Y_kf
+    cdef float * X_i
+    cdef float * Y_j
+    cdef float * Y_k
+
+    for n in range(start, end):
+
+        idx = sample_order[n]
+
+        X_i = X + sample[3*idx] * num_factors
+        Y_j = Y + sample[3*idx + 1] * num_factors
+        Y_k = Y + sample[3*idx + 2] * num_factors
+
+        # compute the difference of the predicted scores
+        zijk = 0.0
+
+        for f in range(num_factors):
+            zijk += X_i[f] * (Y_j[f] - Y_k[f])
+
+        sig = 1. / (1. + exp(-zijk))
+        loss[0] += log(sig)
+
+        deriv = 1. - sig
+
+        for f in range(num_factors):
+            X_if = X_i[f]
+            Y_jf = Y_j[f]
+            Y_kf = Y_k[f]
+            X_i[f] += lrate * (deriv * (Y_jf - Y_kf) - user_reg * X_if)
+            Y_j[f] += lrate * (deriv * X_if - pos_reg * Y_jf)
+            Y_k[f] += lrate * (-deriv * X_if - neg_reg * Y_kf)
+
+
+
+@cython.boundscheck(False)
+def BPRMF_sgd_parallel(R, int num_factors=50, float lrate=0.01, float user_reg=0.015, float pos_reg=0.015,
+                       float neg_reg=0.0015, int iters=10, sampling_type='user_uniform_item_uniform',
+                       sample_with_replacement=True, use_resampling=False, sampling_pop_alpha=1.0,
+                       init_mean=0.0, init_std=0.1, float lrate_decay=1.0, rnd_seed=42, verbose=False, int n_threads=1):
+    """
+    BPRMF_sgd with float32 factors on n_threads.
+    The sampled triples are split in DSGD strata of users and positive items, so the threads never update the same
+    user or positive item factor, while the negative item factors are updated lock free.
+    """
+
+    if not isinstance(R, sps.csr_matrix):
+        raise ValueError('R must be an instance of scipy.sparse.csr_matrix')
+
+    cdef int M = R.shape[0], N = R.shape[1]
+    cdef long nnz = R.nnz
+
+    # set the seed of the random number generator
+    np.random.seed(rnd_seed)
+    # randomly initialize the user and item latent factors
+    X_array = np.random.normal(init_mean, init_std, (M, num_factors)).astype(np.float32)
+    Y_array = np.random.normal(init_mean, init_std, (N, num_factors)).astype(np.float32)
+
+    cdef float[:,::1] X = X_array
+    cdef float[:,::1] Y = Y_array
+
+    cdef long[:,::1] sample
+    cdef int[:] sample_order
+    cdef long[:] stratum_indptr
+    cdef double[:] thread_loss = np.zeros(n_threads, dtype=np.float64)
+
+    cdef int it, sub_epoch, thread_id, stratum
+    cdef double loss
+
+    for it in range(iters):
+
+        if it == 0 or use_resampling:
+            # sample the training triples
+            if sampling_type == 'user_uniform_item_uniform':
+                sample_array = user_uniform_item_uniform_sampling(R, nnz, replace=sample_with_replacement, seed=rnd_seed, verbose=verbose)
+            elif sampling_type == 'user_uniform_item_pop':
+                sample_array = user_uniform_item_pop_sampling(R, nnz, alpha=sampling_pop_alpha, seed=rnd_seed, verbose=verbose)
+            else:
+                raise RuntimeError('Unknown sampling procedure "{}"'.format(sampling_type))
+
+            sample = np.ascontiguousarray(sample_array, dtype=np.int64)
+
+            # the triples are already in random order
+            sample_order_array, stratum_indptr_array = get_strata(sample_array[:,0], sample_array[:,1], M, N, n_threads,
+                                                                  np.arange(nnz))
+            sample_order = sample_order_array
+            stratum_indptr = stratum_indptr_array
+
+        thread_loss[:] = 0.0
+
+        for sub_epoch in range(n_threads):
+            with nogil:
+                for thread_id in prange(n_threads, schedule='static', num_threads=n_threads):
+
+                    stratum = thread_id * n_threads + (thread_id + sub_epoch) % n_threads
+
+                    BPRMF_sgd_stratum(&sample_order[0], stratum_indptr[stratum], stratum_indptr[stratum + 1],
+                                      &sample[0,0], &X[0,0], &Y[0,0], num_factors, lrate,
+                                      user_reg, pos_reg, neg_reg, &thread_loss[thread_id])
+
+        loss = np.sum(thread_loss) / nnz
+        if verbose:
+            print('Iter {} - loss: {:.4f}'.format(it+1, loss))
+        # update the learning rate
+        lrate *= lrate_decay
+
+    return X_array, Y_array
+
+
+
 def user_uniform_item_uniform_sampling(R, size, replace=True, seed=1234, verbose=True):
     # use Cython MemoryViews for fast access to the sparse structure of R
     cdef int [:] col_indices = R.indices, indptr = R.indptr
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 19/10/2026
+
+@author: Maurizio Ferrari Dacrema
+"""
+
+import time
+
+import numpy as np
+
+
+class MIPS_Index(object):
+    """
+    Approximate Maximum Inner Product Search index over the item factors, used to retrieve the topK items
+    of a user without scoring the whole catalogue.
+
+    Inner product search is reduced to nearest neighbour search by adding to each item factor h
+    the component sqrt(M^2 - ||h||^2), where M is the maximum norm, so that all items have norm M, and a 0 component
+    to the query. The ranking of the items by inner product is then the ranking by euclidean distance from the query.
+    The augmented items are clustered with k-means (inverted file index), a query scores exactly only the items
+    in the n_probe clusters closest to it. Higher n_probe gives higher recall at a higher cost.
+    """
+
+    def __init__(self, item_factors, n_clusters = None, n_probe = None, n_iterations = 10, random_seed = 42):
+
+        super(MIPS_Index, self).__init__()
+
+        # Kept by reference, used to score the candidates exactly
+        self.item_factors = item_factors
+
+        self.n_items, self.n_factors = item_factors.shape
+
+        if n_clusters is None:
+            n_clusters = int(np.sqrt(self.n_items))
+
+        self.n_clusters = max(1, min(n_clusters, self.n_items))
+
+        if n_probe is None:
+            n_probe = max(1, self.n_clusters // 10)
+
+        self.n_probe = n_probe
+
+        item_factors = np.asarray(item_factors)
+
+        item_norms_squared = np.sum(item_factors ** 2, axis=1)
+        max_norm_squared = item_norms_squared.max()
+
+        self.max_norm = np.sqrt(max_norm_squared)
+
+        items_augmented = np.hstack((item_factors,
+                                     np.sqrt(np.maximum(max_norm_squared - item_norms_squared, 0.0))[:, None]))
+
+        cluster_assignment = self._kmeans(items_augmented, n_iterations, random_seed)
+
+        # Items are stored grouped by cluster, so that the candidates of a cluster are contiguous
+        self.item_order = np.argsort(cluster_assignment, kind='stable').astype(np.int32)
+
+        self.cluster_indptr = np.zeros(self.n_clusters + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cluster_assignment, minlength=self.n_clusters), out=self.cluster_indptr[1:])
+
+
+
+    def _kmeans(self, items_augmented, n_iterations, random_seed):
+        """
+        Lloyd k-means on the augmented item factors
+        :return: cluster of each item
+        """
+
+        rng = np.random.RandomState(random_seed)
+
+        self.centroids = items_augmented[rng.choice(self.n_items, self.n_clusters, replace=False)].copy()
+
+        cluster_assignment = None
+
+        for n_iteration in range(n_iterations):
+
+            # argmin ||x - c||^2 = argmax x.c - ||c||^2 / 2
+            centroid_scores = items_augmented.dot(self.centroids.T) - 0.5 * np.sum(self.centroids ** 2, axis=1)
+            new_assignment = np.argmax(centroid_scores, axis=1)
+
+            if cluster_assignment is not None and np.array_equal(new_assignment, cluster_assignment):
+                break
+
+            cluster_assignment = new_assignment
+
+            cluster_size = np.bincount(cluster_assignment, minlength=self.n_clusters)
+
+            for dimension in range(items_augmented.shape[1]):
+                self.centroids[:, dimension] = np.bincount(cluster_assignment, weights=items_augmented[:, dimension],
+                                                           minlength=self.n_clusters)
+
+            non_empty = cluster_size > 0
+            self.centroids[non_empty] /= cluster_size[non_empty, None]
+
+            # Empty clusters are moved to a random item
+            n_empty = np.sum(~non_empty)
+
+            if n_empty > 0:
+                self.centroids[~non_empty] = items_augmented[rng.choice(self.n_items, n_empty, replace=False)]
+
+        return cluster_assignment.astype(np.int32)
+
+
+
+    def get_candidates(self, user_factors, n_candidates = 0, n_probe = None):
+        """
+        Collects the items of the clusters closest to the user, probing at least n_probe clusters
+        and as many more as needed to have at least n_candidates items
+        :param user_factors: factors of a single user
+        :return: array of candidate items
+        """
+
+        if n_probe is None:
+            n_probe = self.n_probe
+
+        user_factors = np.asarray(user_factors).ravel()
+        user_norm = np.sqrt(np.sum(user_factors ** 2))
+
+        if user_norm == 0.0:
+            return self.item_order
+
+        # The query is scaled to norm M, whose augmented component is 0,
+        # argmin ||q - c||^2 = argmax 2 q.c - ||c||^2
+        centroid_scores = 2 * self.max_norm / user_norm * self.centroids[:, :-1].dot(user_factors) - \
+                          np.sum(self.centroids ** 2, axis=1)
+
+        cluster_ranking = np.argsort(-centroid_scores)
+
+        cluster_size = np.diff(self.cluster_indptr)[cluster_ranking]
+
+        n_probe_needed = np.searchsorted(np.cumsum(cluster_size), min(n_candidates, self.n_items)) + 1
+        n_probe = min(max(n_probe, n_probe_needed), self.n_clusters)
+
+        return np.concatenate([self.item_order[self.cluster_indptr[cluster]:self.cluster_indptr[cluster + 1]]
+                               for cluster in cluster_ranking[:n_probe]])
+
+
+
+    def recommend(self, user_factors, n, excluded_items = None, n_probe = None):
+        """
+        Approximate topK, the candidates are scored exactly and the excluded items removed
+        :param excluded_items: items not to be recommended, e.g., the seen ones
+        :return: ranking of at most n items
+        """
+
+        if excluded_items is None:
+            excluded_items = np.array([], dtype=np.int32)
+
+        candidates = self.get_candidates(user_factors, n_candidates = n + len(excluded_items), n_probe = n_probe)
+
+        if len(excluded_items) > 0:
+            candidates = candidates[np.in1d(candidates, excluded_items, invert=True)]
+
+        scores = self.item_factors[candidates].dot(np.asarray(user_factors).ravel())
+
+        n = min(n, len(candidates))
+
+        if n == 0:
+            return candidates
+
+        relevant_items_partition = (-scores).argpartition(n - 1)[0:n]
+        relevant_items_partition_sorting = np.argsort(-scores[relevant_items_partition])
+
+        return candidates[relevant_items_partition[relevant_items_partition_sorting]]
+
+
+
+
+
+class MIPS_Recommender_Mixin(object):
+    """
+    Approximate recommendations of a matrix factorization model through a MIPS_Index.
+    The recommender must set self.MIPS_index = None whenever the factors change and implement
+    _get_MIPS_item_factors and _get_MIPS_user_factors
+    """
+
+    def _get_MIPS_item_factors(self):
+        raise NotImplementedError("MIPS_Recommender_Mixin: _get_MIPS_item_factors not implemented for the chosen recommender")
+
+    def _get_MIPS_user_factors(self, user_id):
+        raise NotImplementedError("MIPS_Recommender_Mixin: _get_MIPS_user_factors not implemented for the chosen recommender")
+
+
+
+    def build_MIPS_index(self, n_clusters = None, n_probe = None):
+        """
+        Builds the approximate topK index over the current item factors, used by recommend with approximate=True
+        :param n_clusters: number of clusters of items, default is the square root of the number of items
+        :param n_probe: number of clusters scored for each user, higher values give higher recall at a higher cost
+        """
+
+        self.MIPS_index = MIPS_Index(self._get_MIPS_item_factors(), n_clusters = n_clusters, n_probe = n_probe)
+
+
+
+    def _recommend_approximate(self, user_id, n, exclude_seen, filterTopPop, filterCustomItems):
+
+        if self.MIPS_index is None:
+            self.build_MIPS_index()
+
+        excluded_items = [np.array([], dtype=np.int32)]
+
+        if exclude_seen:
+            excluded_items.append(self.URM_train.indices[self.URM_train.indptr[user_id]:self.URM_train.indptr[user_id + 1]])
+
+        if filterTopPop:
+            excluded_items.append(self.filterTopPop_ItemsID)
+
+        if filterCustomItems:
+            excluded_items.append(self.filterCustomItems_ItemsID)
+
+        return self.MIPS_index.recommend(self._get_MIPS_user_factors(user_id), n, excluded_items = np.concatenate(excluded_items))
+
+
+
+    def _recommendBatch_approximate(self, users_in_batch, n, exclude_seen, filterTopPop, filterCustomItems):
+
+        n_items = self.URM_train.shape[1]
+
+        ranking = np.zeros((len(users_in_batch), n), dtype=int)
+
+        for row_index, user_id in enumerate(users_in_batch):
+
+            user_ranking = self._recommend_approximate(user_id, n, exclude_seen, filterTopPop, filterCustomItems)
+            ranking[row_index, :len(user_ranking)] = user_ranking
+
+            # Users with less than n items available are padded with the excluded items,
+            # which the exact ranking places at the bottom with -inf score
+            if len(user_ranking) < n:
+                excluded_items = np.flatnonzero(np.in1d(np.arange(n_items), user_ranking, invert=True))
+                ranking[row_index, len(user_ranking):] = excluded_items[:n - len(user_ranking)]
+
+        return ranking
+
+
+
+
+
+if __name__ == '__main__':
+
+    # Recall and speed of the approximate topK compared to exact scoring of all items
+
+    from data.Movielens_10m.Movielens10MReader import Movielens10MReader
+    from data.DataSplitter import DataSplitter_Warm
+    from MatrixFactorization.Cython.MF_BPR_Cython import MF_BPR_Cython
+
+    dataSplitter = DataSplitter_Warm(Movielens10MReader)
+    URM_train = dataSplitter.get_URM_train()
+
+    recommender = MF_BPR_Cython(URM_train)
+    recommender.fit(epochs=30, num_factors=50, batch_size=1)
+
+    output_file = open("results/MIPS_Index_recall_benchmark.txt", "a")
+
+    cutoff = 10
+    n_users_to_test = 5000
+
+    users_to_test = np.random.choice(URM_train.shape[0], min(n_users_to_test, URM_train.shape[0]), replace=False)
+
+    start_time = time.time()
+    exact_recommendations = [recommender.recommend(user_id, n=cutoff) for user_id in users_to_test]
+    exact_time = time.time() - start_time
+
+    recommender.build_MIPS_index()
+
+    for n_probe in [1, 2, 5, 10, 20, 50]:
+
+        recommender.MIPS_index.n_probe = n_probe
+
+        start_time = time.time()
+        approximate_recommendations = [recommender.recommend(user_id, n=cutoff, approximate=True) for user_id in users_to_test]
+        approximate_time = time.time() - start_time
+
+        recall = np.mean([len(np.intersect1d(exact, approximate)) / cutoff
+                          for exact, approximate in zip(exact_recommendations, approximate_recommendations)])
+
+        result_string = "MIPS_Index on {}: {} clusters, n_probe {}, recall@{} {:.4f}, " \
+                        "users per second approximate {:.0f}, exact {:.0f}\n".format(
+            Movielens10MReader.DATASET_SUBFOLDER[:-1], recommender.MIPS_index.n_clusters, n_probe, cutoff, recall,
+            len(users_to_test) / approximate_time, len(users_to_test) / exact_time)
+
+        print(result_string)
+        output_file.write(result_string)
+        output_file.flush()
+
+    output_file.close()
@@ -7,12 +7,17 @@ Created on 23/10/17
 """
 
 import logging
+import time
 
 import numpy as np
+import scipy.sparse as sps
+from multiprocessing.pool import ThreadPool
 from Base.Recommender_utils import check_matrix
 
 from Base.Recommender import Recommender
-from MatrixFactorization.Cython.MF_RMSE import FunkSVD_sgd, AsySVD_sgd, AsySVD_compute_user_factors, BPRMF_sgd
+from MatrixFactorization.MIPS_Index import MIPS_Recommender_Mixin
+from MatrixFactorization.Cython.MF_RMSE import FunkSVD_sgd_parallel, AsySVD_sgd_parallel, \
+    BPRMF_sgd_parallel, get_row_indices
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -22,7 +27,7 @@ logging.basicConfig(
 
 
 
-class FunkSVD(Recommender):
+class FunkSVD(MIPS_Recommender_Mixin, Recommender):
     '''
     FunkSVD model
     Reference: http://sifter.org/~simon/journal/20061211.html
@@ -43,6 +48,12 @@ class FunkSVD(Recommender):
 
         self.URM_train = check_matrix(URM_train, 'csr', dtype=np.float32)
 
+        # Row of each nonzero, computed on the first fit and reused by the following ones
+        self._row_indices = None
+
+        # Approximate topK index over the item factors, built on the first approximate recommendation
+        self.MIPS_index = None
+
 
 
     def __str__(self):
@@ -60,7 +71,8 @@ class FunkSVD(Recommender):
                  init_mean=0.0,
                  init_std=0.1,
                  lrate_decay=1.0,
-                 rnd_seed=42):
+                 rnd_seed=42,
+                 n_threads=1):
         """
 
         Initialize the model
@@ -72,6 +84,7 @@ class FunkSVD(Recommender):
         :param init_std: standard deviation used to initialize the latent factors
         :param lrate_decay: learning rate decay
         :param rnd_seed: random seed
+        :param n_threads: number of threads, each epoch is split in DSGD strata processed in parallel
         """
 
         self.num_factors = num_factors
@@ -83,9 +96,17 @@ class FunkSVD(Recommender):
         self.lrate_decay = lrate_decay
         self.rnd_seed = rnd_seed
 
-        self.U, self.V = FunkSVD_sgd(self.URM_train, self.num_factors, self.learning_rate, self.reg, self.epochs, self.init_mean,
-                                     self.init_std,
-                                     self.lrate_decay, self.rnd_seed)
+        self.n_threads = n_threads
+
+        if self._row_indices is None:
+            self._row_indices = get_row_indices(self.URM_train)
+
+        self.U, self.V = FunkSVD_sgd_parallel(self.URM_train, self.num_factors, self.learning_rate, self.reg, self.epochs, self.init_mean,
+                                              self.init_std,
+                                              self.lrate_decay, self.rnd_seed,
+                                              n_threads=self.n_threads, row_indices=self._row_indices)
+
+        self.MIPS_index = None
 
     # def recommend(self, user_id, n=None, exclude_seen=True):
     #     scores = np.dot(self.U[user_id], self.V.T)
@@ -113,7 +134,22 @@ class FunkSVD(Recommender):
 
 
 
-    def recommendBatch(self, users_in_batch, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+    def _get_MIPS_item_factors(self):
+        return self.V
+
+    def _get_MIPS_user_factors(self, user_id):
+        return self.U[user_id]
+
+
+
+    def recommendBatch(self, users_in_batch, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False,
+                       approximate = False):
+
+        if n is None:
+            n = self.URM_train.shape[1] - 1
+
+        if approximate:
+            return self._recommendBatch_approximate(users_in_batch, n, exclude_seen, filterTopPop, filterCustomItems)
 
         # compute the scores using the dot product
         user_profile_batch = self.URM_train[users_in_batch]
@@ -155,12 +191,19 @@ class FunkSVD(Recommender):
 
 
 
-    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False,
+                  approximate = False):
+        """
+        :param approximate: if True the topK is retrieved with the MIPS_Index, scoring only the candidate items
+        """
 
 
         if n==None:
             n=self.URM_train.shape[1]-1
 
+        if approximate:
+            return self._recommend_approximate(user_id, n, exclude_seen, filterTopPop, filterCustomItems)
+
         scores_array = np.dot(self.U[user_id], self.V.T)
 
         if self.normalize:
@@ -222,6 +265,8 @@ class FunkSVD(Recommender):
         for attrib_name in npzfile.files:
              self.__setattr__(attrib_name, npzfile[attrib_name])
 
+        self.MIPS_index = None
+
 
 
 class AsySVD(Recommender):
@@ -248,7 +293,8 @@ class AsySVD(Recommender):
                  init_mean=0.0,
                  init_std=0.1,
                  lrate_decay=1.0,
-                 rnd_seed=42):
+                 rnd_seed=42,
+                 n_threads=1):
         '''
         Initialize the model
         :param num_factors: number of latent factors
@@ -259,6 +305,7 @@ class AsySVD(Recommender):
         :param init_std: standard deviation used to initialize the latent factors
         :param lrate_decay: learning rate decay
         :param rnd_seed: random seed
+        :param n_threads: number of threads, each epoch is split in DSGD strata processed in parallel
         '''
         super(AsySVD, self).__init__()
         self.num_factors = num_factors
@@ -269,6 +316,7 @@ class AsySVD(Recommender):
         self.init_std = init_std
         self.lrate_decay = lrate_decay
         self.rnd_seed = rnd_seed
+        self.n_threads = n_threads
 
     def __str__(self):
         return "AsySVD(num_factors={}, lrate={}, reg={}, iters={}, init_mean={}, " \
@@ -278,17 +326,119 @@ class AsySVD(Recommender):
         )
 
     def fit(self, R):
-        self.dataset = R
         R = check_matrix(R, 'csr', dtype=np.float32)
-        self.X, self.Y = AsySVD_sgd(R, self.num_factors, self.lrate, self.reg, self.iters, self.init_mean,
-                                    self.init_std,
-                                    self.lrate_decay, self.rnd_seed)
+        self.dataset = R
+        self.URM_train = R
+        self.X, self.Y = AsySVD_sgd_parallel(R, self.num_factors, self.lrate, self.reg, self.iters, self.init_mean,
+                                             self.init_std,
+                                             self.lrate_decay, self.rnd_seed, n_threads=self.n_threads)
         # precompute the user factors
-        M = R.shape[0]
-        self.U = np.vstack([AsySVD_compute_user_factors(R[i], self.Y) for i in range(M)])
+        self.U = self.compute_user_factors(R)
 
-    def recommend(self, user_id, n=None, exclude_seen=True):
-        scores = np.dot(self.X, self.U[user_id].T)
+        # Users whose factors are up to date with their profile in dataset
+        self._user_factors_valid = np.ones(R.shape[0], dtype=bool)
+
+
+    def compute_user_factors(self, user_profiles):
+        """
+        Batched folding-in, equivalent to AsySVD_compute_user_factors on each row:
+        the factors of a user are the sum of the Y of the rated items, weighted by the rating and divided by
+        the square root of the number of ratings, computed for all users with a single sparse x dense product
+        :param user_profiles: csr users x items, can contain new users
+        :return: users x num_factors
+        """
+
+        user_profiles = check_matrix(user_profiles, 'csr', dtype=np.float32)
+
+        n_rated = np.diff(user_profiles.indptr)
+
+        row_norm = np.zeros(user_profiles.shape[0], dtype=np.float32)
+        row_norm[n_rated > 0] = 1.0 / np.sqrt(n_rated[n_rated > 0])
+
+        return np.asarray(sps.diags(row_norm).dot(user_profiles).dot(self.Y), dtype=np.float32)
+
+
+    def update_user_profiles(self, user_ids, user_profiles):
+        """
+        Replaces the profiles of the given users, user ids beyond the current ones add new users.
+        Their cached factors are invalidated and folded-in again, in a single batch, on their next recommendation
+        :param user_ids: array of user ids
+        :param user_profiles: csr with the new profile of each user in user_ids
+        """
+
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        user_profiles = check_matrix(user_profiles, 'csr', dtype=np.float32)
+
+        n_users_old = self.dataset.shape[0]
+        n_users = max(n_users_old, user_ids.max() + 1)
+
+        # Rows of the stacked old and new profiles that compose the updated dataset
+        row_source = np.arange(n_users)
+        row_source[n_users_old:] = n_users_old + len(user_ids)
+        row_source[user_ids] = n_users_old + np.arange(len(user_ids))
+
+        empty_row = sps.csr_matrix((1, self.dataset.shape[1]), dtype=np.float32)
+
+        self.dataset = sps.vstack([self.dataset, user_profiles, empty_row], format='csr')[row_source]
+        self.URM_train = self.dataset
+
+        if n_users > n_users_old:
+            self.U = np.vstack([self.U, np.zeros((n_users - n_users_old, self.U.shape[1]), dtype=np.float32)])
+            self._user_factors_valid = np.concatenate([self._user_factors_valid,
+                                                       np.zeros(n_users - n_users_old, dtype=bool)])
+
+        self._user_factors_valid[user_ids] = False
+
+
+    def get_user_factors(self, user_ids):
+        """
+        Returns the cached factors of the users, folding-in in a single batch those whose profile changed
+        """
+
+        user_ids = np.atleast_1d(user_ids)
+        users_to_update = np.unique(user_ids[~self._user_factors_valid[user_ids]])
+
+        if len(users_to_update) > 0:
+            self.U[users_to_update] = self.compute_user_factors(self.dataset[users_to_update])
+            self._user_factors_valid[users_to_update] = True
+
+        return self.U[user_ids]
+
+
+    def recommendBatch(self, users_in_batch, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+
+        if n is None:
+            n = self.dataset.shape[1] - 1
+
+        scores_array = np.dot(self.get_user_factors(users_in_batch), self.X.T)
+
+        if exclude_seen:
+            scores_array[self.dataset[users_in_batch].nonzero()] = -np.inf
+
+        if filterTopPop:
+            scores_array[:,self.filterTopPop_ItemsID] = -np.inf
+
+        if filterCustomItems:
+            scores_array[:, self.filterCustomItems_ItemsID] = -np.inf
+
+        ranking = np.zeros((scores_array.shape[0],n), dtype=int)
+
+        for row_index in range(scores_array.shape[0]):
+            scores = scores_array[row_index]
+
+            relevant_items_partition = (-scores).argpartition(n)[0:n]
+            relevant_items_partition_sorting = np.argsort(-scores[relevant_items_partition])
+            ranking[row_index] = relevant_items_partition[relevant_items_partition_sorting]
+
+        return ranking
+
+
+    def recommend(self, user_id, n=None, exclude_seen=True, filterTopPop = False, filterCustomItems = False):
+        scores = np.dot(self.X, self.get_user_factors(user_id)[0])
+        if filterTopPop:
+            scores = self._filter_TopPop_on_scores(scores)
+        if filterCustomItems:
+            scores = self._filterCustomItems_on_scores(scores)
         ranking = scores.argsort()[::-1]
         # rank items
         if exclude_seen:
@@ -335,7 +485,11 @@ class IALS_numpy(Recommender):
                  epsilon=1.0,
                  init_mean=0.0,
                  init_std=0.1,
-                 rnd_seed=42):
+                 rnd_seed=42,
+                 solver='solve',
+                 cg_steps=3,
+                 n_threads=1,
+                 max_block_memory_MB=20):
         '''
         Initialize the model
         :param num_factors: number of latent factors
@@ -347,10 +501,17 @@ class IALS_numpy(Recommender):
         :param init_mean: mean used to initialize the latent factors
         :param init_std: standard deviation used to initialize the latent factors
         :param rnd_seed: random seed
+        :param solver: 'solve' solves exactly each block of rows with a stacked np.linalg.solve,
+                    'cg' updates the current factors with cg_steps of conjugate gradient without building the
+                    factors x factors system, 'loop' solves one row at a time
+        :param cg_steps: number of conjugate gradient steps of each row, used only if solver is 'cg'
+        :param n_threads: number of blocks of rows solved in parallel
+        :param max_block_memory_MB: memory budget of each block of rows
         '''
 
         super(IALS_numpy, self).__init__()
         assert scaling in ['linear', 'log'], 'Unsupported scaling: {}'.format(scaling)
+        assert solver in ['solve', 'cg', 'loop'], 'Unsupported solver: {}'.format(solver)
 
         self.num_factors = num_factors
         self.reg = reg
@@ -361,6 +522,10 @@ class IALS_numpy(Recommender):
         self.init_mean = init_mean
         self.init_std = init_std
         self.rnd_seed = rnd_seed
+        self.solver = solver
+        self.cg_steps = cg_steps
+        self.n_threads = n_threads
+        self.max_block_memory_MB = max_block_memory_MB
 
     def __str__(self):
         return "WRMF-iALS(num_factors={},  reg={}, iters={}, scaling={}, alpha={}, episilon={}, init_mean={}, " \
@@ -398,9 +563,14 @@ class IALS_numpy(Recommender):
         self.X = np.random.normal(self.init_mean, self.init_std, size=(M, self.num_factors))
         self.Y = np.random.normal(self.init_mean, self.init_std, size=(N, self.num_factors))
 
+        if self.solver == 'loop':
+            lsq_solver = self._lsq_solver_fast
+        else:
+            lsq_solver = self._lsq_solver_blocked
+
         for it in range(self.iters):
-            self.X = self._lsq_solver_fast(C, self.X, self.Y, self.reg)
-            self.Y = self._lsq_solver_fast(Ct, self.Y, self.X, self.reg)
+            self.X = lsq_solver(C, self.X, self.Y, self.reg)
+            self.Y = lsq_solver(Ct, self.Y, self.X, self.reg)
             logger.debug('Finished iter {}'.format(it + 1))
 
     def recommend(self, user_id, n=None, exclude_seen=True):
@@ -454,6 +624,146 @@ class IALS_numpy(Recommender):
             X[i] = np.linalg.solve(A, b)
         return X
 
+    def _get_row_blocks(self, C, factors):
+        """
+        Groups the rows in blocks of similar profile length, so that each block can be padded to its longest profile
+        with little waste. The size of each block is chosen so that its padded factors fit in max_block_memory_MB
+        :return: list of arrays of row indices
+        """
+
+        profile_length = np.ediff1d(C.indptr)
+        rows_by_length = np.argsort(profile_length, kind='stable')
+        sorted_length = profile_length[rows_by_length]
+
+        # Padded factors and their weighted copy, each row also has its own factors x factors system
+        max_block_cells = self.max_block_memory_MB * 1e6 / (8 * 2 * factors)
+
+        block_list = []
+        block_start = 0
+
+        while block_start < len(rows_by_length):
+
+            # Rows are sorted by length, so the padded size of a block grows with its last row
+            # Binary search for the largest block within the budget, at least one row
+            low, high = block_start + 1, len(rows_by_length)
+
+            while low < high:
+                middle = (low + high + 1) // 2
+
+                if (middle - block_start) * (sorted_length[middle - 1] + factors) <= max_block_cells:
+                    low = middle
+                else:
+                    high = middle - 1
+
+            block_list.append(rows_by_length[block_start:low])
+            block_start = low
+
+        return block_list
+
+
+    def _solve_block(self, C, X, Y, YtY_reg, block_rows):
+        """
+        Solves the rows in block_rows, whose profiles are padded with zero confidence to the longest one.
+        Yt(Ci-I)Y is accumulated with a stacked matrix product, without building the diagonal matrix of the confidence
+        """
+
+        factors = X.shape[1]
+
+        profile_length = C.indptr[block_rows + 1] - C.indptr[block_rows]
+        max_length = profile_length.max()
+
+        if max_length == 0:
+            X[block_rows] = 0.0
+            return
+
+        # Position in the padded block of every nonzero of the rows
+        n_cells = profile_length.sum()
+        row_pos = np.repeat(np.arange(len(block_rows)), profile_length)
+        col_pos = np.arange(n_cells) - np.repeat(np.cumsum(profile_length) - profile_length, profile_length)
+        data_pos = np.repeat(C.indptr[block_rows], profile_length) + col_pos
+
+        Yj = np.zeros((len(block_rows), max_length, factors))
+        Yj[row_pos, col_pos] = Y[C.indices[data_pos]]
+
+        ci = np.zeros((len(block_rows), max_length))
+        ci[row_pos, col_pos] = C.data[data_pos]
+
+        # Padded cells have zero confidence and do not contribute
+        ci_minus_one = ci.copy()
+        ci_minus_one[row_pos, col_pos] -= 1.0
+
+        # compute YtCi
+        b = np.matmul(ci[:, None, :], Yj)[:, 0, :]
+
+        if self.solver == 'solve':
+
+            # compute Yt(Ci-I)Y + YtY + reg*I
+            A = np.matmul(Yj.transpose(0, 2, 1), Yj * ci_minus_one[:, :, None])
+            A += YtY_reg
+
+            X[block_rows] = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+
+        else:
+
+            # Conjugate gradient from the current factors, A*p is computed as (YtY + reg*I)p + Yt(Ci-I)(Y p)
+            def A_dot(p):
+                return p.dot(YtY_reg) + np.matmul((np.matmul(Yj, p[:, :, None])[:, :, 0] * ci_minus_one)[:, None, :], Yj)[:, 0, :]
+
+            x = X[block_rows]
+            r = b - A_dot(x)
+            p = r.copy()
+            rs_old = (r * r).sum(axis=1)
+
+            for _ in range(self.cg_steps):
+
+                Ap = A_dot(p)
+                pAp = (p * Ap).sum(axis=1)
+
+                # Rows that have already converged are not updated
+                step = np.divide(rs_old, pAp, out=np.zeros_like(rs_old), where=pAp > 1e-10)
+
+                x += step[:, None] * p
+                r -= step[:, None] * Ap
+
+                rs_new = (r * r).sum(axis=1)
+                beta = np.divide(rs_new, rs_old, out=np.zeros_like(rs_new), where=rs_old > 1e-10)
+
+                p = r + beta[:, None] * p
+                rs_old = rs_new
+
+            X[block_rows] = x
+
+
+    def _lsq_solver_blocked(self, C, X, Y, reg):
+        """
+        Same least squares problem of _lsq_solver_fast, rows are solved in blocks and blocks are distributed over
+        n_threads, as numpy releases the GIL during the matrix products and the solve
+        """
+
+        rows, factors = X.shape
+
+        # precompute YtY + reg*I
+        YtY_reg = np.dot(Y.T, Y) + reg * np.eye(factors)
+
+        X = np.array(X, dtype=np.float64)
+
+        block_list = self._get_row_blocks(C, factors)
+
+        def _solve_block_rows(block_rows):
+            self._solve_block(C, X, Y, YtY_reg, block_rows)
+
+        if self.n_threads > 1:
+            pool = ThreadPool(processes=self.n_threads)
+            pool.map(_solve_block_rows, block_list)
+            pool.close()
+            pool.join()
+        else:
+            for block_rows in block_list:
+                _solve_block_rows(block_rows)
+
+        return X
+
+
     def _nonzeros(self, R, row):
         for i in range(R.indptr[row], R.indptr[row + 1]):
             yield (R.indices[i], R.data[i])
@@ -495,7 +805,8 @@ class BPRMF(Recommender):
                  init_std=0.1,
                  lrate_decay=1.0,
                  rnd_seed=42,
-                 verbose=True):
+                 verbose=True,
+                 n_threads=1):
         '''
         Initialize the model
         :param num_factors: number of latent factors
@@ -513,6 +824,7 @@ class BPRMF(Recommender):
         :param lrate_decay: learning rate decay
         :param rnd_seed: random seed
         :param verbose: controls verbosity in output
+        :param n_threads: number of threads, each epoch is split in DSGD strata processed in parallel
         '''
         super(BPRMF, self).__init__()
         self.num_factors = num_factors
@@ -530,6 +842,7 @@ class BPRMF(Recommender):
         self.lrate_decay = lrate_decay
         self.rnd_seed = rnd_seed
         self.verbose = verbose
+        self.n_threads = n_threads
 
     def __str__(self):
         return "BPRMF(num_factors={}, lrate={}, user_reg={}. pos_reg={}, neg_reg={}, iters={}, " \
@@ -547,22 +860,23 @@ class BPRMF(Recommender):
     def fit(self, R):
         self.dataset = R
         R = check_matrix(R, 'csr', dtype=np.float32)
-        self.X, self.Y = BPRMF_sgd(R,
-                                   num_factors=self.num_factors,
-                                   lrate=self.lrate,
-                                   user_reg=self.user_reg,
-                                   pos_reg=self.pos_reg,
-                                   neg_reg=self.neg_reg,
-                                   iters=self.iters,
-                                   sampling_type=self.sampling_type,
-                                   sample_with_replacement=self.sample_with_replacement,
-                                   use_resampling=self.use_resampling,
-                                   sampling_pop_alpha=self.sampling_pop_alpha,
-                                   init_mean=self.init_mean,
-                                   init_std=self.init_std,
-                                   lrate_decay=self.lrate_decay,
-                                   rnd_seed=self.rnd_seed,
-                                   verbose=self.verbose)
+        self.X, self.Y = BPRMF_sgd_parallel(R,
+                                            num_factors=self.num_factors,
+                                            lrate=self.lrate,
+                                            user_reg=self.user_reg,
+                                            pos_reg=self.pos_reg,
+                                            neg_reg=self.neg_reg,
+                                            iters=self.iters,
+                                            sampling_type=self.sampling_type,
+                                            sample_with_replacement=self.sample_with_replacement,
+                                            use_resampling=self.use_resampling,
+                                            sampling_pop_alpha=self.sampling_pop_alpha,
+                                            init_mean=self.init_mean,
+                                            init_std=self.init_std,
+                                            lrate_decay=self.lrate_decay,
+                                            rnd_seed=self.rnd_seed,
+                                            verbose=self.verbose,
+                                            n_threads=self.n_threads)
 
     def recommend(self, user_id, n=None, exclude_seen=True):
         scores = np.dot(self.X[user_id], self.Y.T)
@@ -587,3 +901,37 @@ class BPRMF(Recommender):
         unseen_mask = np.in1d(ranking, seen, assume_unique=True, invert=True)
         return ranking[unseen_mask]
 
+
+
+
+if __name__ == '__main__':
+
+    # Fit-time benchmark of the IALS solvers
+
+    from data.Movielens_10m.Movielens10MReader import Movielens10MReader
+    from data.DataSplitter import DataSplitter_Warm
+
+    import multiprocessing
+
+    dataSplitter = DataSplitter_Warm(Movielens10MReader)
+    URM_train = dataSplitter.get_URM_train()
+
+    output_file = open("results/IALS_fit_time_benchmark.txt", "a")
+
+    for solver, n_threads in [('loop', 1), ('solve', 1), ('solve', multiprocessing.cpu_count()),
+                              ('cg', 1), ('cg', multiprocessing.cpu_count())]:
+
+        recommender = IALS_numpy(num_factors=50, iters=5, solver=solver, n_threads=n_threads)
+
+        start_time = time.time()
+        recommender.fit(URM_train)
+        fit_time = time.time() - start_time
+
+        result_string = "IALS solver '{}' on {}: {} threads, fit time {:.2f} sec\n".format(
+            solver, Movielens10MReader.DATASET_SUBFOLDER[:-1], n_threads, fit_time)
+
+        print(result_string)
+        output_file.write(result_string)
+        output_file.flush()
+
+    output_file.close()
@@ -170,6 +170,7 @@ class GridSearch(AbstractClassSearch):
 if __name__ == '__main__':
 
     from MatrixFactorization.Cython.MF_BPR_Cython import MF_BPR_Cython
+    import multiprocessing
     from data.NetflixEnhanced.NetflixEnhancedReader import NetflixEnhancedReader
 
     dataReader = NetflixEnhancedReader()
@@ -193,7 +194,8 @@ if __name__ == '__main__':
     recommenderDictionary = {DictionaryKeys.CONSTRUCTOR_POSITIONAL_ARGS: [URM_train],
                              DictionaryKeys.CONSTRUCTOR_KEYWORD_ARGS: dict(),
                              DictionaryKeys.FIT_POSITIONAL_ARGS: dict(),
-                             DictionaryKeys.FIT_KEYWORD_ARGS: dict(),
+                             DictionaryKeys.FIT_KEYWORD_ARGS: {"n_threads": multiprocessing.cpu_count(),
+                                                               "factors_precision": "float32"},
                              DictionaryKeys.FIT_RANGE_KEYWORD_ARGS: hyperparamethers_range_dictionary}
 
     best_paramethers = gridSearch.search(recommenderDictionary, logFile = logFile)
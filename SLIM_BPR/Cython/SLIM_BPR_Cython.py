@@ -33,7 +33,8 @@ class SLIM_BPR_Cython(Similarity_Matrix_Recommender, Recommender):
 
     def __init__(self, URM_train, positive_threshold=4, URM_validation = None,
                  recompile_cython = False, final_model_sparse_weights = True, train_with_sparse_weights = False,
-                 symmetric = True):
+                 symmetric = True, sparse_weights_structure = "tree",
+                 weights_precision = "float64", max_memory_gb = None):
 
 
         super(SLIM_BPR_Cython, self).__init__()
@@ -57,6 +58,10 @@ class SLIM_BPR_Cython(Similarity_Matrix_Recommender, Recommender):
         if self.train_with_sparse_weights:
             self.sparse_weights = True
 
+        # Data structure used for the similarity when train_with_sparse_weights is True
+        # "tree" is a per-row binary tree, "hash" a per-row open addressing hash table with float32 values
+        self.sparse_weights_structure = sparse_weights_structure
+
 
         self.URM_mask = self.URM_train.copy()
 
@@ -65,15 +70,39 @@ class SLIM_BPR_Cython(Similarity_Matrix_Recommender, Recommender):
 
         self.symmetric = symmetric
 
+        # Precision of the dense or symmetric similarity, float16 values are updated with float32 accumulation
+        if weights_precision not in ["float64", "float32", "float16"]:
+            raise ValueError("weights_precision not valid. Acceptable values are: 'float64', 'float32', 'float16'. Provided value was '{}'".format(
+                weights_precision))
+
+        self.weights_precision = weights_precision
+
+        # True if the sparse weights are used because the similarity does not fit in max_memory_gb
+        self.max_memory_gb_exceeded = False
+
         if not self.train_with_sparse_weights:
 
             n_items = URM_train.shape[1]
-            requiredGB = 8 * n_items**2 / 1e+06
 
             if symmetric:
-                requiredGB /=2
+                n_cells = n_items * (n_items + 1) / 2
+            else:
+                n_cells = n_items ** 2
+
+            requiredGB = np.dtype(self.weights_precision).itemsize * n_cells / 1e+09
 
-            print("SLIM_BPR_Cython: Estimated memory required for similarity matrix of {} items is {:.2f} MB".format(n_items, requiredGB))
+            print("SLIM_BPR_Cython: Estimated memory required for similarity matrix of {} items is {:.2f} MB".format(n_items, requiredGB * 1e+03))
+
+            # Every sample may update any row of the similarity, which must therefore be entirely in memory.
+            # If it does not fit in the budget, only the cells actually updated are stored in the sparse structure
+            if max_memory_gb is not None and requiredGB > max_memory_gb:
+
+                print("SLIM_BPR_Cython: Estimated memory exceeds max_memory_gb of {:.2f} GB, training with sparse weights".format(
+                    max_memory_gb))
+
+                self.train_with_sparse_weights = True
+                self.sparse_weights = True
+                self.max_memory_gb_exceeded = True
 
 
 
@@ -88,10 +117,10 @@ class SLIM_BPR_Cython(Similarity_Matrix_Recommender, Recommender):
 
 
     def fit(self, epochs=300, logFile=None, URM_test=None, filterTopPop = False, minRatingsPerUser=1,
-            batch_size = 1000, lambda_i = 0.0, lambda_j = 0.0, learning_rate = 1e-4, topK = 200,
+            batch_size = 1, lambda_i = 0.0, lambda_j = 0.0, learning_rate = 1e-4, topK = 200,
             sgd_mode='adagrad', gamma=0.995, beta_1=0.9, beta_2=0.999,
             stop_on_validation = False, lower_validatons_allowed = 5, validation_metric = "map",
-            validation_function = None, validation_every_n = 1):
+            validation_function = None, validation_every_n = 1, n_threads = 1):
 
 
         # Import compiled module
@@ -106,6 +135,18 @@ class SLIM_BPR_Cython(Similarity_Matrix_Recommender, Recommender):
         self.sgd_mode = sgd_mode
         self.epochs = epochs
 
+        # With n_threads > 1 each epoch runs lock-free (Hogwild) on the dense or symmetric similarity
+        # With batch_size > 1 the x_uij of each mini-batch are computed on the same similarity, using n_threads,
+        # and the updates of all its samples are then applied
+        self.n_threads = n_threads
+
+        # The sparse weights chosen because of max_memory_gb can not be updated concurrently
+        if self.n_threads > 1 and self.max_memory_gb_exceeded:
+            print("SLIM_BPR_Cython: Training with sparse weights because of max_memory_gb, "
+                  "multi-threaded training is not available, using n_threads = 1 instead of {}".format(self.n_threads))
+
+            self.n_threads = 1
+
 
         self.cythonEpoch = SLIM_BPR_Cython_Epoch(self.URM_mask,
                                                  train_with_sparse_weights = self.train_with_sparse_weights,
@@ -114,12 +155,15 @@ class SLIM_BPR_Cython(Similarity_Matrix_Recommender, Recommender):
                                                  learning_rate=learning_rate,
                                                  li_reg = lambda_i,
                                                  lj_reg = lambda_j,
-                                                 batch_size=1,
+                                                 batch_size=batch_size,
                                                  symmetric = self.symmetric,
                                                  sgd_mode = sgd_mode,
                                                  gamma=gamma,
                                                  beta_1=beta_1,
-                                                 beta_2=beta_2)
+                                                 beta_2=beta_2,
+                                                 sparse_weights_structure = self.sparse_weights_structure,
+                                                 n_threads = self.n_threads,
+                                                 weights_precision = self.weights_precision)
 
 
 
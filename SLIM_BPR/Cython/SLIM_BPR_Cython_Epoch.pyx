@@ -18,11 +18,17 @@ Created on 07/09/17
 from Base.Recommender_utils import similarityMatrixTopK, check_matrix
 import numpy as np
 cimport numpy as np
+cimport cython
 import time
 import sys
 
-from libc.math cimport exp, sqrt
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+from libc.math cimport exp, sqrt, pow
 from libc.stdlib cimport rand, RAND_MAX
+from libc.string cimport memcpy
+
+from cython.parallel import prange
 
 
 cdef struct BPR_sample:
@@ -34,6 +40,140 @@ cdef struct BPR_sample:
 
 
 
+cdef inline np.uint64_t xorshift_rand(np.uint64_t * rng_state) nogil:
+    """
+    Xorshift64 random generator, each thread has its own state, which must not be 0
+    """
+
+    rng_state[0] ^= rng_state[0] << 13
+    rng_state[0] ^= rng_state[0] >> 7
+    rng_state[0] ^= rng_state[0] << 17
+
+    return rng_state[0]
+
+
+
+# Bytes required by each cell of the dense or symmetric S for the available precisions
+WEIGHTS_PRECISION_BYTES = {"float64": 8, "float32": 4, "float16": 2}
+
+
+cdef inline float half_to_float(np.uint16_t half) nogil:
+    """
+    Converts an IEEE 754 half precision value, given as its bits, to float
+    """
+
+    cdef np.uint32_t sign = (<np.uint32_t> (half & 0x8000)) << 16
+    cdef np.uint32_t exponent = (half >> 10) & 0x1f
+    cdef np.uint32_t mantissa = half & 0x3ff
+    cdef np.uint32_t bits
+    cdef float value
+
+    if exponent == 0:
+
+        if mantissa == 0:
+            bits = sign
+
+        else:
+            # Subnormal half, normalize it
+            exponent = 127 - 15 + 1
+
+            while (mantissa & 0x400) == 0:
+                mantissa <<= 1
+                exponent -= 1
+
+            bits = sign | (exponent << 23) | ((mantissa & 0x3ff) << 13)
+
+    elif exponent == 0x1f:
+        # Inf or NaN
+        bits = sign | 0x7f800000 | (mantissa << 13)
+
+    else:
+        bits = sign | ((exponent + 127 - 15) << 23) | (mantissa << 13)
+
+    memcpy(&value, &bits, sizeof(float))
+
+    return value
+
+
+
+cdef inline np.uint16_t float_to_half(float value) nogil:
+    """
+    Converts a float to the bits of the nearest IEEE 754 half precision value, ties are rounded to even
+    """
+
+    cdef np.uint32_t bits, sign, mantissa, remainder, halfway
+    cdef np.int32_t exponent
+    cdef np.uint32_t half
+
+    memcpy(&bits, &value, sizeof(float))
+
+    sign = (bits >> 16) & 0x8000
+    exponent = <np.int32_t> ((bits >> 23) & 0xff) - 127 + 15
+    mantissa = bits & 0x7fffff
+
+    # Inf or NaN
+    if ((bits >> 23) & 0xff) == 0xff:
+        return sign | 0x7c00 | (0x200 if mantissa != 0 else 0)
+
+    # Overflow
+    if exponent >= 0x1f:
+        return sign | 0x7c00
+
+    if exponent <= 0:
+
+        # Underflow
+        if exponent < -10:
+            return sign
+
+        # Subnormal half, add the implicit bit and shift
+        mantissa |= 0x800000
+        half = mantissa >> (14 - exponent)
+        remainder = mantissa & ((1 << (14 - exponent)) - 1)
+        halfway = 1 << (13 - exponent)
+
+    else:
+        half = (exponent << 10) | (mantissa >> 13)
+        remainder = mantissa & 0x1fff
+        halfway = 0x1000
+
+    # A carry of the rounding correctly moves to the next exponent
+    if remainder > halfway or (remainder == halfway and (half & 1)):
+        half += 1
+
+    return sign | half
+
+
+
+cdef inline void heap_sift_down(double * heap_data, int * heap_indices, long heap_size, long position) nogil:
+    """
+    Moves the element in the given position down the min-heap until both its children are greater or equal
+    """
+
+    cdef long child
+    cdef double data = heap_data[position]
+    cdef int index = heap_indices[position]
+
+    while 2*position + 1 < heap_size:
+
+        child = 2*position + 1
+
+        if child + 1 < heap_size and heap_data[child + 1] < heap_data[child]:
+            child += 1
+
+        if heap_data[child] >= data:
+            break
+
+        heap_data[position] = heap_data[child]
+        heap_indices[position] = heap_indices[child]
+        position = child
+
+    heap_data[position] = data
+    heap_indices[position] = index
+
+
+
+# Final allows the cdef methods used in the inner loops to be inlined
+@cython.final
 cdef class SLIM_BPR_Cython_Epoch:
 
     cdef int n_users
@@ -49,9 +189,18 @@ cdef class SLIM_BPR_Cython_Epoch:
 
     cdef int[:] URM_mask_indices, URM_mask_indptr
 
+    cdef int use_hash_sparse_weights
     cdef Sparse_Matrix_Tree_CSR S_sparse
-    cdef Triangular_Matrix S_symmetric
-    cdef double[:,:] S_dense
+    cdef Sparse_Matrix_Hash_CSR S_sparse_hash
+    # Dense or symmetric S, stored as a flat array with the selected precision.
+    # The symmetric S only stores its lower triangular, row by row.
+    # Half precision values are kept as their bits, computations are done in double
+    cdef int weights_precision_bits
+    cdef double[:] S_flat_float64
+    cdef float[:] S_flat_float32
+    cdef np.uint16_t[:] S_flat_float16
+
+    cdef int n_threads
 
 
     # Adaptive gradient
@@ -65,6 +214,13 @@ cdef class SLIM_BPR_Cython_Epoch:
     cdef double beta_1, beta_2, beta_1_power_t, beta_2_power_t
     cdef double momentum_1, momentum_2
 
+    # Adaptive gradient state of each thread, initialized from the shared one at the beginning of each epoch
+    # and merged back into it at the end
+    cdef double [:,:] sgd_cache_I_thread
+    cdef double [:,:] sgd_cache_I_momentum_1_thread, sgd_cache_I_momentum_2_thread
+    cdef double [:] beta_1_power_t_thread, beta_2_power_t_thread
+    cdef double [:] loss_thread
+
 
 
     def __init__(self, URM_mask,
@@ -72,7 +228,8 @@ cdef class SLIM_BPR_Cython_Epoch:
                  final_model_sparse_weights = True,
                  learning_rate = 0.01, li_reg = 0.0, lj_reg = 0.0,
                  batch_size = 1, topK = 150, symmetric = True,
-                 sgd_mode='adam', gamma=0.995, beta_1=0.9, beta_2=0.999):
+                 sgd_mode='adam', gamma=0.995, beta_1=0.9, beta_2=0.999,
+                 sparse_weights_structure = "tree", n_threads = 1, weights_precision = "float64"):
 
         super(SLIM_BPR_Cython_Epoch, self).__init__()
 
@@ -99,13 +256,52 @@ cdef class SLIM_BPR_Cython_Epoch:
         self.URM_mask_indptr = np.array(URM_mask.indptr, dtype=np.int32)
 
 
+        if sparse_weights_structure not in ["tree", "hash"]:
+            raise ValueError(
+                "sparse_weights_structure not valid. Acceptable values are: 'tree', 'hash'. Provided value was '{}'".format(
+                    sparse_weights_structure))
+
+        self.use_hash_sparse_weights = sparse_weights_structure == "hash"
+
+
         if self.train_with_sparse_weights:
-            self.S_sparse = Sparse_Matrix_Tree_CSR(self.n_items, self.n_items)
 
-        elif self.symmetric:
-            self.S_symmetric = Triangular_Matrix(self.n_items, isSymmetric = True)
+            if self.use_hash_sparse_weights:
+                self.S_sparse_hash = Sparse_Matrix_Hash_CSR(self.n_items, self.n_items)
+            else:
+                self.S_sparse = Sparse_Matrix_Tree_CSR(self.n_items, self.n_items)
+
         else:
-            self.S_dense = np.zeros((self.n_items, self.n_items), dtype=np.float64)
+
+            if weights_precision not in WEIGHTS_PRECISION_BYTES:
+                raise ValueError(
+                    "weights_precision not valid. Acceptable values are: {}. Provided value was '{}'".format(
+                        list(WEIGHTS_PRECISION_BYTES.keys()), weights_precision))
+
+            if self.symmetric:
+                n_cells = self.n_items * (self.n_items + 1) // 2
+            else:
+                n_cells = self.n_items ** 2
+
+            self.weights_precision_bits = WEIGHTS_PRECISION_BYTES[weights_precision] * 8
+
+            if weights_precision == "float64":
+                self.S_flat_float64 = np.zeros(n_cells, dtype=np.float64)
+            elif weights_precision == "float32":
+                self.S_flat_float32 = np.zeros(n_cells, dtype=np.float32)
+            else:
+                self.S_flat_float16 = np.zeros(n_cells, dtype=np.float16).view(np.uint16)
+
+
+        if n_threads < 1:
+            raise ValueError("n_threads not valid. Must be a positive integer, provided value was '{}'".format(n_threads))
+
+        # The sparse structures allocate memory when a new cell is added, they can not be updated concurrently
+        if n_threads > 1 and self.train_with_sparse_weights:
+            raise ValueError("Multi-threaded training is only available for dense or symmetric weights, "
+                             "set train_with_sparse_weights to False or n_threads to 1")
+
+        self.n_threads = n_threads
 
 
         self.useAdaGrad = False
@@ -152,10 +348,28 @@ cdef class SLIM_BPR_Cython_Epoch:
         """
 
         if self.train_with_sparse_weights:
-            self.S_sparse.dealloc()
 
-        elif self.symmetric:
-            self.S_symmetric.dealloc()
+            if self.use_hash_sparse_weights:
+                self.S_sparse_hash.dealloc()
+            else:
+                self.S_sparse.dealloc()
+
+
+
+    cdef double S_sparse_get_value(self, long row, long col):
+
+        if self.use_hash_sparse_weights:
+            return self.S_sparse_hash.get_value(row, col)
+        else:
+            return self.S_sparse.get_value(row, col)
+
+
+    cdef double S_sparse_add_value(self, long row, long col, double value):
+
+        if self.use_hash_sparse_weights:
+            return self.S_sparse_hash.add_value(row, col, value)
+        else:
+            return self.S_sparse.add_value(row, col, value)
 
 
 
@@ -163,6 +377,15 @@ cdef class SLIM_BPR_Cython_Epoch:
 
 
     def epochIteration_Cython(self):
+        """
+        Samples are processed in batches of batch_size. All the x_uij of a batch are computed on the same S,
+        in parallel over the samples for the dense or symmetric S, then the updates of all the samples are applied.
+        With batch_size 1 this is plain SGD, if n_threads > 1 the Hogwild epoch is used instead
+        """
+
+        if self.n_threads > 1 and self.batch_size == 1:
+            self.epochIteration_Cython_Hogwild()
+            return
 
         # Get number of available interactions
         cdef long totalNumberOfBatch = int(self.numPositiveIteractions / self.batch_size) + 1
@@ -171,249 +394,600 @@ cdef class SLIM_BPR_Cython_Epoch:
         cdef long start_time_batch = time.time()
 
         cdef BPR_sample sample
-        cdef long i, j
-        cdef long index, seenItem, numCurrentBatch, itemId
+        cdef long sample_index, numCurrentBatch
         cdef double x_uij, gradient, loss = 0.0
         cdef double gradient_update
 
-        cdef int numSeenItems
-        cdef int printStep
+        cdef long printStep
+
+        cdef BPR_sample * batch_samples = <BPR_sample *> PyMem_Malloc(self.batch_size * sizeof(BPR_sample))
+        cdef double[:] batch_x_uij = np.zeros(self.batch_size, dtype=np.float64)
 
         if self.train_with_sparse_weights:
             printStep = 500000
         else:
             printStep = 5000000
 
+        # Print step in number of batches
+        printStep = max(1, printStep / self.batch_size)
+
 
         # Uniform user sampling without replacement
         for numCurrentBatch in range(totalNumberOfBatch):
 
-            sample = self.sampleBPR_Cython()
+            for sample_index in range(self.batch_size):
+                batch_samples[sample_index] = self.sampleBPR_Cython()
 
-            i = sample.pos_item
-            j = sample.neg_item
 
-            x_uij = 0.0
+            if self.train_with_sparse_weights:
+                for sample_index in range(self.batch_size):
+                    batch_x_uij[sample_index] = self.compute_x_uij_sparse(batch_samples[sample_index])
 
-            # The difference is computed on the user_seen items
+            elif self.batch_size == 1:
+                batch_x_uij[0] = self.compute_x_uij(batch_samples[0])
 
-            index = 0
-            while index <  sample.seen_items_end_pos - sample.seen_items_start_pos:
+            else:
+                for sample_index in prange(self.batch_size, nogil=True, num_threads=self.n_threads, schedule='static'):
+                    batch_x_uij[sample_index] = self.compute_x_uij(batch_samples[sample_index])
+
+
+            for sample_index in range(self.batch_size):
 
-                seenItem = self.URM_mask_indices[sample.seen_items_start_pos + index]
-                index +=1
+                sample = batch_samples[sample_index]
+                x_uij = batch_x_uij[sample_index]
 
-                if self.train_with_sparse_weights:
-                   x_uij += self.S_sparse.get_value(i, seenItem) - self.S_sparse.get_value(j, seenItem)
+                gradient = 1 / (1 + exp(x_uij))
+                loss += x_uij**2
 
-                elif self.symmetric:
-                    x_uij += self.S_symmetric.get_value(i, seenItem) - self.S_symmetric.get_value(j, seenItem)
+                gradient_update = self.adaptive_gradient_update(sample.pos_item, sample.neg_item, gradient)
 
+                self.apply_sample_update(sample, gradient_update)
+
+
+
+            # If I have reached at least 20% of the total number of batches or samples
+            # This allows to limit the memory occupancy of the sparse matrix
+            if self.train_with_sparse_weights and totalNumberOfBatch >= 5 and \
+                    numCurrentBatch % (totalNumberOfBatch/5) == 0 and numCurrentBatch!=0:
+
+                if self.use_hash_sparse_weights:
+                    if self.topK:
+                        self.S_sparse_hash.prune_rows_topK(self.topK)
                 else:
-                    x_uij += self.S_dense[i, seenItem] - self.S_dense[j, seenItem]
+                    self.S_sparse.rebalance_tree(TopK=self.topK)
+
+
+            if((numCurrentBatch%printStep==0 and not numCurrentBatch==0) or numCurrentBatch==totalNumberOfBatch-1):
+                print("Processed {} ( {:.2f}% ) in {:.2f} seconds. BPR loss is {:.2E}. Sample per second: {:.0f}".format(
+                    numCurrentBatch*self.batch_size,
+                    100.0* float(numCurrentBatch*self.batch_size)/self.numPositiveIteractions,
+                    time.time() - start_time_batch,
+                    loss/(numCurrentBatch*self.batch_size + 1),
+                    float(numCurrentBatch*self.batch_size + 1) / (time.time() - start_time_epoch)))
+
+                sys.stdout.flush()
+                sys.stderr.flush()
+
+                start_time_batch = time.time()
+
+
+        PyMem_Free(batch_samples)
+
+
+
+
+    cdef double compute_x_uij(self, BPR_sample sample) nogil:
+        """
+        x_uij of the sample on the dense or symmetric S, the difference is computed on the user_seen items
+        """
+
+        cdef long index, seenItem
+        cdef double x_uij = 0.0
+
+        for index in range(sample.seen_items_end_pos - sample.seen_items_start_pos):
+            seenItem = self.URM_mask_indices[sample.seen_items_start_pos + index]
+            x_uij = x_uij + self.get_S_value(sample.pos_item, seenItem) - self.get_S_value(sample.neg_item, seenItem)
+
+        return x_uij
+
+
+
+    cdef double compute_x_uij_sparse(self, BPR_sample sample):
+        """
+        x_uij of the sample on the sparse S, the difference is computed on the user_seen items
+        """
+
+        cdef long index, seenItem
+        cdef double x_uij = 0.0
+
+        for index in range(sample.seen_items_end_pos - sample.seen_items_start_pos):
+            seenItem = self.URM_mask_indices[sample.seen_items_start_pos + index]
+            x_uij += self.S_sparse_get_value(sample.pos_item, seenItem) - self.S_sparse_get_value(sample.neg_item, seenItem)
+
+        return x_uij
+
+
+
+    cdef double adaptive_gradient_update(self, long i, long j, double gradient):
+        """
+        Updates the adaptive gradient state of items i and j and returns the resulting gradient update
+        """
+
+        cdef double gradient_update
+
+        if self.useAdaGrad:
+            self.sgd_cache_I[i] += gradient ** 2
+            self.sgd_cache_I[j] += gradient ** 2
+
+            gradient_update = gradient / (sqrt(self.sgd_cache_I[i]) + 1e-8)
+
+
+        elif self.useRmsprop:
+            self.sgd_cache_I[i] = self.sgd_cache_I[i] * self.gamma + (1 - self.gamma) * gradient ** 2
+            self.sgd_cache_I[j] = self.sgd_cache_I[j] * self.gamma + (1 - self.gamma) * gradient ** 2
+
+            gradient_update = gradient / (sqrt(self.sgd_cache_I[i]) + 1e-8)
+
+
+        elif self.useAdam:
+
+            self.sgd_cache_I_momentum_1[i] = \
+                self.sgd_cache_I_momentum_1[i] * self.beta_1 + (1 - self.beta_1) * gradient
+
+            self.sgd_cache_I_momentum_2[i] = \
+                self.sgd_cache_I_momentum_2[i] * self.beta_2 + (1 - self.beta_2) * gradient**2
+
+
+            self.momentum_1 = self.sgd_cache_I_momentum_1[i]/ (1 - self.beta_1_power_t)
+            self.momentum_2 = self.sgd_cache_I_momentum_2[i]/ (1 - self.beta_2_power_t)
+
+            gradient_update = self.momentum_1/ (sqrt(self.momentum_2) + 1e-8)
+
+
+            self.sgd_cache_I_momentum_1[j] = \
+                self.sgd_cache_I_momentum_1[j] * self.beta_1 + (1 - self.beta_1) * gradient
+
+            self.sgd_cache_I_momentum_2[j] = \
+                self.sgd_cache_I_momentum_2[j] * self.beta_2 + (1 - self.beta_2) * gradient**2
+
+            # Exponentiation of beta at the end of each sample
+            self.beta_1_power_t *= self.beta_1
+            self.beta_2_power_t *= self.beta_2
+
+        else:
+
+            gradient_update = gradient
+
+
+        return gradient_update
+
+
+
+    cdef apply_sample_update(self, BPR_sample sample, double gradient_update):
+
+        cdef long index, seenItem
+        cdef long i = sample.pos_item
+        cdef long j = sample.neg_item
+
+        if not self.train_with_sparse_weights:
+            self.apply_sample_update_dense(sample, gradient_update)
+            return
+
+
+        for index in range(sample.seen_items_end_pos - sample.seen_items_start_pos):
+
+            seenItem = self.URM_mask_indices[sample.seen_items_start_pos + index]
+
+            # Since the sparse matrix is slower compared to the others
+            # If no reg is required, avoid accessing it
+
+            if seenItem != i:
+                if self.li_reg!= 0.0:
+                    self.S_sparse_add_value(i, seenItem, self.learning_rate * (gradient_update - self.li_reg * self.S_sparse_get_value(i, seenItem)))
+                else:
+                    self.S_sparse_add_value(i, seenItem, self.learning_rate * gradient_update)
+
+
+            if seenItem != j:
+                if self.lj_reg!= 0.0:
+                    self.S_sparse_add_value(j, seenItem, -self.learning_rate * (gradient_update - self.lj_reg * self.S_sparse_get_value(j, seenItem)))
+                else:
+                    self.S_sparse_add_value(j, seenItem, -self.learning_rate * gradient_update)
+
+
+
+    cdef void apply_sample_update_dense(self, BPR_sample sample, double gradient_update) nogil:
+
+        cdef long index, seenItem
+        cdef long i = sample.pos_item
+        cdef long j = sample.neg_item
+
+        for index in range(sample.seen_items_end_pos - sample.seen_items_start_pos):
+
+            seenItem = self.URM_mask_indices[sample.seen_items_start_pos + index]
+
+            if seenItem != i:
+                self.add_S_value(i, seenItem, self.learning_rate * (gradient_update - self.li_reg * self.get_S_value(i, seenItem)))
+
+            if seenItem != j:
+                self.add_S_value(j, seenItem, -self.learning_rate * (gradient_update - self.lj_reg * self.get_S_value(j, seenItem)))
+
+
+
+
+    def epochIteration_Cython_Hogwild(self):
+        """
+        Lock-free parallel epoch, each thread samples with its own random generator and updates
+        the shared S without synchronization.
+        The adaptive gradient state is copied for each thread and merged at the end of the epoch:
+        AdaGrad accumulators are summed, RMSProp and Adam moving averages are averaged
+        """
+
+        cdef long n_samples_thread = int(self.numPositiveIteractions / self.n_threads) + 1
+        cdef long thread_id
+
+        cdef np.uint64_t[:] rng_state = np.random.randint(1, np.iinfo(np.int64).max, size=self.n_threads, dtype=np.uint64)
+
+        start_time_epoch = time.time()
+
+        self.loss_thread = np.zeros(self.n_threads, dtype=np.float64)
+
+        if self.useAdaGrad or self.useRmsprop:
+            self.sgd_cache_I_thread = np.tile(self.sgd_cache_I, (self.n_threads, 1))
+
+        elif self.useAdam:
+            self.sgd_cache_I_momentum_1_thread = np.tile(self.sgd_cache_I_momentum_1, (self.n_threads, 1))
+            self.sgd_cache_I_momentum_2_thread = np.tile(self.sgd_cache_I_momentum_2, (self.n_threads, 1))
+            self.beta_1_power_t_thread = np.full(self.n_threads, self.beta_1_power_t, dtype=np.float64)
+            self.beta_2_power_t_thread = np.full(self.n_threads, self.beta_2_power_t, dtype=np.float64)
+
+
+        for thread_id in prange(self.n_threads, nogil=True, num_threads=self.n_threads, schedule='static'):
+            self.epochIteration_thread(thread_id, n_samples_thread, &rng_state[thread_id])
+
+
+        if self.useAdaGrad:
+            self.sgd_cache_I = np.asarray(self.sgd_cache_I_thread).sum(axis=0) - (self.n_threads - 1) * np.asarray(self.sgd_cache_I)
+
+        elif self.useRmsprop:
+            self.sgd_cache_I = np.asarray(self.sgd_cache_I_thread).mean(axis=0)
+
+        elif self.useAdam:
+            self.sgd_cache_I_momentum_1 = np.asarray(self.sgd_cache_I_momentum_1_thread).mean(axis=0)
+            self.sgd_cache_I_momentum_2 = np.asarray(self.sgd_cache_I_momentum_2_thread).mean(axis=0)
+
+            self.beta_1_power_t *= pow(self.beta_1, n_samples_thread * self.n_threads)
+            self.beta_2_power_t *= pow(self.beta_2, n_samples_thread * self.n_threads)
+
+
+        print("Processed {} ( {:.2f}% ) in {:.2f} seconds with {} threads. BPR loss is {:.2E}. Sample per second: {:.0f}".format(
+            n_samples_thread * self.n_threads,
+            100.0* float(n_samples_thread * self.n_threads)/self.numPositiveIteractions,
+            time.time() - start_time_epoch,
+            self.n_threads,
+            np.sum(self.loss_thread)/(n_samples_thread * self.n_threads),
+            float(n_samples_thread * self.n_threads) / (time.time() - start_time_epoch)))
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+
+
+    cdef void epochIteration_thread(self, long thread_id, long n_samples_thread, np.uint64_t * rng_state) nogil:
+
+        cdef BPR_sample sample
+        cdef long i, j
+        cdef long numCurrentSample
+        cdef double x_uij, gradient, loss = 0.0
+        cdef double gradient_update, momentum_1, momentum_2
+
+
+        for numCurrentSample in range(n_samples_thread):
+
+            sample = self.sampleBPR_Cython_thread(rng_state)
+
+            i = sample.pos_item
+            j = sample.neg_item
+
+            x_uij = self.compute_x_uij(sample)
 
 
             gradient = 1 / (1 + exp(x_uij))
-            loss += x_uij**2
-
-
-            # if self.useAdaGrad:
-            #     cacheUpdate = gradient ** 2
-            #
-            #     sgd_cache[i] += cacheUpdate
-            #     sgd_cache[j] += cacheUpdate
-            #
-            #     gradient = gradient / (sqrt(sgd_cache[i]) + 1e-8)
-            #
-            # elif self.useRmsprop:
-            #     cacheUpdate = sgd_cache[i] * gamma + (1 - gamma) * gradient ** 2
-            #
-            #     sgd_cache[i] = cacheUpdate
-            #     sgd_cache[j] = cacheUpdate
-            #
-            #     gradient = gradient / (sqrt(sgd_cache[i]) + 1e-8)
-            #
-            #
-            # #######################################
+            loss = loss + x_uij**2
 
 
             if self.useAdaGrad:
-                self.sgd_cache_I[i] += gradient ** 2
-                self.sgd_cache_I[j] += gradient ** 2
+                self.sgd_cache_I_thread[thread_id, i] += gradient ** 2
+                self.sgd_cache_I_thread[thread_id, j] += gradient ** 2
 
-                gradient_update = gradient / (sqrt(self.sgd_cache_I[i]) + 1e-8)
+                gradient_update = gradient / (sqrt(self.sgd_cache_I_thread[thread_id, i]) + 1e-8)
 
 
             elif self.useRmsprop:
-                self.sgd_cache_I[i] = self.sgd_cache_I[i] * self.gamma + (1 - self.gamma) * gradient ** 2
-                self.sgd_cache_I[j] = self.sgd_cache_I[j] * self.gamma + (1 - self.gamma) * gradient ** 2
+                self.sgd_cache_I_thread[thread_id, i] = self.sgd_cache_I_thread[thread_id, i] * self.gamma + (1 - self.gamma) * gradient ** 2
+                self.sgd_cache_I_thread[thread_id, j] = self.sgd_cache_I_thread[thread_id, j] * self.gamma + (1 - self.gamma) * gradient ** 2
 
-                gradient_update = gradient / (sqrt(self.sgd_cache_I[i]) + 1e-8)
+                gradient_update = gradient / (sqrt(self.sgd_cache_I_thread[thread_id, i]) + 1e-8)
 
 
             elif self.useAdam:
 
-                self.sgd_cache_I_momentum_1[i] = \
-                    self.sgd_cache_I_momentum_1[i] * self.beta_1 + (1 - self.beta_1) * gradient
+                self.sgd_cache_I_momentum_1_thread[thread_id, i] = \
+                    self.sgd_cache_I_momentum_1_thread[thread_id, i] * self.beta_1 + (1 - self.beta_1) * gradient
+
+                self.sgd_cache_I_momentum_2_thread[thread_id, i] = \
+                    self.sgd_cache_I_momentum_2_thread[thread_id, i] * self.beta_2 + (1 - self.beta_2) * gradient**2
+
+
+                momentum_1 = self.sgd_cache_I_momentum_1_thread[thread_id, i]/ (1 - self.beta_1_power_t_thread[thread_id])
+                momentum_2 = self.sgd_cache_I_momentum_2_thread[thread_id, i]/ (1 - self.beta_2_power_t_thread[thread_id])
+
+                gradient_update = momentum_1/ (sqrt(momentum_2) + 1e-8)
 
-                self.sgd_cache_I_momentum_2[i] = \
-                    self.sgd_cache_I_momentum_2[i] * self.beta_2 + (1 - self.beta_2) * gradient**2
 
+                self.sgd_cache_I_momentum_1_thread[thread_id, j] = \
+                    self.sgd_cache_I_momentum_1_thread[thread_id, j] * self.beta_1 + (1 - self.beta_1) * gradient
 
-                self.momentum_1 = self.sgd_cache_I_momentum_1[i]/ (1 - self.beta_1_power_t)
-                self.momentum_2 = self.sgd_cache_I_momentum_2[i]/ (1 - self.beta_2_power_t)
+                self.sgd_cache_I_momentum_2_thread[thread_id, j] = \
+                    self.sgd_cache_I_momentum_2_thread[thread_id, j] * self.beta_2 + (1 - self.beta_2) * gradient**2
 
-                gradient_update = self.momentum_1/ (sqrt(self.momentum_2) + 1e-8)
+            else:
+
+                gradient_update = gradient
 
 
 
+            self.apply_sample_update_dense(sample, gradient_update)
 
-                self.sgd_cache_I_momentum_1[j] = \
-                    self.sgd_cache_I_momentum_1[j] * self.beta_1 + (1 - self.beta_1) * gradient
 
-                self.sgd_cache_I_momentum_2[j] = \
-                    self.sgd_cache_I_momentum_2[j] * self.beta_2 + (1 - self.beta_2) * gradient**2
+            if self.useAdam:
+                self.beta_1_power_t_thread[thread_id] *= self.beta_1
+                self.beta_2_power_t_thread[thread_id] *= self.beta_2
+
 
+        self.loss_thread[thread_id] = loss
 
+
+
+
+    cdef inline long get_S_flat_index(self, long row, long col) nogil:
+        """
+        Position of a cell of the dense or symmetric S in its flat array
+        """
+
+        if self.symmetric:
+            if col > row:
+                return col*(col + 1)/2 + row
             else:
+                return row*(row + 1)/2 + col
 
-                gradient_update = gradient
+        return row*self.n_items + col
 
 
 
+    cdef inline double get_S_value(self, long row, long col) nogil:
 
+        cdef long index = self.get_S_flat_index(row, col)
 
+        if self.weights_precision_bits == 64:
+            return self.S_flat_float64[index]
 
+        elif self.weights_precision_bits == 32:
+            return self.S_flat_float32[index]
 
-            index = 0
-            while index < sample.seen_items_end_pos - sample.seen_items_start_pos:
+        else:
+            return half_to_float(self.S_flat_float16[index])
+
+
+
+    cdef inline void add_S_value(self, long row, long col, double value) nogil:
+
+        cdef long index = self.get_S_flat_index(row, col)
+
+        if self.weights_precision_bits == 64:
+            self.S_flat_float64[index] += value
+
+        elif self.weights_precision_bits == 32:
+            self.S_flat_float32[index] += value
+
+        else:
+            # The sum is computed in float and rounded once to half precision
+            self.S_flat_float16[index] = float_to_half(half_to_float(self.S_flat_float16[index]) + value)
+
+
+
+    def get_S_dense(self):
+        """
+        Returns the dense or symmetric S as a dense numpy array, float64 or float32 depending on the precision used
+        :return:
+        """
+
+        cdef long row
+
+        if self.weights_precision_bits == 64:
+            S_flat = np.asarray(self.S_flat_float64)
+        elif self.weights_precision_bits == 32:
+            S_flat = np.asarray(self.S_flat_float32)
+        else:
+            S_flat = np.asarray(self.S_flat_float16).view(np.float16).astype(np.float32)
 
-                seenItem = self.URM_mask_indices[sample.seen_items_start_pos + index]
-                index +=1
+        if not self.symmetric:
+            return S_flat.reshape((self.n_items, self.n_items)).copy()
 
-                if self.train_with_sparse_weights:
-                    # Since the sparse matrix is slower compared to the others
-                    # If no reg is required, avoid accessing it
+        S_dense = np.zeros((self.n_items, self.n_items), dtype=S_flat.dtype)
 
-                    if seenItem != i:
-                        if self.li_reg!= 0.0:
-                            self.S_sparse.add_value(i, seenItem, self.learning_rate * (gradient_update - self.li_reg * self.S_sparse.get_value(i, seenItem)))
-                        else:
-                            self.S_sparse.add_value(i, seenItem, self.learning_rate * gradient_update)
+        # Copy each row of the lower triangular both in the row and in the column
+        for row in range(self.n_items):
+            row_start = row*(row + 1)//2
+            S_dense[row, 0:row + 1] = S_flat[row_start:row_start + row + 1]
+            S_dense[0:row, row] = S_flat[row_start:row_start + row]
 
+        return S_dense
+
+
+
+    def get_S(self):
+
+        # FIll diagonal with zeros, the diagonal of the dense or symmetric S is never updated
+        cdef int index = 0
+
+        while index < self.n_items and self.train_with_sparse_weights:
+
+            self.S_sparse_add_value(index, index, -self.S_sparse_get_value(index, index))
+
+            index+=1
+
+
+
+        if self.topK == False:
+
+            if self.train_with_sparse_weights:
+
+                if self.use_hash_sparse_weights:
+                    return self.S_sparse_hash.get_scipy_csr(TopK = False)
+                else:
+                    return self.S_sparse.get_scipy_csr(TopK = False)
+
+            elif self.symmetric or self.final_model_sparse_weights:
+                return sps.csr_matrix(self.get_S_dense())
+
+            else:
+                return self.get_S_dense()
+
+
+        else :
+
+            if self.train_with_sparse_weights:
+
+                if self.use_hash_sparse_weights:
+                    return self.S_sparse_hash.get_scipy_csr(TopK=self.topK)
+                else:
+                    return self.S_sparse.get_scipy_csr(TopK=self.topK)
+
+            elif self.symmetric or self.final_model_sparse_weights:
+                return self.get_S_topK_rows()
+
+            else:
+                return self.get_S_dense()
+
+
+
+    def get_S_topK_rows(self):
+        """
+        Returns the scipy csr with the TopK highest values of each row of the dense or symmetric S.
+        The selection is done in place on S with a partial selection on each row, rows are processed in parallel
+        and no dense copy of S is made.
+        As in similarityMatrixTopK, zeros are considered during the selection and then removed
+        :return:
+        """
 
-                    if seenItem != j:
-                        if self.lj_reg!= 0.0:
-                            self.S_sparse.add_value(j, seenItem, -self.learning_rate * (gradient_update - self.lj_reg * self.S_sparse.get_value(j, seenItem)))
-                        else:
-                            self.S_sparse.add_value(j, seenItem, -self.learning_rate * gradient_update)
+        cdef long TopK = min(self.topK, self.n_items)
+        cdef long row
 
+        cdef double[:,:] topK_data = np.zeros((self.n_items, TopK), dtype=np.float64)
+        cdef int[:,:] topK_indices = np.zeros((self.n_items, TopK), dtype=np.int32)
 
-                elif self.symmetric:
+        for row in prange(self.n_items, nogil=True, num_threads=self.n_threads, schedule='static'):
+            self.select_row_topK(row, TopK, &topK_data[row, 0], &topK_indices[row, 0])
 
-                    if seenItem != i:
-                        self.S_symmetric.add_value(i, seenItem, self.learning_rate * (gradient_update - self.li_reg * self.S_symmetric.get_value(i, seenItem)))
 
-                    if seenItem != j:
-                        self.S_symmetric.add_value(j, seenItem, -self.learning_rate * (gradient_update - self.lj_reg * self.S_symmetric.get_value(j, seenItem)))
+        topK_data_np = np.asarray(topK_data)
+        not_zero_mask = topK_data_np != 0.0
 
-                else:
+        indptr = np.zeros(self.n_items + 1, dtype=np.int64)
+        np.cumsum(not_zero_mask.sum(axis=1), out=indptr[1:])
 
-                    if seenItem != i:
-                        self.S_dense[i, seenItem] += self.learning_rate * (gradient_update - self.li_reg * self.S_dense[i, seenItem])
+        return sps.csr_matrix((topK_data_np[not_zero_mask], np.asarray(topK_indices)[not_zero_mask], indptr),
+                              shape=(self.n_items, self.n_items))
 
-                    if seenItem != j:
-                        self.S_dense[j, seenItem] -= self.learning_rate * (gradient_update - self.lj_reg * self.S_dense[j, seenItem])
 
 
 
-            # Exponentiation of beta at the end of each sample
-            if self.useAdam:
+    cdef void select_row_topK(self, long row, long TopK, double * heap_data, int * heap_indices) nogil:
+        """
+        Selects the TopK highest values of the row using a min-heap of size TopK, whose root is the
+        lowest of the values selected so far. Values and columns are written in heap_data and heap_indices
+        """
 
-                self.beta_1_power_t *= self.beta_1
-                self.beta_2_power_t *= self.beta_2
+        cdef long col, position
+        cdef double value
 
+        for col in range(TopK):
+            heap_data[col] = self.get_S_value(row, col)
+            heap_indices[col] = col
 
+        position = TopK/2 - 1
+        while position >= 0:
+            heap_sift_down(heap_data, heap_indices, TopK, position)
+            position -= 1
 
-            # If I have reached at least 20% of the total number of batches or samples
-            # This allows to limit the memory occupancy of the sparse matrix
-            if self.train_with_sparse_weights and numCurrentBatch % (totalNumberOfBatch/5) == 0 and numCurrentBatch!=0:
-                self.S_sparse.rebalance_tree(TopK=self.topK)
+        for col in range(TopK, self.n_items):
 
+            value = self.get_S_value(row, col)
 
-            if((numCurrentBatch%printStep==0 and not numCurrentBatch==0) or numCurrentBatch==totalNumberOfBatch-1):
-                print("Processed {} ( {:.2f}% ) in {:.2f} seconds. BPR loss is {:.2E}. Sample per second: {:.0f}".format(
-                    numCurrentBatch*self.batch_size,
-                    100.0* float(numCurrentBatch*self.batch_size)/self.numPositiveIteractions,
-                    time.time() - start_time_batch,
-                    loss/(numCurrentBatch*self.batch_size + 1),
-                    float(numCurrentBatch*self.batch_size + 1) / (time.time() - start_time_epoch)))
+            if value > heap_data[0]:
+                heap_data[0] = value
+                heap_indices[0] = col
+                heap_sift_down(heap_data, heap_indices, TopK, 0)
 
-                sys.stdout.flush()
-                sys.stderr.flush()
 
-                start_time_batch = time.time()
 
 
 
+    cdef BPR_sample sampleBPR_Cython(self):
 
-    def get_S(self):
+        cdef BPR_sample sample = BPR_sample(-1,-1,-1,-1,-1)
 
-        # FIll diagonal with zeros
-        cdef int index = 0
+        cdef long index
 
-        while index < self.n_items:
+        cdef int negItemSelected, numSeenItems = 0
 
-            if self.train_with_sparse_weights:
-                self.S_sparse.add_value(index, index, -self.S_sparse.get_value(index, index))
 
-            elif self.symmetric:
-                self.S_symmetric.add_value(index, index, -self.S_symmetric.get_value(index, index))
+        # Skip users with no interactions or with no negative items
+        while numSeenItems == 0 or numSeenItems == self.n_items:
 
-            else:
-                self.S_dense[index, index] = 0.0
+            sample.user = rand() % self.n_users
 
-            index+=1
+            sample.seen_items_start_pos = self.URM_mask_indptr[sample.user]
+            sample.seen_items_end_pos = self.URM_mask_indptr[sample.user + 1]
 
+            numSeenItems = sample.seen_items_end_pos - sample.seen_items_start_pos
 
 
-        if self.topK == False:
+        index = rand() % numSeenItems
 
-            if self.train_with_sparse_weights:
-                return self.S_sparse.get_scipy_csr(TopK = False)
+        sample.pos_item = self.URM_mask_indices[sample.seen_items_start_pos + index]
 
-            elif self.symmetric:
-                return self.S_symmetric.get_scipy_csr(TopK = False)
 
-            else:
+        negItemSelected = False
 
-                if self.final_model_sparse_weights:
-                    return similarityMatrixTopK(np.array(self.S_dense.T), k=self.topK, forceSparseOutput=True, inplace=True).T
-                else:
-                    return np.array(self.S_dense)
+        # It's faster to just try again then to build a mapping of the non-seen items
+        # for every user
+        while (not negItemSelected):
 
+            sample.neg_item = rand() % self.n_items
 
-        else :
+            index = 0
+            while index < numSeenItems and self.URM_mask_indices[sample.seen_items_start_pos + index]!=sample.neg_item:
+                index+=1
 
-            if self.train_with_sparse_weights:
-                return self.S_sparse.get_scipy_csr(TopK=self.topK)
+            if index == numSeenItems:
+                negItemSelected = True
 
-            elif self.symmetric:
-                return self.S_symmetric.get_scipy_csr(TopK=self.topK)
 
-            else:
-                if self.final_model_sparse_weights:
-                    return similarityMatrixTopK(np.array(self.S_dense.T), k=self.topK, forceSparseOutput=True, inplace=True).T
-                else:
-                    return np.array(self.S_dense)
+        return sample
 
 
 
 
 
-    cdef BPR_sample sampleBPR_Cython(self):
+    cdef BPR_sample sampleBPR_Cython_thread(self, np.uint64_t * rng_state) nogil:
+        """
+        Same as sampleBPR_Cython, using the random generator state of the calling thread
+        """
 
-        cdef BPR_sample sample = BPR_sample(-1,-1,-1,-1,-1)
+        cdef BPR_sample sample
 
         cdef long index
 
@@ -423,7 +997,7 @@ cdef class SLIM_BPR_Cython_Epoch:
         # Skip users with no interactions or with no negative items
         while numSeenItems == 0 or numSeenItems == self.n_items:
 
-            sample.user = rand() % self.n_users
+            sample.user = xorshift_rand(rng_state) % self.n_users
 
             sample.seen_items_start_pos = self.URM_mask_indptr[sample.user]
             sample.seen_items_end_pos = self.URM_mask_indptr[sample.user + 1]
@@ -431,18 +1005,16 @@ cdef class SLIM_BPR_Cython_Epoch:
             numSeenItems = sample.seen_items_end_pos - sample.seen_items_start_pos
 
 
-        index = rand() % numSeenItems
+        index = xorshift_rand(rng_state) % numSeenItems
 
         sample.pos_item = self.URM_mask_indices[sample.seen_items_start_pos + index]
 
 
         negItemSelected = False
 
-        # It's faster to just try again then to build a mapping of the non-seen items
-        # for every user
         while (not negItemSelected):
 
-            sample.neg_item = rand() % self.n_items
+            sample.neg_item = xorshift_rand(rng_state) % self.n_items
 
             index = 0
             while index < numSeenItems and self.URM_mask_indices[sample.seen_items_start_pos + index]!=sample.neg_item:
@@ -456,7 +1028,6 @@ cdef class SLIM_BPR_Cython_Epoch:
 
 
 
-
 ##################################################################################################################
 #####################
 #####################            SPARSE MATRIX
@@ -1184,6 +1755,354 @@ cdef class Sparse_Matrix_Tree_CSR:
 
 
 
+##################################################################################################################
+#####################
+#####################            SPARSE MATRIX HASH
+#####################
+##################################################################################################################
+
+# Size of the table allocated for a row when its first cell is added, must be a power of 2
+DEF HASH_INITIAL_TABLE_SIZE = 8
+
+# Column of the empty slots
+DEF HASH_EMPTY_SLOT = -1
+
+
+# Cell of a row, used to select the TopK cells of a row
+ctypedef struct matrix_element_hash_s:
+    int column
+    float data
+
+
+cdef int compare_hash_element_on_data_descending(const void * a_input, const void * b_input):
+    """
+    The function compares the data contained in the two struct passed, in order to sort them in descending order.
+    If a.data > b.data returns <0
+    If a.data < b.data returns >0
+
+    :return int: -1, +1 or 0
+    """
+
+    cdef matrix_element_hash_s * a_casted = <matrix_element_hash_s *> a_input
+    cdef matrix_element_hash_s * b_casted = <matrix_element_hash_s *> b_input
+
+    if a_casted.data > b_casted.data:
+        return -1
+    elif a_casted.data < b_casted.data:
+        return +1
+    else:
+        return 0
+
+
+cdef inline long hash_slot(long column, long table_mask):
+    """
+    Multiplicative hashing of the column, table_mask is the table size - 1
+    """
+    return (<unsigned long> column * <unsigned long> 2654435761) & table_mask
+
+
+
+#################################
+#################################       CLASS DECLARATION
+#################################
+
+cdef class Sparse_Matrix_Hash_CSR:
+    """
+    Sparse matrix in which each row is an open addressing hash table with linear probing.
+    The table of a row is made of two contiguous arrays, the columns as int32 and the values as float32,
+    its size is a power of 2 and it is doubled whenever the row becomes half full.
+    Empty slots have column HASH_EMPTY_SLOT, cells are never removed but by prune_rows_topK, which rebuilds the tables
+    """
+
+    cdef long num_rows, num_cols
+
+    cdef int** row_columns
+    cdef float** row_data
+    cdef long* row_table_size
+    cdef long* row_nnz
+
+
+    def __init__(self, long num_rows, long num_cols):
+
+        cdef long row
+
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+
+        self.row_columns = <int **> PyMem_Malloc(self.num_rows * sizeof(int*))
+        self.row_data = <float **> PyMem_Malloc(self.num_rows * sizeof(float*))
+        self.row_table_size = <long *> PyMem_Malloc(self.num_rows * sizeof(long))
+        self.row_nnz = <long *> PyMem_Malloc(self.num_rows * sizeof(long))
+
+        # Initialize all rows to empty, tables are allocated when the first cell is added
+        for row in range(self.num_rows):
+            self.row_columns[row] = NULL
+            self.row_data[row] = NULL
+            self.row_table_size[row] = 0
+            self.row_nnz[row] = 0
+
+
+
+    def dealloc(self):
+        """
+        Remove all PyMalloc allocaded memory
+        :return:
+        """
+
+        cdef long row
+
+        # Free all rows memory
+        for row in range(self.num_rows):
+            PyMem_Free(self.row_columns[row])
+            PyMem_Free(self.row_data[row])
+
+        PyMem_Free(self.row_columns)
+        PyMem_Free(self.row_data)
+        PyMem_Free(self.row_table_size)
+        PyMem_Free(self.row_nnz)
+
+
+
+    cdef allocate_row_table(self, long row, long table_size):
+        """
+        The function replaces the table of the row with an empty one of the given size.
+        The previous table is NOT freed
+
+        :param row:
+        :param table_size: must be a power of 2
+        """
+
+        cdef long slot
+
+        self.row_columns[row] = <int *> PyMem_Malloc(table_size * sizeof(int))
+        self.row_data[row] = <float *> PyMem_Malloc(table_size * sizeof(float))
+        self.row_table_size[row] = table_size
+        self.row_nnz[row] = 0
+
+        for slot in range(table_size):
+            self.row_columns[row][slot] = HASH_EMPTY_SLOT
+            self.row_data[row][slot] = 0.0
+
+
+
+    cdef long find_slot(self, long row, long col):
+        """
+        The function returns the slot of the row table containing the column or,
+        if the column is not present, the empty slot in which it should be inserted.
+        The row table must be allocated and contain at least one empty slot
+
+        :param row: cell coordinates
+        :param col:  cell coordinates
+        :return long: slot
+        """
+
+        cdef long table_mask = self.row_table_size[row] - 1
+        cdef long slot = hash_slot(col, table_mask)
+        cdef int* columns = self.row_columns[row]
+
+        while columns[slot] != HASH_EMPTY_SLOT and columns[slot] != col:
+            slot = (slot + 1) & table_mask
+
+        return slot
+
+
+
+    cdef insert_new_cell(self, long row, long col, float value):
+        """
+        The function inserts a cell which is NOT already present in a row table with at least one empty slot
+        """
+
+        cdef long slot = self.find_slot(row, col)
+
+        self.row_columns[row][slot] = col
+        self.row_data[row][slot] = value
+        self.row_nnz[row] += 1
+
+
+
+    cdef resize_row_table(self, long row, long new_table_size):
+        """
+        The function moves all the cells of the row in a new table of the given size
+
+        :param row:
+        :param new_table_size: must be a power of 2 and greater than the number of cells of the row
+        """
+
+        cdef int* old_columns = self.row_columns[row]
+        cdef float* old_data = self.row_data[row]
+        cdef long old_table_size = self.row_table_size[row]
+        cdef long slot
+
+        self.allocate_row_table(row, new_table_size)
+
+        for slot in range(old_table_size):
+            if old_columns[slot] != HASH_EMPTY_SLOT:
+                self.insert_new_cell(row, old_columns[slot], old_data[slot])
+
+        PyMem_Free(old_columns)
+        PyMem_Free(old_data)
+
+
+
+
+    cpdef double add_value(self, long row, long col, double value):
+        """
+        The function adds a value to the specified cell. A new cell is created if necessary.
+
+        :param row: cell coordinates
+        :param col:  cell coordinates
+        :param value: value to add
+        :return double: resulting cell value
+        """
+
+        if row >= self.num_rows or col >= self.num_cols or row < 0 or col < 0:
+            raise ValueError("Cell is outside matrix. Matrix shape is ({},{}), coordinates given are ({},{})".format(
+                self.num_rows, self.num_cols, row, col))
+
+        cdef long slot
+
+        # If the row is empty, create its table
+        if self.row_table_size[row] == 0:
+            self.allocate_row_table(row, HASH_INITIAL_TABLE_SIZE)
+
+        slot = self.find_slot(row, col)
+
+        # The cell exists
+        if self.row_columns[row][slot] == col:
+            self.row_data[row][slot] += value
+            return self.row_data[row][slot]
+
+
+        # The cell is new, keep the table at most half full so that the probe sequences stay short
+        if 2 * (self.row_nnz[row] + 1) > self.row_table_size[row]:
+            self.resize_row_table(row, 2 * self.row_table_size[row])
+            slot = self.find_slot(row, col)
+
+        self.row_columns[row][slot] = col
+        self.row_data[row][slot] = value
+        self.row_nnz[row] += 1
+
+        return self.row_data[row][slot]
+
+
+
+    cpdef double get_value(self, long row, long col):
+        """
+        The function returns the value of the specified cell.
+
+        :param row: cell coordinates
+        :param col:  cell coordinates
+        :return double: cell value
+        """
+
+        if row >= self.num_rows or col >= self.num_cols or row < 0 or col < 0:
+            raise ValueError(
+                "Cell is outside matrix. Matrix shape is ({},{}), coordinates given are ({},{})".format(
+                    self.num_rows, self.num_cols, row, col))
+
+        cdef long slot
+
+        # If the row is empty, return default
+        if self.row_table_size[row] == 0:
+            return 0.0
+
+        slot = self.find_slot(row, col)
+
+        # If the cell exist, return its value
+        if self.row_columns[row][slot] == col:
+            return self.row_data[row][slot]
+
+        # The cell is not found, return default
+        else:
+            return 0.0
+
+
+
+    cpdef prune_rows_topK(self, long TopK):
+        """
+        The function keeps, for each row, only the TopK cells with the highest value.
+        Tables of the rows with more than TopK cells are rebuilt with the smallest size able to contain TopK cells
+
+        :param TopK: number of the highest elements to preserve
+        """
+
+        cdef long row, slot, index, table_size, row_nnz
+        cdef matrix_element_hash_s * row_elements
+
+        for row in range(self.num_rows):
+
+            row_nnz = self.row_nnz[row]
+
+            if row_nnz <= TopK:
+                continue
+
+            row_elements = <matrix_element_hash_s *> PyMem_Malloc(row_nnz * sizeof(matrix_element_hash_s))
+
+            index = 0
+            for slot in range(self.row_table_size[row]):
+                if self.row_columns[row][slot] != HASH_EMPTY_SLOT:
+                    row_elements[index].column = self.row_columns[row][slot]
+                    row_elements[index].data = self.row_data[row][slot]
+                    index += 1
+
+            qsort(row_elements, row_nnz, sizeof(matrix_element_hash_s), compare_hash_element_on_data_descending)
+
+            PyMem_Free(self.row_columns[row])
+            PyMem_Free(self.row_data[row])
+
+            table_size = HASH_INITIAL_TABLE_SIZE
+            while table_size < 2 * TopK:
+                table_size *= 2
+
+            self.allocate_row_table(row, table_size)
+
+            for index in range(TopK):
+                self.insert_new_cell(row, row_elements[index].column, row_elements[index].data)
+
+            PyMem_Free(row_elements)
+
+
+
+    cpdef get_scipy_csr(self, long TopK = False):
+        """
+        The function returns the current sparse matrix as a scipy_csr object.
+        As for Sparse_Matrix_Tree_CSR, if TopK is given the cells not selected are removed from the matrix
+
+        :return double: scipy_csr object
+        """
+
+        cdef long row, slot, cell_index = 0, nnz = 0
+
+        if TopK:
+            self.prune_rows_topK(TopK)
+
+        for row in range(self.num_rows):
+            nnz += self.row_nnz[row]
+
+        cdef int[:] indices = np.empty(nnz, dtype=np.int32)
+        cdef float[:] data = np.empty(nnz, dtype=np.float32)
+        cdef long[:] indptr = np.zeros(self.num_rows + 1, dtype=np.int64)
+
+        for row in range(self.num_rows):
+
+            for slot in range(self.row_table_size[row]):
+
+                if self.row_columns[row][slot] != HASH_EMPTY_SLOT:
+                    indices[cell_index] = self.row_columns[row][slot]
+                    data[cell_index] = self.row_data[row][slot]
+                    cell_index += 1
+
+            indptr[row + 1] = cell_index
+
+
+        W_sparse = sps.csr_matrix((np.array(data), np.array(indices), np.array(indptr)), shape=(self.num_rows, self.num_cols))
+        W_sparse.sort_indices()
+
+        return W_sparse
+
+
+
+
 ##################################################################################################################
 #####################
 #####################            TRIANGULAR MATRIX
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 19/10/2026
+
+@author: Maurizio Ferrari Dacrema
+"""
+
+import subprocess
+import os
+import numpy as np
+import scipy.sparse as sps
+
+import unittest
+
+
+
+def runCompilationScript():
+    # Run compile script setting the working directory to ensure the compiled file are contained in the
+    # appropriate subfolder and not the project root
+
+    compiledModuleSubfolder = "/SLIM_BPR/Cython"
+    fileToCompile = 'SLIM_BPR_Cython_Epoch.pyx'
+
+    command = ['python',
+               'compileCython.py',
+               fileToCompile,
+               'build_ext',
+               '--inplace'
+               ]
+
+    output = subprocess.check_output(' '.join(command), shell=True, cwd=os.getcwd())
+
+    try:
+
+        command = ['cython',
+                   fileToCompile,
+                   '-a'
+                   ]
+
+        output = subprocess.check_output(' '.join(command), shell=True, cwd=os.getcwd())
+
+    except:
+        pass
+
+    print("Compiled module saved in subfolder: {}".format(compiledModuleSubfolder))
+
+    # Command to run compilation script
+    # python compileCython.py SLIM_BPR_Cython_Epoch.pyx build_ext --inplace
+
+
+class MyTestCase(unittest.TestCase):
+
+
+
+    def test_initialization(self):
+
+        numCols = 10
+        numRows = 5
+
+        sparseMatrix = Sparse_Matrix_Hash_CSR(numRows, numCols)
+        dense = sparseMatrix.get_scipy_csr().todense()
+
+        self.assertTrue(np.equal(dense, np.zeros((numRows, numCols))).all(), "Initialization incorrect")
+
+
+    def test_get_value_in_empty(self):
+
+        numCols = 10
+        numRows = 5
+
+        sparseMatrix = Sparse_Matrix_Hash_CSR(numRows, numCols)
+
+        value = sparseMatrix.get_value(1, 4)
+
+        self.assertEqual(0.0, value, "get_value_in_empty incorrect")
+
+
+    def test_add_complex_data(self):
+        numCols = 100
+        numRows = 10
+
+        sparseMatrix = Sparse_Matrix_Hash_CSR(numRows, numCols)
+
+        # Values are stored as float32
+        randomData = np.random.random((numRows, numCols)).astype(np.float32)
+
+        incrementalMatrix = np.zeros_like(randomData)
+
+        randomData_coo = sps.coo_matrix(randomData)
+
+        newOrdering = np.arange(len(randomData_coo.data))
+        np.random.shuffle(newOrdering)
+
+
+        for index in range(len(newOrdering)):
+
+            data = randomData_coo.data[newOrdering[index]]
+            row = randomData_coo.row[newOrdering[index]]
+            col = randomData_coo.col[newOrdering[index]]
+
+            data_return = sparseMatrix.add_value(row, col, data)
+            self.assertEqual(data, data_return, "add_value incorrect")
+
+            data_return_2 = sparseMatrix.get_value(row, col)
+            self.assertEqual(data, data_return_2, "get_value incorrect")
+
+            incrementalMatrix[row, col] = data
+
+        dense_return = sparseMatrix.get_scipy_csr().todense()
+
+        self.assertTrue(np.allclose(incrementalMatrix, dense_return), "Dense matrix incorrect")
+
+
+    def test_add_to_existing(self):
+        numCols = 1000
+        numRows = 3
+
+        sparseMatrix = Sparse_Matrix_Hash_CSR(numRows, numCols)
+        incrementalMatrix = np.zeros((numRows, numCols))
+
+        for _ in range(20000):
+
+            row = np.random.randint(numRows)
+            col = np.random.randint(numCols)
+            data = np.random.normal()
+
+            sparseMatrix.add_value(row, col, data)
+            incrementalMatrix[row, col] += data
+
+        dense_return = sparseMatrix.get_scipy_csr().todense()
+
+        self.assertTrue(np.allclose(incrementalMatrix, dense_return, atol=1e-4), "Dense matrix incorrect")
+
+
+    def test_prune_rows_top_k(self):
+        numCols = 100
+        numRows = 5
+
+        TopK = 20
+
+        sparseMatrix = Sparse_Matrix_Hash_CSR(numRows, numCols)
+        sparseMatrix_tree = Sparse_Matrix_Tree_CSR(numRows, numCols)
+
+        randomData = np.random.random((numRows, numCols)).astype(np.float32)
+
+        for row in range(numRows):
+            for col in range(numCols):
+                sparseMatrix.add_value(row, col, randomData[row, col])
+                sparseMatrix_tree.add_value(row, col, randomData[row, col])
+
+        dense_matrix_topK = sparseMatrix.get_scipy_csr(TopK = TopK).todense()
+        dense_matrix_tree_topK = sparseMatrix_tree.get_scipy_csr(TopK = TopK).todense()
+
+        self.assertTrue(np.allclose(dense_matrix_topK, dense_matrix_tree_topK), "Dense matrix incorrect")
+        self.assertTrue(np.all((dense_matrix_topK != 0).sum(axis=1) == TopK), "Number of cells per row incorrect")
+
+        # Pruned rows must still accept new cells
+        removed_col = np.flatnonzero(np.asarray(dense_matrix_topK[0]).ravel() == 0)[0]
+        sparseMatrix.add_value(0, removed_col, 5.0)
+        self.assertEqual(5.0, sparseMatrix.get_value(0, removed_col), "add_value after pruning incorrect")
+
+
+    @unittest.skipUnless(os.environ.get("RUN_BENCHMARKS"), "benchmark, set RUN_BENCHMARKS=1 to run it")
+    def test_speed_epoch(self):
+
+        # Samples per second of a SLIM BPR epoch using the tree or the hash to store the sparse similarity
+        # Benchmark only, it requires about 30 sec and has no assertion
+
+        import time
+
+        n_users = 5000
+        n_items = 3000
+
+        URM_mask = sps.random(n_users, n_items, density=0.02, format='csr')
+        URM_mask.data = np.ones_like(URM_mask.data)
+
+        for sparse_weights_structure in ["tree", "hash"]:
+
+            cythonEpoch = SLIM_BPR_Cython_Epoch(URM_mask, train_with_sparse_weights = True, topK = 100,
+                                                sgd_mode = 'adagrad', learning_rate = 1e-2,
+                                                sparse_weights_structure = sparse_weights_structure)
+
+            start_time = time.time()
+            cythonEpoch.epochIteration_Cython()
+            elapsed_time = time.time() - start_time
+
+            print("Sparse weights structure '{}': epoch requires {:.2f} sec, samples per second: {:.0f}".format(
+                sparse_weights_structure, elapsed_time, URM_mask.nnz / elapsed_time))
+
+
+
+from SLIM_BPR.Cython.SLIM_BPR_Cython_Epoch import Sparse_Matrix_Hash_CSR, Sparse_Matrix_Tree_CSR, SLIM_BPR_Cython_Epoch
+
+
+if __name__ == '__main__':
+
+    runCompilationScript()
+
+    from SLIM_BPR.Cython.SLIM_BPR_Cython_Epoch import Sparse_Matrix_Hash_CSR, Sparse_Matrix_Tree_CSR, SLIM_BPR_Cython_Epoch
+
+    unittest.main()
@@ -40,7 +40,8 @@ extensionName = re.sub("\.pyx", "", fileToCompile)
 
 ext_modules = Extension(extensionName,
                 [fileToCompile],
-                extra_compile_args=['-O3'],
+                extra_compile_args=['-O3', '-fopenmp'],
+                extra_link_args=['-fopenmp'],
                 include_dirs=[numpy.get_include(),],
                 )
 
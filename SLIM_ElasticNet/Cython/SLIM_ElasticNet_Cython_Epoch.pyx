@@ -15,253 +15,321 @@ Created on 07/09/17
 
 #defining NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 
-from Base.Recommender_utils import similarityMatrixTopK, check_matrix
+from Base.Recommender_utils import check_matrix
 import numpy as np
 cimport numpy as np
+cimport cython
+import scipy.sparse as sps
 import time
 import sys
 
-from libc.math cimport exp, sqrt
-from libc.stdlib cimport rand, RAND_MAX
+from libc.math cimport fabs
 
+from cython.parallel import prange, threadid
 
-cdef struct SGD_sample:
-    long user
-    long item
-    double value
 
-cdef class SLIM_ElasticNet_Cython:
 
-    cdef int n_users
-    cdef int n_items
-    cdef int numPositiveIteractions
-    cdef int topK
-    cdef int useAdaGrad, rmsprop
 
-    cdef float learning_rate
+cdef inline void heap_sift_down(float * heap_data, int * heap_indices, long heap_size, long position) nogil:
+    """
+    Moves the element in the given position down the min-heap until both its children are greater or equal
+    """
 
-    cdef long[:] eligibleUsers
-    cdef long numEligibleUsers
+    cdef long child
+    cdef float data = heap_data[position]
+    cdef int index = heap_indices[position]
 
-    cdef int[:] seenItemsSampledUser
-    cdef int numSeenItemsSampledUser
+    while 2*position + 1 < heap_size:
 
-    cdef int[:] URM_train_indices, URM_train_indptr
-    cdef double[:], URM_train_data
+        child = 2*position + 1
 
+        if child + 1 < heap_size and heap_data[child + 1] < heap_data[child]:
+            child += 1
 
-    cdef S_sparse
-    cdef double[:,:] S_dense
+        if heap_data[child] >= data:
+            break
 
+        heap_data[position] = heap_data[child]
+        heap_indices[position] = heap_indices[child]
+        position = child
 
-    def __init__(self, URM_train,
-                 learning_rate = 0.05,
-                 topK=100, sgd_mode='adagrad'):
+    heap_data[position] = data
+    heap_indices[position] = index
 
-        super(SLIM_ElasticNet_Cython, self).__init__()
 
-        URM_train = check_matrix(URM_train, 'csr')
 
-        self.numPositiveIteractions = int(URM_train.nnz * 1)
-        self.n_users = URM_train.shape[0]
-        self.n_items = URM_train.shape[1]
-        self.topK = topK
 
-        self.URM_train_indices = URM_train.indices
-        self.URM_train_indptr = URM_train.indptr
-        self.URM_train_data = np.array(URM_train.data, dtype=float)
+@cython.final
+cdef class SLIM_ElasticNet_Cython_Epoch:
+    """
+    Cyclic coordinate descent solver of the ElasticNet model of each item, with the same objective as
+    sklearn ElasticNet with alpha = 1.0 and l1_ratio = l1_penalty / (l1_penalty + l2_penalty):
 
+        1 / (2 * n_users) * ||y - X w||^2 + l1_ratio * ||w||_1 + 0.5 * (1 - l1_ratio) * ||w||^2
 
-        if sgd_mode=='adagrad':
-            self.useAdaGrad = True
-        elif sgd_mode=='rmsprop':
-            self.rmsprop = True
-        elif sgd_mode=='sgd':
-            pass
-        else:
-            raise ValueError(
-                "SGD_mode not valid. Acceptable values are: 'sgd', 'adagrad', 'rmsprop'. Provided value was '{}'".format(
-                    sgd_mode))
+    where y is the column of the item and X the URM without it.
+    Each model only reads the CSC URM and keeps its own residual, therefore the items are fitted in parallel
+    with n_threads, and only the topK highest coefficients of each item are kept.
+    """
 
+    cdef int n_users
+    cdef int n_items
+    cdef int topK
+    cdef int positive_only
+    cdef int max_iter
+    cdef int n_threads
 
+    cdef double l1_reg, l2_reg, tol
 
-        self.learning_rate = learning_rate
+    cdef int[:] URM_csc_indices, URM_csc_indptr
+    cdef double[:] URM_csc_data
 
+    cdef int[:] URM_csr_indices, URM_csr_indptr
 
-    # Using memoryview instead of the sparse matrix itself allows for much faster access
-    cdef int[:] getSeenItems(self, long index):
-        return self.URM_mask_indices[self.URM_mask_indptr[index]:self.URM_mask_indptr[index + 1]]
+    cdef double[:] column_norms
 
+    # Buffers of each thread
+    cdef double[:,:] residual, coef
+    cdef int[:,:] features, feature_marker
 
+    # topK coefficients of each item, stored in consecutive blocks of topK cells
+    cdef int[:] W_rows, W_count
+    cdef float[:] W_values
 
-    def epochIteration_Cython(self):
 
-        cdef long start_time_epoch = time.time()
-        cdef long start_time_batch = time.time()
 
-        cdef SGD_sample sample
-        cdef long index, seenItem, numCurrentSample, itemId
-        cdef float gradient
+    def __init__(self, URM_train, l1_penalty = 0.1, l2_penalty = 0.1, positive_only = True, topK = 100,
+                 max_iter = 100, tol = 1e-4, n_threads = 1):
 
-        cdef int numSeenItems
-        cdef int printStep
+        super(SLIM_ElasticNet_Cython_Epoch, self).__init__()
 
-        if self.sparse_weights:
-            printStep = 500000
-        else:
-            printStep = 5000000
+        URM_csc = check_matrix(URM_train, 'csc', dtype=np.float64)
+        URM_csc.sort_indices()
 
-        # Variables for AdaGrad and RMSprop
-        cdef double [:] sgd_cache
-        cdef double cacheUpdate
-        cdef float gamma
+        self.n_users = URM_csc.shape[0]
+        self.n_items = URM_csc.shape[1]
+        self.topK = min(topK, self.n_items)
+        self.positive_only = positive_only
+        self.max_iter = max_iter
+        self.tol = tol
+        self.n_threads = n_threads
 
-        if self.useAdaGrad:
-            sgd_cache = np.zeros((self.n_items), dtype=float)
+        l1_ratio = l1_penalty / (l1_penalty + l2_penalty)
 
-        elif self.rmsprop:
-            sgd_cache = np.zeros((self.n_items), dtype=float)
-            gamma = 0.001
+        # Same scaling of sklearn, whose loss is divided by the number of samples
+        self.l1_reg = l1_ratio * self.n_users
+        self.l2_reg = (1.0 - l1_ratio) * self.n_users
 
+        self.URM_csc_indices = URM_csc.indices.astype(np.int32)
+        self.URM_csc_indptr = URM_csc.indptr.astype(np.int32)
+        self.URM_csc_data = URM_csc.data
 
+        # Used to find the items co-occurring with the target
+        URM_csr = URM_csc.tocsr()
+        self.URM_csr_indices = URM_csr.indices.astype(np.int32)
+        self.URM_csr_indptr = URM_csr.indptr.astype(np.int32)
 
-        # Uniform user sampling without replacement
-        for numCurrentSample in range(self.numPositiveIteractions):
+        self.column_norms = np.asarray(URM_csc.power(2).sum(axis=0), dtype=np.float64).ravel()
 
-            sample = self.sampleBatch_Cython()
+        self.residual = np.zeros((n_threads, self.n_users), dtype=np.float64)
+        self.coef = np.zeros((n_threads, self.n_items), dtype=np.float64)
+        self.features = np.zeros((n_threads, self.n_items), dtype=np.int32)
+        self.feature_marker = np.full((n_threads, self.n_items), -1, dtype=np.int32)
 
+        self.W_rows = np.zeros(self.n_items * self.topK, dtype=np.int32)
+        self.W_values = np.zeros(self.n_items * self.topK, dtype=np.float32)
+        self.W_count = np.zeros(self.n_items, dtype=np.int32)
 
-            x_uij = 0.0
 
-            # The difference is computed on the user_seen items
 
-            index = 0
-            while index<self.numSeenItemsSampledUser:
 
-                seenItem = self.seenItemsSampledUser[index]
-                index +=1
+    def fit_items(self, verbose = True):
+        """
+        Fits the models of all items, using n_threads
+        :return: csc items x items with the topK coefficients of the model of item j in column j
+        """
 
-                #print("Get: i {}, j {}, seenItem {}".format(i, j, seenItem))
+        cdef int n_items = self.n_items
+        cdef int block_size = max(1, min(1000, n_items))
+        cdef int start_item, end_item, current_item
 
-                if self.sparse_weights:
+        start_time = time.time()
 
-                   x_uij += self.S_sparse.get_value(i, seenItem) - self.S_sparse.get_value(j, seenItem)
-                else:
-                    x_uij += self.S_dense[i, seenItem] - self.S_dense[j, seenItem]
+        for start_item in range(0, n_items, block_size):
 
+            end_item = min(start_item + block_size, n_items)
 
-            gradient = 1 / (1 + exp(x_uij))
+            with nogil:
+                for current_item in prange(start_item, end_item, schedule='dynamic', num_threads=self.n_threads):
+                    self.fit_item(current_item, threadid())
 
-            if self.useAdaGrad:
-                cacheUpdate = gradient ** 2
+            if verbose:
+                print("Processed {} ( {:.2f}% ) in {:.2f} minutes. Items per second: {:.0f}".format(
+                    end_item,
+                    100.0 * float(end_item) / n_items,
+                    (time.time() - start_time) / 60,
+                    float(end_item) / (time.time() - start_time)))
 
-                sgd_cache[i] += cacheUpdate
-                sgd_cache[j] += cacheUpdate
+                sys.stdout.flush()
+                sys.stderr.flush()
 
-                gradient = gradient / (sqrt(sgd_cache[i]) + 1e-8)
 
-            elif self.rmsprop:
-                cacheUpdate = sgd_cache[i] * gamma + (1 - gamma) * gradient ** 2
+        W_count = np.array(self.W_count)
 
-                sgd_cache[i] += cacheUpdate
-                sgd_cache[j] += cacheUpdate
+        # Cells of each item block beyond its count are not used
+        cell_mask = np.arange(self.topK) < W_count[:, None]
 
-                gradient = gradient / (sqrt(sgd_cache[i]) + 1e-8)
+        indptr = np.zeros(n_items + 1, dtype=np.int32)
+        np.cumsum(W_count, out=indptr[1:])
 
+        W_sparse = sps.csc_matrix((np.array(self.W_values)[cell_mask.ravel()],
+                                   np.array(self.W_rows)[cell_mask.ravel()],
+                                   indptr), shape=(n_items, n_items))
 
+        W_sparse.sort_indices()
 
+        return W_sparse
 
 
-            index = 0
-            while index < self.numSeenItemsSampledUser:
 
-                seenItem = self.seenItemsSampledUser[index]
-                index +=1
 
-                if self.sparse_weights:
+    cdef int select_features(self, int target_item, int thread_id) nogil:
+        """
+        Collects in the features buffer of the thread the items whose coefficient can be nonzero.
+        With positive_only and non negative data the gradient of the items that never co-occur with the target
+        is non positive, so their coefficient stays zero and only the co-occurring items are used
+        :return: number of features
+        """
 
-                    if seenItem != i:
-                        self.S_sparse.add_value(i, seenItem, self.learning_rate * gradient)
+        cdef int n_features = 0
+        cdef int item, user_index, item_index, user
 
-                    if seenItem != j:
-                        self.S_sparse.add_value(j, seenItem, -self.learning_rate * gradient)
+        if not self.positive_only:
 
-                else:
+            for item in range(self.n_items):
+                if item != target_item and self.column_norms[item] > 0.0:
+                    self.features[thread_id, n_features] = item
+                    n_features += 1
 
-                    if seenItem != i:
-                        self.S_dense[i, seenItem] += self.learning_rate * gradient
+            return n_features
 
-                    if seenItem != j:
-                        self.S_dense[j, seenItem] -= self.learning_rate * gradient
 
+        for user_index in range(self.URM_csc_indptr[target_item], self.URM_csc_indptr[target_item + 1]):
 
-            # If I have reached at least 20% of the total number of batches or samples
-            if numCurrentBatch % (totalNumberOfBatch/5) == 0 and numCurrentBatch!=0:
-                self.S_sparse.rebalance_tree(TopK=self.topK)
-                #print("Num batch is {}, rebalancing matrix".format(numCurrentBatch))
+            user = self.URM_csc_indices[user_index]
 
+            for item_index in range(self.URM_csr_indptr[user], self.URM_csr_indptr[user + 1]):
 
-            if((numCurrentBatch%printStep==0 and not numCurrentBatch==0) or numCurrentBatch==totalNumberOfBatch-1):
-                print("Processed {} ( {:.2f}% ) in {:.2f} seconds. Sample per second: {:.0f}".format(
-                    numCurrentBatch*self.batch_size,
-                    100.0* float(numCurrentBatch*self.batch_size)/self.numPositiveIteractions,
-                    time.time() - start_time_batch,
-                    float(numCurrentBatch*self.batch_size + 1) / (time.time() - start_time_epoch)))
+                item = self.URM_csr_indices[item_index]
 
-                sys.stdout.flush()
-                sys.stderr.flush()
+                # The marker contains the last target that selected the item, so it never needs to be cleared
+                if item != target_item and self.feature_marker[thread_id, item] != target_item:
+                    self.feature_marker[thread_id, item] = target_item
+                    self.features[thread_id, n_features] = item
+                    n_features += 1
 
-                start_time_batch = time.time()
+        return n_features
 
 
-        # FIll diagonal with zeros
 
-        index = 0
-        while index < self.n_items:
 
-            if self.sparse_weights:
-                self.S_sparse.add_value(index, index, -self.S_sparse.get_value(index, index))
-            else:
-                self.S_dense[index, index] = 0.0
+    cdef void fit_item(self, int target_item, int thread_id) nogil:
+
+        cdef int n_features, feature_index, item, index, n_iter
+        cdef int heap_size
+        cdef double gradient, coef_old, coef_new, delta, max_delta, max_coef
+        cdef float * heap_data
+        cdef int * heap_indices
+
+        n_features = self.select_features(target_item, thread_id)
+
+        # The residual of the all zero model is the target column
+        for index in range(self.URM_csc_indptr[target_item], self.URM_csc_indptr[target_item + 1]):
+            self.residual[thread_id, self.URM_csc_indices[index]] = self.URM_csc_data[index]
+
+
+        for n_iter in range(self.max_iter):
+
+            max_delta = 0.0
+            max_coef = 0.0
+
+            for feature_index in range(n_features):
+
+                item = self.features[thread_id, feature_index]
+                coef_old = self.coef[thread_id, item]
+
+                # Gradient with the contribution of the item removed from the residual
+                gradient = coef_old * self.column_norms[item]
+
+                for index in range(self.URM_csc_indptr[item], self.URM_csc_indptr[item + 1]):
+                    gradient += self.URM_csc_data[index] * self.residual[thread_id, self.URM_csc_indices[index]]
+
+                # Soft thresholding
+                if self.positive_only and gradient < 0.0:
+                    coef_new = 0.0
+                elif gradient > self.l1_reg:
+                    coef_new = (gradient - self.l1_reg) / (self.column_norms[item] + self.l2_reg)
+                elif gradient < -self.l1_reg:
+                    coef_new = (gradient + self.l1_reg) / (self.column_norms[item] + self.l2_reg)
+                else:
+                    coef_new = 0.0
 
-            index+=1
+                delta = coef_new - coef_old
 
+                if delta != 0.0:
+                    self.coef[thread_id, item] = coef_new
 
+                    for index in range(self.URM_csc_indptr[item], self.URM_csc_indptr[item + 1]):
+                        self.residual[thread_id, self.URM_csc_indices[index]] -= delta * self.URM_csc_data[index]
 
-        if self.topK == False:
-            print("Return S matrix to python caller")
+                if fabs(delta) > max_delta:
+                    max_delta = fabs(delta)
 
-            if self.sparse_weights:
-                return self.S_sparse.get_scipy_csr(TopK = False)
-            else:
-                return np.array(self.S_dense)
+                if fabs(coef_new) > max_coef:
+                    max_coef = fabs(coef_new)
 
+            # Stop when the largest coefficient update is small relative to the largest coefficient,
+            # unlike sklearn the duality gap is not checked
+            if max_coef == 0.0 or max_delta / max_coef < self.tol:
+                break
 
-        else :
-            print("Return S matrix to python caller")
 
-            if self.sparse_weights:
-                return self.S_sparse.get_scipy_csr(TopK=self.topK)
-            else:
-                return similarityMatrixTopK(np.array(self.S_dense.T), k=self.topK, forceSparseOutput=True, inplace=True).T
+        # Keep the topK coefficients with a min-heap stored directly in the block of the item
+        heap_data = &self.W_values[target_item * self.topK]
+        heap_indices = &self.W_rows[target_item * self.topK]
+        heap_size = 0
 
+        for feature_index in range(n_features):
 
+            item = self.features[thread_id, feature_index]
+            coef_new = self.coef[thread_id, item]
 
+            if coef_new == 0.0:
+                continue
 
-    cdef SGD_sample sampleBatch_Cython(self):
+            if heap_size < self.topK:
+                heap_data[heap_size] = <float> coef_new
+                heap_indices[heap_size] = item
+                heap_size += 1
 
-        cdef SGD_sample sample = SGD_sample(-1,-1,-1.0)
-        cdef long index
-        cdef int numSeenItems
+                if heap_size == self.topK:
+                    index = heap_size/2 - 1
+                    while index >= 0:
+                        heap_sift_down(heap_data, heap_indices, heap_size, index)
+                        index -= 1
 
-        sample.user = rand() % self.n_users
+            elif coef_new > heap_data[0]:
+                heap_data[0] = <float> coef_new
+                heap_indices[0] = item
+                heap_sift_down(heap_data, heap_indices, heap_size, 0)
 
-        numSeenItems = self.URM_train_indptr[sample.user+1] - self.URM_train_indptr[sample.user]
+            # Clear the buffers for the next item
+            self.coef[thread_id, item] = 0.0
 
-        index = rand() % numSeenItems
+        self.W_count[target_item] = heap_size
 
-        sample.item = self.URM_train_indices[self.URM_train_indptr[sample.user] + index]
-        sample.value = self.URM_train_data[self.URM_train_indptr[sample.user] + index]
 
-        return sample
+        # Clear the residual for the next item
+        for index in range(self.n_users):
+            self.residual[thread_id, index] = 0.0
 
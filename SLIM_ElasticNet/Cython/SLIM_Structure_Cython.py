@@ -36,7 +36,7 @@ class SLIM_Structure_Cython(Similarity_Matrix_Recommender, Recommender):
     RECOMMENDER_NAME = "SLIM_Structure_Recommender"
 
     INIT_TYPE_VALUES = ["random", "one", "zero", "copy_similarity"]
-    STRUCTURE_MODE_VALUES = ["full", "similarity"]#, "common_feature"]
+    STRUCTURE_MODE_VALUES = ["full", "similarity", "common_feature"]
 
 
     def __init__(self, URM_train, ICM = None, URM_validation = None,
@@ -80,7 +80,7 @@ class SLIM_Structure_Cython(Similarity_Matrix_Recommender, Recommender):
             structure_mode = "full", init_type = "random", loss = "mse", force_positive = False,
             sgd_mode='adam', gamma=0.995, beta_1=0.9, beta_2=0.999,
             stop_on_validation = False, lower_validatons_allowed = 5, validation_metric = "map",
-            validation_function = None, validation_every_n = 1):
+            validation_function = None, validation_every_n = 1, n_threads = 1):
 
 
 
@@ -135,7 +135,8 @@ class SLIM_Structure_Cython(Similarity_Matrix_Recommender, Recommender):
                                                        sgd_mode=sgd_mode,
                                                        gamma=gamma,
                                                        beta_1=beta_1,
-                                                       beta_2=beta_2)
+                                                       beta_2=beta_2,
+                                                       n_threads = n_threads)
 
 
 
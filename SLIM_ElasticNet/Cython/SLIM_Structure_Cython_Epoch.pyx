@@ -17,12 +17,11 @@ Created on 31/03/18
 
 import numpy as np
 cimport numpy as np
-
-# PyMem malloc and free are slightly faster than plain C equivalents as they optimize OS calls
-from cpython.mem cimport PyMem_Malloc, PyMem_Free
+cimport cython
 
 from libc.math cimport exp, sqrt
-from libc.stdlib cimport rand, RAND_MAX
+
+from cython.parallel import prange, threadid
 
 
 
@@ -35,35 +34,77 @@ import scipy.sparse as sps
 
 
 
+cdef inline np.uint64_t xorshift_rand(np.uint64_t * rng_state) nogil:
+    """
+    Xorshift64 random generator, each thread has its own state, which must not be 0
+    """
+
+    rng_state[0] ^= rng_state[0] << 13
+    rng_state[0] ^= rng_state[0] >> 7
+    rng_state[0] ^= rng_state[0] << 17
+
+    return rng_state[0]
+
+
+
+cdef inline void heap_sift_down(double * heap_data, int * heap_indices, long heap_size, long position) nogil:
+    """
+    Moves the element in the given position down the min-heap until both its children are greater or equal
+    """
+
+    cdef long child
+    cdef double data = heap_data[position]
+    cdef int index = heap_indices[position]
+
+    while 2*position + 1 < heap_size:
+
+        child = 2*position + 1
 
+        if child + 1 < heap_size and heap_data[child + 1] < heap_data[child]:
+            child += 1
 
-cdef struct BPR_sample:
-    long user
-    long pos_item
-    long neg_item
-    long seen_items_start_pos
-    long seen_items_end_pos
+        if heap_data[child] >= data:
+            break
 
+        heap_data[position] = heap_data[child]
+        heap_indices[position] = heap_indices[child]
+        position = child
 
-cdef struct MSE_sample:
-    long user
-    long item
-    long rating
-    long seen_items_start_pos
-    long seen_items_end_pos
+    heap_data[position] = data
+    heap_indices[position] = index
 
 
 
 
+# Columns of the per-thread statistics
+DEF STAT_SAMPLES = 0
+DEF STAT_LOSS = 1
+DEF STAT_USABLE = 2
+DEF STAT_OVERALL = 3
+
+
+
+@cython.final
 cdef class SLIM_Structure_Cython_Epoch:
+    """
+    The similarities of each item are learned independently, only on the neighbours allowed by the structure.
+    The allowed (item, neighbour) pairs are computed once as a CSR, the similarities of the "similarity" and
+    "common_feature" modes are stored aligned to it. The "full" structure allows every neighbour and is not
+    materialized, the position of a neighbour is its item id.
 
+    Each thread trains one item at a time on its own buffers, which are only as large as the allowed neighbours,
+    therefore items are trained in parallel with n_threads
+    """
 
     cdef int[:] S_indices, S_indptr
-    cdef int[:] ICM_indices, ICM_indptr
     cdef double[:] S_data
 
     cdef double[:,:] S_dense
 
+    # Allowed neighbours of each item, sorted
+    cdef int[:] structure_indices, structure_indptr
+    cdef int max_neighbours
+
     cdef int[:] URM_indices, URM_indptr
     cdef double[:] URM_data
     cdef double[:] user_bias
@@ -73,30 +114,33 @@ cdef class SLIM_Structure_Cython_Epoch:
 
     cdef double learning_rate, lambda_1, lambda_2
 
-    cdef int n_items, n_users, n_features
+    cdef int n_items, n_users, n_threads
 
     cdef int topK, batch_size
 
     # Structure
     cdef int structure_full, structure_common_feature, structure_similarity
-    cdef int[:] common_feature_mask, common_feature_item_id
 
 
     # Adaptive gradient
     cdef int useAdaGrad, useRmsprop, useAdam
 
-    cdef double [:] sgd_cache
     cdef double gamma
+    cdef double beta_1, beta_2
+
 
-    cdef double [:] sgd_cache_momentum_1, sgd_cache_momentum_2
-    cdef double beta_1, beta_2, beta_1_power_t, beta_2_power_t
-    cdef double momentum_1, momentum_2
+    # Buffers of each thread, the neighbour position is -1 for the items not allowed for the current item
+    cdef int[:,:] neighbour_position, sample_shuffle
+    cdef double[:,:] Si_weights
+    cdef double[:,:] sgd_cache, sgd_cache_momentum_1, sgd_cache_momentum_2
+    cdef double[:,:] thread_statistics
+    cdef np.uint64_t[:] rng_state
 
 
     def __init__(self, URM, S_structure = None, ICM = None, topK = 100, learning_rate=0.001, batch_size = 1,
                  lambda_1=0.001, lambda_2=0.001,
                  init_type = "random", structure_mode = "full",
-                 sgd_mode='adam', gamma=0.995, beta_1=0.9, beta_2=0.999):
+                 sgd_mode='adam', gamma=0.995, beta_1=0.9, beta_2=0.999, n_threads = 1):
         """
 
         :param S_structure:
@@ -105,6 +149,7 @@ cdef class SLIM_Structure_Cython_Epoch:
         :param b:
         :param g:
         :param init_type:
+        :param n_threads: number of items trained in parallel
         """
 
         #python compileCython.py SLIM_Structure_Cython_Epoch.pyx build_ext --inplace
@@ -112,9 +157,11 @@ cdef class SLIM_Structure_Cython_Epoch:
         self.batch_size = batch_size
         self.lambda_1 = lambda_1
         self.lambda_2 = lambda_2
+        self.n_threads = n_threads
 
 
         URM = check_matrix(URM, "csr")
+        URM.sort_indices()
         self.URM_indices = np.array(URM.indices, dtype=np.int32)
         self.URM_indptr = np.array(URM.indptr, dtype=np.int32)
         self.URM_data = np.array(URM.data, dtype=np.float64)
@@ -143,6 +190,8 @@ cdef class SLIM_Structure_Cython_Epoch:
             if self.topK > self.n_items:
                 self.topK = self.n_items
 
+            self.max_neighbours = self.n_items
+
             if self.topK == False:
 
                 if init_type == "copy_similarity":
@@ -161,12 +210,7 @@ cdef class SLIM_Structure_Cython_Epoch:
                 self.S_indices = np.zeros(self.n_items*self.topK, dtype=np.int32)
 
                 # Indptr contais the position at which an item begins, always topK steps
-                self.S_indptr = np.zeros(self.n_items + 1, dtype=np.int32)
-
-                for item_id in range(self.n_items):
-                    self.S_indptr[item_id] = item_id*self.topK
-
-                self.S_indptr[self.n_items] = len(self.S_indices)
+                self.S_indptr = np.arange(0, self.n_items*self.topK + 1, self.topK, dtype=np.int32)
 
 
                 if init_type == "copy_similarity":
@@ -179,21 +223,35 @@ cdef class SLIM_Structure_Cython_Epoch:
                     self.S_data = np.zeros(self.n_items*self.topK, dtype=np.float64)
                 else:
                     raise ValueError("SLIM_Structure_Cython_Epoch: 'init_type' not recognized")
-        #
-        # elif structure_mode == "common_feature":
-        #
-        #     if ICM is None:
-        #         raise ValueError("SLIM_Structure_Cython_Epoch: 'structure_mode' is 'common_feature' but no 'ICM' was provided")
-        #
-        #     self.structure_common_feature = True
-        #
-        #     ICM = check_matrix(ICM, "csr")
-        #     self.ICM_indices = np.array(ICM.indices, dtype=np.int32)
-        #     self.ICM_indptr = np.array(ICM.indptr, dtype=np.int32)
-        #
-        #     self.n_features = ICM.shape[1]
-        #     self.common_feature_mask = np.zeros(self.n_features, dtype=np.int32)
-        #
+
+
+        elif structure_mode == "common_feature":
+
+            if ICM is None:
+                raise ValueError("SLIM_Structure_Cython_Epoch: 'structure_mode' is 'common_feature' but no 'ICM' was provided")
+
+            self.structure_common_feature = True
+
+            # Items having at least a common feature
+            ICM = check_matrix(ICM, "csr", dtype=np.float32)
+            ICM.data = np.ones_like(ICM.data)
+
+            S_structure = check_matrix(ICM.dot(ICM.T), "csr")
+            S_structure = S_structure - sps.diags(S_structure.diagonal(), format="csr")
+            S_structure.eliminate_zeros()
+            S_structure.sort_indices()
+
+            self._set_structure(S_structure)
+
+            if init_type == "random":
+                self.S_data = np.random.normal(0.001, 0.1, (S_structure.nnz)).astype(np.float64)
+            elif init_type == "one":
+                self.S_data = np.ones(S_structure.nnz, dtype=np.float64)
+            elif init_type == "zero":
+                self.S_data = np.zeros(S_structure.nnz, dtype=np.float64)
+            else:
+                raise ValueError("SLIM_Structure_Cython_Epoch: 'init_type' not recognized")
+
 
         elif structure_mode == "similarity":
 
@@ -203,8 +261,9 @@ cdef class SLIM_Structure_Cython_Epoch:
             self.structure_similarity = True
 
             S_structure = check_matrix(S_structure, "csr")
-            self.S_indices = np.array(S_structure.indices, dtype=np.int32)
-            self.S_indptr = np.array(S_structure.indptr, dtype=np.int32)
+            S_structure.sort_indices()
+
+            self._set_structure(S_structure)
 
             if init_type == "copy_similarity":
                 self.S_data = np.array(S_structure.data, dtype=np.float64)
@@ -256,6 +315,45 @@ cdef class SLIM_Structure_Cython_Epoch:
 
 
 
+        # Buffers of each thread
+        if self.structure_full:
+            # All items are allowed, the position of each neighbour is its id
+            self.neighbour_position = np.tile(np.arange(self.n_items, dtype=np.int32), (self.n_threads, 1))
+        else:
+            self.neighbour_position = np.full((self.n_threads, self.n_items), -1, dtype=np.int32)
+
+        max_item_interactions = max(1, np.ediff1d(self.URM_indptr_csc).max(initial=0))
+
+        self.sample_shuffle = np.zeros((self.n_threads, max_item_interactions), dtype=np.int32)
+        self.Si_weights = np.zeros((self.n_threads, self.max_neighbours), dtype=np.float64)
+
+        self.sgd_cache = np.zeros((self.n_threads, self.max_neighbours), dtype=np.float64)
+
+        if self.useAdam:
+            self.sgd_cache_momentum_1 = np.zeros((self.n_threads, self.max_neighbours), dtype=np.float64)
+            self.sgd_cache_momentum_2 = np.zeros((self.n_threads, self.max_neighbours), dtype=np.float64)
+
+        self.thread_statistics = np.zeros((self.n_threads, 4), dtype=np.float64)
+
+
+
+
+    def _set_structure(self, S_structure):
+        """
+        Stores the structure of the given CSR as the allowed neighbours of each item, the similarities are
+        stored aligned to it
+        """
+
+        self.structure_indices = np.array(S_structure.indices, dtype=np.int32)
+        self.structure_indptr = np.array(S_structure.indptr, dtype=np.int32)
+
+        self.S_indices = self.structure_indices
+        self.S_indptr = self.structure_indptr
+
+        self.max_neighbours = max(1, np.ediff1d(S_structure.indptr).max(initial=0))
+
+
+
 
     def epochIteration_Cython(self, epochs=30, loss = "mse", force_positive = False, sample_quota = 0.10):
 
@@ -271,202 +369,154 @@ cdef class SLIM_Structure_Cython_Epoch:
 
 
 
-    cdef init_S_structure_current_item(self, int current_item, int* Si_mask, double* Si_dense):
+
+    cdef int init_S_structure_current_item(self, int current_item, int thread_id) nogil:
         """
-        The function initializes the dense similarity vector for current item from the global data structure
+        The function loads the similarities of the current item in the buffer of the thread, in the order of its
+        allowed neighbours
         IMPORTANT: the similarity matrix has similarities for item i in row i
+        :return: number of allowed neighbours
         """
 
-        cdef int item_index, item_id
-        cdef int feature_index, feature_id
-
-        cdef int[:] S_current_item_indices
-        cdef double[:] S_current_item_data
-
-        cdef int[:] current_item_features, other_item_features
-        cdef int has_a_common_feature
-
-        #
-        # if self.structure_common_feature:
-        #
-        #     # Accept all items having at least a common feature
-        #     S_current_item_data = np.random.normal(0.001, 0.1, (self.n_items)).astype(np.float64)
-        #
-        #     # Set current item features
-        #
-        #     current_item_features = self.ICM_indices[self.ICM_indptr[current_item]:self.ICM_indptr[current_item + 1]]
-        #
-        #     for feature_index in range(len(current_item_features)):
-        #         feature_id = current_item_features[feature_index]
-        #
-        #         self.common_feature_mask[feature_id] = True
-        #
-        #
-        #     for item_id in range(self.n_items):
-        #
-        #         other_item_features = self.ICM_indices[self.ICM_indptr[item_id]:self.ICM_indptr[item_id + 1]]
-        #
-        #         has_a_common_feature = False
-        #
-        #         # Check its features against the ones of the current_item
-        #         for feature_index in range(len(other_item_features)):
-        #             feature_id = current_item_features[feature_index]
-        #
-        #             # As soon as I find one, terminate
-        #             if self.common_feature_mask[feature_id]:
-        #                 has_a_common_feature = True
-        #                 break
-        #
-        #
-        #         if has_a_common_feature:
-        #             Si_mask[item_id] = True
-        #             Si_dense[item_id] = S_current_item_data[item_id]
-        #
-        #
-        #     # Clean feature_mask
-        #     for feature_index in range(len(current_item_features)):
-        #         feature_id = current_item_features[feature_index]
-        #
-        #         self.common_feature_mask[feature_id] = False
-
-
+        cdef int item_index, item_id, start_pos
 
         if self.structure_full and not self.topK:
 
-
             for item_id in range(self.n_items):
+                self.Si_weights[thread_id, item_id] = self.S_dense[current_item, item_id]
 
-                Si_mask[item_id] = True
-                Si_dense[item_id] = self.S_dense[current_item, item_id]
-
+            return self.n_items
 
-        else:
-            # Structure_similarity and structure_dense topK behave in a sligthly different way
 
-            S_current_item_indices = self.S_indices[self.S_indptr[current_item]:self.S_indptr[current_item + 1]]
-            S_current_item_data = self.S_data[self.S_indptr[current_item]:self.S_indptr[current_item + 1]]
+        elif self.structure_full:
 
+            # All cells are available, not only those associated to a neighbor value
+            for item_id in range(self.n_items):
+                self.Si_weights[thread_id, item_id] = 0.0
 
-            # If structure full, all mask cells must be true, not only those associated to a
-            # neighbor value
-            if self.structure_full and self.topK:
+            for item_index in range(self.S_indptr[current_item], self.S_indptr[current_item + 1]):
+                self.Si_weights[thread_id, self.S_indices[item_index]] = self.S_data[item_index]
 
-                for item_id in range(self.n_items):
+            return self.n_items
 
-                    Si_mask[item_id] = True
-                    Si_dense[item_id] = 0.0
 
+        # Structure similarity and common feature, only this specific set of cells is available
+        start_pos = self.structure_indptr[current_item]
 
-            # If structure similarity, only this specific set of cells is available
-            for item_index in range(len(S_current_item_indices)):
+        for item_index in range(self.structure_indptr[current_item + 1] - start_pos):
 
-                item_id = S_current_item_indices[item_index]
+            item_id = self.structure_indices[start_pos + item_index]
 
-                Si_mask[item_id] = True
-                Si_dense[item_id] = S_current_item_data[item_index]
+            self.neighbour_position[thread_id, item_id] = item_index
+            self.Si_weights[thread_id, item_index] = self.S_data[start_pos + item_index]
 
+        return self.structure_indptr[current_item + 1] - start_pos
 
 
 
 
-    cdef clear_and_save_S_structure_current_item(self, int current_item, int* Si_mask, double* Si_dense):
+    cdef void clear_and_save_S_structure_current_item(self, int current_item, int thread_id) nogil:
         """
         The function copies the similarities of the current item into the final data structure
         IMPORTANT: the similarity matrix has similarities for item i in row i
         """
 
-        cdef int item_index, item_id
-        cdef int num_S_items, start_pos
+        cdef int item_index, item_id, start_pos
+        cdef double * heap_data
+        cdef int * heap_indices
 
-        cdef int[:] S_current_item_indices
 
-        cdef np.ndarray[np.float64_t, ndim=1] item_similarity_np
-        cdef np.ndarray[long, ndim=1] relevant_items_partition, relevant_items_partition_sorting, ranking
+        if self.structure_full and not self.topK:
 
+            for item_id in range(self.n_items):
+                self.S_dense[current_item, item_id] = self.Si_weights[thread_id, item_id]
 
-        if self.structure_similarity:
 
-            S_current_item_indices = self.S_indices[self.S_indptr[current_item]:self.S_indptr[current_item + 1]]
+        elif self.structure_full:
 
-            for item_index in range(len(S_current_item_indices)):
+            # Keep the topK similarities with a min-heap built directly in the block of the item
+            start_pos = self.S_indptr[current_item]
 
-                item_id = S_current_item_indices[item_index]
+            heap_data = &self.S_data[start_pos]
+            heap_indices = &self.S_indices[start_pos]
 
-                Si_mask[item_id] = False
+            for item_id in range(self.topK):
+                heap_data[item_id] = self.Si_weights[thread_id, item_id]
+                heap_indices[item_id] = item_id
 
-                self.S_data[self.S_indptr[current_item] + item_index] = Si_dense[item_id]
-                Si_dense[item_id] = 0.0
+            item_index = self.topK/2 - 1
+            while item_index >= 0:
+                heap_sift_down(heap_data, heap_indices, self.topK, item_index)
+                item_index -= 1
 
-        else:
+            for item_id in range(self.topK, self.n_items):
 
-            # structure_dense
-            if self.topK == False:
+                if self.Si_weights[thread_id, item_id] > heap_data[0]:
+                    heap_data[0] = self.Si_weights[thread_id, item_id]
+                    heap_indices[0] = item_id
+                    heap_sift_down(heap_data, heap_indices, self.topK, 0)
 
-                for item_id in range(self.n_items):
-                    Si_mask[item_id] = False
-                    self.S_dense[current_item, item_id] = Si_dense[item_id]
-                    Si_dense[item_id] = 0.0
 
+        else:
 
-            else:
+            start_pos = self.structure_indptr[current_item]
 
-                item_similarity_np = np.zeros(self.n_items, dtype=np.float64)
+            for item_index in range(self.structure_indptr[current_item + 1] - start_pos):
 
-                for item_id in range(self.n_items):
+                item_id = self.structure_indices[start_pos + item_index]
 
-                    item_similarity_np[item_id] = Si_dense[item_id]
+                self.neighbour_position[thread_id, item_id] = -1
+                self.S_data[start_pos + item_index] = self.Si_weights[thread_id, item_index]
 
-                    Si_mask[item_id] = False
-                    Si_dense[item_id] = 0.0
 
 
-                relevant_items_partition = (-item_similarity_np).argpartition(self.topK)[0:self.topK]
-                relevant_items_partition_sorting = np.argsort(-item_similarity_np[relevant_items_partition])
-                ranking = relevant_items_partition[relevant_items_partition_sorting]
 
+    cdef void clear_adaptive_gradient(self, int thread_id, int n_neighbours) nogil:
 
-                # Update global data structure
-                start_pos = self.S_indptr[current_item]
+        cdef int item_index
 
-                for item_index in range(self.topK):
+        for item_index in range(n_neighbours):
 
-                    item_id = ranking[item_index]
+            if self.useAdaGrad or self.useRmsprop:
+                self.sgd_cache[thread_id, item_index] = 0.0
 
-                    self.S_indices[start_pos + item_index] = item_id
-                    self.S_data[start_pos + item_index] = item_similarity_np[item_id]
+            elif self.useAdam:
+                self.sgd_cache_momentum_1[thread_id, item_index] = 0.0
+                self.sgd_cache_momentum_2[thread_id, item_index] = 0.0
 
 
 
 
-    cdef double compute_adaptive_gradient(self, int item_id, double gradient):
+    cdef double compute_adaptive_gradient(self, int thread_id, int item_index, double gradient,
+                                          double beta_1_power_t, double beta_2_power_t) nogil:
 
-        cdef double gradient_update
+        cdef double gradient_update, momentum_1, momentum_2
 
         if self.useAdaGrad:
-            self.sgd_cache[item_id] += gradient ** 2
+            self.sgd_cache[thread_id, item_index] += gradient ** 2
 
-            gradient_update = gradient / (sqrt(self.sgd_cache[item_id]) + 1e-8)
+            gradient_update = gradient / (sqrt(self.sgd_cache[thread_id, item_index]) + 1e-8)
 
 
         elif self.useRmsprop:
-            self.sgd_cache[item_id] = self.sgd_cache[item_id] * self.gamma + (1 - self.gamma) * gradient ** 2
+            self.sgd_cache[thread_id, item_index] = self.sgd_cache[thread_id, item_index] * self.gamma + (1 - self.gamma) * gradient ** 2
 
-            gradient_update = gradient / (sqrt(self.sgd_cache[item_id]) + 1e-8)
+            gradient_update = gradient / (sqrt(self.sgd_cache[thread_id, item_index]) + 1e-8)
 
 
         elif self.useAdam:
 
-            self.sgd_cache_momentum_1[item_id] = \
-                self.sgd_cache_momentum_1[item_id] * self.beta_1 + (1 - self.beta_1) * gradient
+            self.sgd_cache_momentum_1[thread_id, item_index] = \
+                self.sgd_cache_momentum_1[thread_id, item_index] * self.beta_1 + (1 - self.beta_1) * gradient
 
-            self.sgd_cache_momentum_2[item_id] = \
-                self.sgd_cache_momentum_2[item_id] * self.beta_2 + (1 - self.beta_2) * gradient**2
+            self.sgd_cache_momentum_2[thread_id, item_index] = \
+                self.sgd_cache_momentum_2[thread_id, item_index] * self.beta_2 + (1 - self.beta_2) * gradient**2
 
 
-            self.momentum_1 = self.sgd_cache_momentum_1[item_id]/ (1 - self.beta_1_power_t)
-            self.momentum_2 = self.sgd_cache_momentum_2[item_id]/ (1 - self.beta_2_power_t)
+            momentum_1 = self.sgd_cache_momentum_1[thread_id, item_index]/ (1 - beta_1_power_t)
+            momentum_2 = self.sgd_cache_momentum_2[thread_id, item_index]/ (1 - beta_2_power_t)
 
-            gradient_update = self.momentum_1/ (sqrt(self.momentum_2) + 1e-8)
+            gradient_update = momentum_1/ (sqrt(momentum_2) + 1e-8)
 
         else:
 
@@ -476,275 +526,165 @@ cdef class SLIM_Structure_Cython_Epoch:
         return gradient_update
 
 
-    cdef epochIteration_Cython_SGD(self, int n_epochs, int use_BPR, int force_positive, double sample_quota):
-
-        cdef int current_item, current_epoch
-        cdef int sample_index, sample_user
-        cdef int item_index, item_id
-        cdef double sample_rating, gradient_update, gradient, prediction, sample_quota_current_item
-        cdef int is_last_sample = False
-
-        cdef int[:] sample_indices, sample_shuffle, num_samples_to_choose
-        cdef double[:] sample_data
-
-        cdef int[:] user_profile_item_id
-        cdef double[:] user_profile_rating
-
-        cdef BPR_sample sample_bpr
-        cdef MSE_sample sample_mse
-
-        cdef long start_time = time.time()
-        cdef long last_print_time = start_time
-        cdef long processed_samples = 0, processed_samples_last_print = 0
-        cdef long print_block_size = 100
-        cdef long usable_interactions = 0, overall_interactions = 0
-        cdef double samples_per_sec, cumulative_loss = 0
-
-
-        cdef int * Si_mask = < int *> PyMem_Malloc((self.n_items) * sizeof(int))
-        cdef double * Si_dense = < double *> PyMem_Malloc((self.n_items) * sizeof(double))
-
 
 
-        for current_item in range(self.n_items):
-
-            #print("begin {}".format(time.time() - start_time))
-
-            self.init_S_structure_current_item(current_item, Si_mask, Si_dense)
-
-            #print("initialized {}".format(time.time() - start_time))
-
-            # Get the indices of the users who rated item i
-            sample_indices = self.URM_indices_csc[self.URM_indptr_csc[current_item]:self.URM_indptr_csc[current_item + 1]]
-            sample_data = self.URM_data_csc[self.URM_indptr_csc[current_item]:self.URM_indptr_csc[current_item + 1]]
-
-            if len(sample_indices) == 0:
-                continue
-
-
-
-            sample_shuffle = np.arange(0, len(sample_indices), dtype=np.int32)
-
-
-            if self.useAdaGrad:
-                self.sgd_cache = np.zeros((self.n_items), dtype=np.float64)
-
-            elif self.useRmsprop:
-                self.sgd_cache = np.zeros((self.n_items), dtype=np.float64)
-
-            elif self.useAdam:
-                self.sgd_cache_momentum_1 = np.zeros((self.n_items), dtype=np.float64)
-                self.sgd_cache_momentum_2 = np.zeros((self.n_items), dtype=np.float64)
-
-                self.momentum_1 = 0.0
-                self.momentum_2 = 0.0
-
-                self.beta_1_power_t = self.beta_1
-                self.beta_2_power_t = self.beta_2
-
-
-            # Adjust sample percentage for current item to ensure at least one is chosen
-            sample_quota_current_item = 1/len(sample_indices)
-
-            if sample_quota_current_item < sample_quota:
-                sample_quota_current_item = sample_quota
-
-
-            num_samples_to_choose = int(len(sample_indices)*1.0*sample_quota)
-
-            if num_samples_to_choose < 1:
-                num_samples_to_choose = 1
-
-
-
-
-            for current_epoch in range(n_epochs):
-
-                np.random.shuffle(sample_shuffle)
-
-                #print("sample_shuffle {}".format(time.time() - start_time))
-
-                for sample_index in range(num_samples_to_choose):
-
-
-                    sample_user = sample_indices[sample_shuffle[sample_index]]
-                    sample_rating = sample_data[sample_shuffle[sample_index]]
-
-                    user_profile_item_id = self.URM_indices[self.URM_indptr[sample_user]:self.URM_indptr[sample_user + 1]]
-                    user_profile_rating = self.URM_data[self.URM_indptr[sample_user]:self.URM_indptr[sample_user + 1]]
-
-                    #print("user_profile {}".format(time.time() - start_time))
-
-                    if use_BPR:
-
-                        prediction = 0.0
-
-                        sample_bpr = self.sampleBPR_Cython(current_item)
-
-
-                        for item_index in range(len(user_profile_item_id)):
-                            item_id = user_profile_item_id[item_index]
-
-                            overall_interactions += 1
-
-                            if Si_mask[item_id] == True and item_id != current_item:
-                                prediction += 1.0 * Si_dense[item_id]
-                                usable_interactions += 1
-
-                        gradient = 1 / (1 + exp(prediction))
-
-                        cumulative_loss += prediction**2
-
-
-                    else:   ## USE MSE
-
-                        #prediction = + self.user_bias[sample_user]
-                        prediction = 0.0
-
-                        sample_mse = self.sampleMSE_Cython(current_item)
-
-                        for item_index in range(len(user_profile_item_id)):
-                            item_id = user_profile_item_id[item_index]
-
-                            overall_interactions += 1
-
-                            if Si_mask[item_id] == True and item_id != current_item:
-                                prediction += user_profile_rating[item_index] * Si_dense[item_id]
-                                usable_interactions += 1
-
-
-                        gradient = prediction - sample_rating
-
-                        cumulative_loss += gradient**2
-
+    cdef epochIteration_Cython_SGD(self, int n_epochs, int use_BPR, int force_positive, double sample_quota):
 
+        cdef int current_item, start_item, end_item
+        cdef int block_size = max(1, min(self.n_items, 100*self.n_threads))
+        cdef int is_last_block
 
-                    #print("gradient {}".format(time.time() - start_time))
+        cdef double start_time = time.time()
+        cdef double last_print_time = start_time
+        cdef double processed_samples, samples_per_sec
 
+        self.rng_state = np.random.randint(1, np.iinfo(np.int64).max, size=self.n_threads, dtype=np.uint64)
+        self.thread_statistics[:,:] = 0.0
 
 
+        for start_item in range(0, self.n_items, block_size):
 
-                    for item_index in range(len(user_profile_item_id)):
-                        item_id = user_profile_item_id[item_index]
+            end_item = min(start_item + block_size, self.n_items)
 
-                        if Si_mask[item_id] == True and item_id != current_item:
+            with nogil:
+                for current_item in prange(start_item, end_item, schedule='dynamic', num_threads=self.n_threads):
+                    self.fit_item_SGD(current_item, threadid(), n_epochs, use_BPR, force_positive, sample_quota)
 
-                            gradient_update = self.compute_adaptive_gradient(item_id, gradient)
 
-                            if use_BPR:
-                                Si_dense[item_id] += self.learning_rate * (gradient_update - Si_dense[item_id] * self.lambda_2 - self.lambda_1)
-                            else:
-                                Si_dense[item_id] -=  self.learning_rate * (gradient_update * user_profile_rating[item_index] + Si_dense[item_id] * self.lambda_2 + self.lambda_1)
+            is_last_block = end_item == self.n_items
+            current_time = time.time()
 
+            if current_time - last_print_time > 30 or is_last_block:
 
-                            if force_positive and Si_dense[item_id] < 0.0:
-                                Si_dense[item_id] = 0.0
+                statistics = np.array(self.thread_statistics).sum(axis=0)
 
+                processed_samples = statistics[STAT_SAMPLES]
+                samples_per_sec = processed_samples/(current_time-start_time)
 
-                    #print("gradient_update {}".format(time.time() - start_time))
-                    #input()
+                print("Processed {:.2E} samples ( {:2.0f} % ), {:.2E} samples/sec. Average loss is {:.2E}. Usable interactions are {:.2E} ( {:2.0f} % ). Elapsed time {:.2f} min".format(
+                    processed_samples, processed_samples*1.0/(len(self.URM_data)*n_epochs)*100,
+                    samples_per_sec,
+                    statistics[STAT_LOSS]/max(1.0, processed_samples),
+                    statistics[STAT_USABLE],
+                    statistics[STAT_USABLE]*1.0/max(1.0, statistics[STAT_OVERALL])*100,
+                    (current_time-start_time) / 60))
 
+                last_print_time = current_time
 
+                sys.stdout.flush()
+                sys.stderr.flush()
 
-                    processed_samples += 1
-                    processed_samples_last_print +=1
 
-                    # Exponentiation of beta at the end of each sample
-                    if self.useAdam:
+        print("SLIM_Structure, fit complete!")
 
-                        self.beta_1_power_t *= self.beta_1
-                        self.beta_2_power_t *= self.beta_2
 
 
-                # END for sample_indices
 
-                is_last_sample = (current_item == self.n_items -1) and \
-                                 (current_epoch == n_epochs -1) and \
-                                 ((sample_index == len(sample_indices) -1 ) or len(sample_indices)==0)
+    cdef void fit_item_SGD(self, int current_item, int thread_id, int n_epochs, int use_BPR, int force_positive,
+                           double sample_quota) nogil:
 
+        cdef int current_epoch, n_neighbours, n_samples, num_samples_to_choose
+        cdef int sample_index, swap_index, swap_value, sample_position, sample_user
+        cdef int item_index, item_id, position
+        cdef double sample_rating, gradient_update, gradient, prediction
+        cdef double beta_1_power_t = self.beta_1, beta_2_power_t = self.beta_2
+        cdef double * Si_weights = &self.Si_weights[thread_id, 0]
+        cdef int * sample_shuffle = &self.sample_shuffle[thread_id, 0]
+        cdef int * neighbour_position = &self.neighbour_position[thread_id, 0]
 
-                if processed_samples_last_print >= print_block_size or is_last_sample:
+        n_neighbours = self.init_S_structure_current_item(current_item, thread_id)
 
-                    current_time = time.time()
+        # Get the users who rated item i
+        sample_position = self.URM_indptr_csc[current_item]
+        n_samples = self.URM_indptr_csc[current_item + 1] - sample_position
 
-                    # Set block size to the number of items necessary in order to print every 30 seconds
-                    samples_per_sec = processed_samples/(time.time()-start_time)
+        if n_samples == 0 or n_neighbours == 0:
+            self.clear_and_save_S_structure_current_item(current_item, thread_id)
+            return
 
-                    print_block_size = int(samples_per_sec*30)
+        for sample_index in range(n_samples):
+            sample_shuffle[sample_index] = sample_index
 
-                    if current_time - last_print_time > 30  or is_last_sample:
+        self.clear_adaptive_gradient(thread_id, n_neighbours)
 
-                        print("Processed {:.2E} samples ( {:2.0f} % ), {:.2E} samples/sec. Average loss is {:.2E}. Usable interactions are {:.2E} ( {:2.0f} % ). Elapsed time {:.2f} min".format(
-                            processed_samples, processed_samples*1.0/(len(self.URM_data)*n_epochs)*100,
-                            samples_per_sec,
-                            cumulative_loss/processed_samples,
-                            usable_interactions,
-                            usable_interactions*1.0/overall_interactions*100,
-                            (time.time()-start_time) / 60))
+        # Ensure at least one sample is chosen
+        num_samples_to_choose = <int> (n_samples*sample_quota)
 
-                        last_print_time = current_time
-                        processed_samples_last_print = 0
+        if num_samples_to_choose < 1:
+            num_samples_to_choose = 1
 
-                        sys.stdout.flush()
-                        sys.stderr.flush()
 
+        for current_epoch in range(n_epochs):
 
+            for sample_index in range(num_samples_to_choose):
 
-            #print("End for epochs {}".format(time.time() - start_time))
+                # Partial Fisher-Yates shuffle, only the samples used in this epoch are drawn
+                swap_index = sample_index + xorshift_rand(&self.rng_state[thread_id]) % (n_samples - sample_index)
+                swap_value = sample_shuffle[swap_index]
+                sample_shuffle[swap_index] = sample_shuffle[sample_index]
+                sample_shuffle[sample_index] = swap_value
 
-            # End for epochs
+                sample_user = self.URM_indices_csc[sample_position + swap_value]
+                sample_rating = self.URM_data_csc[sample_position + swap_value]
 
-            self.clear_and_save_S_structure_current_item(current_item, Si_mask, Si_dense)
+                prediction = 0.0
 
-            #print("clear_and_save_S_structure_current_item {}".format(time.time() - start_time))
-            #input()
+                for item_index in range(self.URM_indptr[sample_user], self.URM_indptr[sample_user + 1]):
+                    item_id = self.URM_indices[item_index]
 
+                    self.thread_statistics[thread_id, STAT_OVERALL] += 1
 
-        PyMem_Free(Si_mask)
-        PyMem_Free(Si_dense)
+                    position = neighbour_position[item_id]
 
+                    if position != -1 and item_id != current_item:
+                        self.thread_statistics[thread_id, STAT_USABLE] += 1
 
-        print("SLIM_Structure, fit complete!")
+                        if use_BPR:
+                            prediction += 1.0 * Si_weights[position]
+                        else:
+                            prediction += self.URM_data[item_index] * Si_weights[position]
 
 
-    cdef BPR_sample sampleBPR_Cython(self, long current_item, int[:] users_interacting_with_item):
+                if use_BPR:
+                    gradient = 1 / (1 + exp(prediction))
+                    self.thread_statistics[thread_id, STAT_LOSS] += prediction**2
 
-        cdef BPR_sample sample = BPR_sample(-1,-1,-1,-1,-1)
+                else:
+                    gradient = prediction - sample_rating
+                    self.thread_statistics[thread_id, STAT_LOSS] += gradient**2
 
-        cdef long index
 
-        cdef int negItemSelected = False, numSeenItems = 0
 
-        # Skip users with no interactions or with no negative items
-        while numSeenItems == 0 or numSeenItems == self.n_items:
+                for item_index in range(self.URM_indptr[sample_user], self.URM_indptr[sample_user + 1]):
+                    item_id = self.URM_indices[item_index]
 
-            sample.user = rand() % len(users_interacting_with_item)
+                    position = neighbour_position[item_id]
 
-            sample.seen_items_start_pos = self.URM_indices_csc[sample.user]
-            sample.seen_items_end_pos = self.URM_mask_indptr[sample.user + 1]
+                    if position != -1 and item_id != current_item:
 
-            numSeenItems = sample.seen_items_end_pos - sample.seen_items_start_pos
+                        gradient_update = self.compute_adaptive_gradient(thread_id, position, gradient, beta_1_power_t, beta_2_power_t)
 
-            if numSeenItems != 0:
+                        if use_BPR:
+                            Si_weights[position] += self.learning_rate * (gradient_update - Si_weights[position] * self.lambda_2 - self.lambda_1)
+                        else:
+                            Si_weights[position] -=  self.learning_rate * (gradient_update * self.URM_data[item_index] + Si_weights[position] * self.lambda_2 + self.lambda_1)
 
-                user_profile_item_id = self.URM_indices[self.URM_indptr[sample_user]:self.URM_indptr[sample_user + 1]]
 
-                index = rand() % numSeenItems
+                        if force_positive and Si_weights[position] < 0.0:
+                            Si_weights[position] = 0.0
 
-                sample.neg_item = self.URM_mask_indices[sample.seen_items_start_pos + index]
 
-                index = 0
-                while index < numSeenItems and self.URM_mask_indices[sample.seen_items_start_pos + index]!=sample.neg_item:
-                    index+=1
+                self.thread_statistics[thread_id, STAT_SAMPLES] += 1
 
-                if index == numSeenItems:
-                    negItemSelected = True
+                # Exponentiation of beta at the end of each sample
+                if self.useAdam:
 
+                    beta_1_power_t *= self.beta_1
+                    beta_2_power_t *= self.beta_2
 
-                negItemSelected = True
 
+        self.clear_and_save_S_structure_current_item(current_item, thread_id)
 
-        return sample
 
 
 
@@ -753,8 +693,9 @@ cdef class SLIM_Structure_Cython_Epoch:
 
         cdef int current_item, current_epoch, n_epochs = epochs
         cdef int sample_index, sample_user, sample_index_start_batch, sample_index_end_batch, samples_completed
-        cdef int item_index, item_id
+        cdef int item_index, item_id, position, n_neighbours
         cdef double prediction, error, sample_rating, gradient_update, gradient
+        cdef double beta_1_power_t, beta_2_power_t
         cdef int is_last_sample = False
 
         cdef int[:] sample_indices, sample_shuffle
@@ -769,15 +710,13 @@ cdef class SLIM_Structure_Cython_Epoch:
         cdef long processed_samples = 0, print_block_size = 100000
         cdef double samples_per_sec, cumulative_loss = 0
 
-
-        cdef int * Si_mask = < int *> PyMem_Malloc((self.n_items) * sizeof(int))
-        cdef double * Si_dense = < double *> PyMem_Malloc((self.n_items) * sizeof(double))
-
+        # The batch version is sequential and uses the buffers of the first thread
+        cdef int thread_id = 0
 
 
         for current_item in range(self.n_items):
 
-            self.init_S_structure_current_item(current_item, Si_mask, Si_dense)
+            n_neighbours = self.init_S_structure_current_item(current_item, thread_id)
 
             # Get the indices of the users who rated item i
             sample_indices = self.URM_indices_csc[self.URM_indptr_csc[current_item]:self.URM_indptr_csc[current_item + 1]]
@@ -785,22 +724,10 @@ cdef class SLIM_Structure_Cython_Epoch:
 
             sample_shuffle = np.arange(0, len(sample_indices), dtype=np.int32)
 
+            self.clear_adaptive_gradient(thread_id, n_neighbours)
 
-            if self.useAdaGrad:
-                self.sgd_cache = np.zeros((self.n_items), dtype=np.float64)
-
-            elif self.useRmsprop:
-                self.sgd_cache = np.zeros((self.n_items), dtype=np.float64)
-
-            elif self.useAdam:
-                self.sgd_cache_momentum_1 = np.zeros((self.n_items), dtype=np.float64)
-                self.sgd_cache_momentum_2 = np.zeros((self.n_items), dtype=np.float64)
-
-                self.momentum_1 = 0.0
-                self.momentum_2 = 0.0
-
-                self.beta_1_power_t = self.beta_1
-                self.beta_2_power_t = self.beta_2
+            beta_1_power_t = self.beta_1
+            beta_2_power_t = self.beta_2
 
 
 
@@ -842,9 +769,10 @@ cdef class SLIM_Structure_Cython_Epoch:
 
                         for item_index in range(len(user_profile_item_id)):
                             item_id = user_profile_item_id[item_index]
+                            position = self.neighbour_position[thread_id, item_id]
 
-                            if Si_mask[item_id] == True and item_id != current_item:
-                                prediction += user_profile_rating[item_index] * Si_dense[item_id]
+                            if position != -1 and item_id != current_item:
+                                prediction += user_profile_rating[item_index] * self.Si_weights[thread_id, position]
 
 
 
@@ -873,18 +801,17 @@ cdef class SLIM_Structure_Cython_Epoch:
 
                             for item_index in range(len(user_profile_item_id)):
                                 item_id = user_profile_item_id[item_index]
+                                position = self.neighbour_position[thread_id, item_id]
 
-                                if Si_mask[item_id] == True and item_id != current_item:
-
-                                    gradient_update = self.compute_adaptive_gradient(item_id, error)
-
-                                    Si_dense[item_id] -= gradient_update * user_profile_rating[item_index] * self.learning_rate \
-                                                         + Si_dense[item_id] * self.lambda_2 + self.lambda_1
+                                if position != -1 and item_id != current_item:
 
-                                    if Si_dense[item_id] < 0.0:
-                                        Si_dense[item_id] = 0.0
+                                    gradient_update = self.compute_adaptive_gradient(thread_id, position, error, beta_1_power_t, beta_2_power_t)
 
+                                    self.Si_weights[thread_id, position] -= gradient_update * user_profile_rating[item_index] * self.learning_rate \
+                                                         + self.Si_weights[thread_id, position] * self.lambda_2 + self.lambda_1
 
+                                    if self.Si_weights[thread_id, position] < 0.0:
+                                        self.Si_weights[thread_id, position] = 0.0
 
 
 
@@ -921,18 +848,14 @@ cdef class SLIM_Structure_Cython_Epoch:
                     # Exponentiation of beta at the end of each batch
                     if self.useAdam:
 
-                        self.beta_1_power_t *= self.beta_1
-                        self.beta_2_power_t *= self.beta_2
+                        beta_1_power_t *= self.beta_1
+                        beta_2_power_t *= self.beta_2
 
 
                 #End for samples
             # End for epochs
 
-            self.clear_and_save_S_structure_current_item(current_item, Si_mask, Si_dense)
-
-
-        PyMem_Free(Si_mask)
-        PyMem_Free(Si_dense)
+            self.clear_and_save_S_structure_current_item(current_item, thread_id)
 
 
         print("SLIM_Structure, fit complete!")
@@ -8,11 +8,13 @@
 import numpy as np
 import scipy.sparse as sps
 from Base.Recommender import Recommender
-from Base.Recommender_utils import check_matrix
+from Base.Recommender_utils import check_matrix, similarityMatrixTopK
 from sklearn.linear_model import ElasticNet
 
 from Base.Similarity_Matrix_Recommender import Similarity_Matrix_Recommender
-import time, sys
+import time, sys, os
+import subprocess
+import multiprocessing
 
 class SLIM_ElasticNet(Similarity_Matrix_Recommender, Recommender):
     """
@@ -44,13 +46,22 @@ class SLIM_ElasticNet(Similarity_Matrix_Recommender, Recommender):
         )
 
 
-    def fit(self, l1_penalty=0.1, l2_penalty=0.1, positive_only=True, topK = 100):
+    def fit(self, l1_penalty=0.1, l2_penalty=0.1, positive_only=True, topK = 100, candidate_items = None, warm_start = False):
+        """
+        :param candidate_items: if None, the model of each item is fitted on all the other items.
+                    Otherwise it is fitted only on the candidate_items items with which it co-occurs the most,
+                    all the other coefficients are zero
+        :param warm_start: if True, the model of each item starts from its coefficients of the previous fit
+                    with the same candidate_items. Sweeping over the penalties, from the highest to the lowest,
+                    reuses the previous solutions instead of starting each fit from zero
+        """
 
         self.l1_penalty = l1_penalty
         self.l2_penalty = l2_penalty
         self.positive_only = positive_only
         self.l1_ratio = self.l1_penalty / (self.l1_penalty + self.l2_penalty)
         self.topK = topK
+        self.candidate_items = candidate_items
 
 
 
@@ -63,7 +74,8 @@ class SLIM_ElasticNet(Similarity_Matrix_Recommender, Recommender):
                                 precompute=True,
                                 selection='random',
                                 max_iter=100,
-                                tol=1e-4)
+                                tol=1e-4,
+                                warm_start=warm_start)
 
 
         URM_train = check_matrix(self.URM_train, 'csc', dtype=np.float32)
@@ -71,6 +83,15 @@ class SLIM_ElasticNet(Similarity_Matrix_Recommender, Recommender):
         n_items = URM_train.shape[1]
 
 
+        if candidate_items is not None:
+            candidates_csc = self._get_candidate_items(URM_train, candidate_items)
+
+        # Coefficients of each item in the last fit, as indices of the features used and values
+        if not warm_start or getattr(self, "_coef_cache_candidate_items", False) != candidate_items:
+            self._coef_cache = {}
+            self._coef_cache_candidate_items = candidate_items
+
+
         # Use array as it reduces memory requirements compared to lists
         dataBlock = 10000000
 
@@ -90,20 +111,54 @@ class SLIM_ElasticNet(Similarity_Matrix_Recommender, Recommender):
             # get the target column
             y = URM_train[:, currentItem].toarray()
 
-            # set the j-th column of X to zero
-            start_pos = URM_train.indptr[currentItem]
-            end_pos = URM_train.indptr[currentItem + 1]
+            if candidate_items is None:
+
+                # set the j-th column of X to zero
+                start_pos = URM_train.indptr[currentItem]
+                end_pos = URM_train.indptr[currentItem + 1]
+
+                current_item_data_backup = URM_train.data[start_pos: end_pos].copy()
+                URM_train.data[start_pos: end_pos] = 0.0
+
+                X = URM_train
+
+            else:
+                # The candidates never contain the item itself
+                features = candidates_csc.indices[candidates_csc.indptr[currentItem]:candidates_csc.indptr[currentItem + 1]]
+                X = URM_train[:, features]
+
+
+            if candidate_items is None or len(features) > 0:
+
+                if warm_start:
+                    coef_start = np.zeros(X.shape[1], dtype=np.float32)
 
-            current_item_data_backup = URM_train.data[start_pos: end_pos].copy()
-            URM_train.data[start_pos: end_pos] = 0.0
+                    if currentItem in self._coef_cache:
+                        coef_index, coef_value = self._coef_cache[currentItem]
+                        coef_start[coef_index] = coef_value
 
+                    self.model.coef_ = coef_start
 
 
-            # fit one ElasticNet model per column
-            self.model.fit(URM_train, y)
+                # fit one ElasticNet model per column
+                self.model.fit(X, y)
+
+                # self.model.coef_ contains the coefficient of the ElasticNet model
+                # let's keep only the non-zero values
+                nonzero_model_coef_index = self.model.sparse_coef_.indices
+                nonzero_model_coef_value = self.model.sparse_coef_.data
+
+                if warm_start:
+                    self._coef_cache[currentItem] = (nonzero_model_coef_index.copy(), nonzero_model_coef_value.copy())
+
+                if candidate_items is not None:
+                    nonzero_model_coef_index = features[nonzero_model_coef_index]
+
+            else:
+                nonzero_model_coef_index = np.zeros(0, dtype=np.int32)
+                nonzero_model_coef_value = np.zeros(0, dtype=np.float32)
+
 
-            # self.model.coef_ contains the coefficient of the ElasticNet model
-            # let's keep only the non-zero values
 
             # Select topK values
             # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
@@ -111,16 +166,13 @@ class SLIM_ElasticNet(Similarity_Matrix_Recommender, Recommender):
             # - Sort only the relevant items
             # - Get the original item index
 
-            # nonzero_model_coef_index = self.model.coef_.nonzero()[0]
-            # nonzero_model_coef_value = self.model.coef_[nonzero_model_coef_index]
+            local_topK = min(len(nonzero_model_coef_value), self.topK)
 
-            nonzero_model_coef_index = self.model.sparse_coef_.indices
-            nonzero_model_coef_value = self.model.sparse_coef_.data
+            if local_topK < len(nonzero_model_coef_value):
+                relevant_items_partition = (-nonzero_model_coef_value).argpartition(local_topK-1)[0:local_topK]
+            else:
+                relevant_items_partition = np.arange(len(nonzero_model_coef_value))
 
-
-            local_topK = min(len(nonzero_model_coef_value)-1, self.topK)
-
-            relevant_items_partition = (-nonzero_model_coef_value).argpartition(local_topK)[0:local_topK]
             relevant_items_partition_sorting = np.argsort(-nonzero_model_coef_value[relevant_items_partition])
             ranking = relevant_items_partition[relevant_items_partition_sorting]
 
@@ -141,7 +193,8 @@ class SLIM_ElasticNet(Similarity_Matrix_Recommender, Recommender):
 
 
             # finally, replace the original values of the j-th column
-            URM_train.data[start_pos:end_pos] = current_item_data_backup
+            if candidate_items is None:
+                URM_train.data[start_pos:end_pos] = current_item_data_backup
 
 
             if time.time() - start_time_printBatch > 300 or currentItem == n_items-1:
@@ -162,13 +215,42 @@ class SLIM_ElasticNet(Similarity_Matrix_Recommender, Recommender):
 
 
 
+    def _get_candidate_items(self, URM_train, candidate_items):
+        """
+        For each item selects the candidate_items items with the highest number of co-occurrences, computed
+        on the binarized URM. The result is cached as it does not depend on the penalties
+        :param URM_train:
+        :param candidate_items:
+        :return: csc items x items, column j contains the candidates of item j
+        """
+
+        if getattr(self, "_candidates_csc_candidate_items", None) == candidate_items:
+            return self._candidates_csc
+
+        URM_binary = URM_train.copy()
+        URM_binary.data = np.ones_like(URM_binary.data)
+
+        co_occurrence = check_matrix(URM_binary.T.dot(URM_binary), 'csc', dtype=np.float32)
+        co_occurrence.setdiag(0.0)
+        co_occurrence.eliminate_zeros()
 
+        candidates_csc = check_matrix(similarityMatrixTopK(co_occurrence, k=candidate_items, forceSparseOutput=True), 'csc')
+        candidates_csc.sort_indices()
 
-class SLIM_ElasticNet_Cython(Recommender, Similarity_Matrix_Recommender):
+        self._candidates_csc = candidates_csc
+        self._candidates_csc_candidate_items = candidate_items
+
+        return candidates_csc
+
+
+
+
+
+class SLIM_ElasticNet_Cython(Similarity_Matrix_Recommender, Recommender):
     """
     Train a Sparse Linear Methods (SLIM) item similarity model.
-    NOTE: ElasticNet solver is parallel, a single intance of SLIM_ElasticNet will
-          make use of half the cores available
+    The ElasticNet model of each item is fitted in Cython with cyclic coordinate descent on the CSC URM,
+    items are fitted in parallel with n_threads, keeping only the topK coefficients of each one
 
     See:
         Efficient Top-N Recommendation by Linear Regression,
@@ -179,102 +261,266 @@ class SLIM_ElasticNet_Cython(Recommender, Similarity_Matrix_Recommender):
         http://glaros.dtc.umn.edu/gkhome/fetch/papers/SLIM2011icdm.pdf
     """
 
-    def __init__(self, URM_train):
+    RECOMMENDER_NAME = "SLIM_ElasticNet_Cython_Recommender"
+
+    def __init__(self, URM_train, recompile_cython = False):
 
         super(SLIM_ElasticNet_Cython, self).__init__()
 
         self.URM_train = URM_train
 
+        if recompile_cython:
+            print("Compiling in Cython")
+            self.runCompilationScript()
+            print("Compilation Complete")
+
 
 
     def __str__(self):
-        return "SLIM (l1_penalty={},l2_penalty={},positive_only={})".format(
-            self.l1_penalty, self.l2_penalty, self.positive_only
+        return "SLIM_Cython (l1_penalty={},l2_penalty={},positive_only={},n_threads={})".format(
+            self.l1_penalty, self.l2_penalty, self.positive_only, self.n_threads
         )
 
-    def fit(self, l1_penalty=0.1, l2_penalty=0.1, positive_only=True, topK = 100):
+    def fit(self, l1_penalty=0.1, l2_penalty=0.1, positive_only=True, topK = 100, max_iter = 100, tol = 1e-4,
+            n_threads = multiprocessing.cpu_count()):
+
+        # Import compiled module
+        from SLIM_ElasticNet.Cython.SLIM_ElasticNet_Cython_Epoch import SLIM_ElasticNet_Cython_Epoch
 
         self.l1_penalty = l1_penalty
         self.l2_penalty = l2_penalty
         self.positive_only = positive_only
         self.l1_ratio = self.l1_penalty / (self.l1_penalty + self.l2_penalty)
         self.topK = topK
+        self.n_threads = n_threads
 
-        X = check_matrix(self.URM_train, 'csc', dtype=np.float32)
+        cythonEpoch = SLIM_ElasticNet_Cython_Epoch(self.URM_train,
+                                                   l1_penalty = self.l1_penalty,
+                                                   l2_penalty = self.l2_penalty,
+                                                   positive_only = self.positive_only,
+                                                   topK = self.topK,
+                                                   max_iter = max_iter,
+                                                   tol = tol,
+                                                   n_threads = self.n_threads)
 
-        n_items = X.shape[1]
+        self.W_sparse = cythonEpoch.fit_items()
 
+        sys.stdout.flush()
 
 
-        # we'll store the W matrix into a sparse csr_matrix
-        # let's initialize the vectors used by the sparse.csc_matrix constructor
-        values, rows, cols = [], [], []
-        start_time = time.time()
-        start_time_printBatch = start_time
 
-        # fit each item's factors sequentially (not in parallel)
-        for currentItem in range(n_items):
-            # get the target column
-            y = X[:, currentItem].toarray()
-            # set the j-th column of X to zero
-            startptr = X.indptr[currentItem]
-            endptr = X.indptr[currentItem + 1]
-            bak = X.data[startptr: endptr].copy()
-            X.data[startptr: endptr] = 0.0
-            # fit one ElasticNet model per column
-            self.model.fit(X, y)
-
-            # self.model.coef_ contains the coefficient of the ElasticNet model
-            # let's keep only the non-zero values
-            #nnz_idx = self.model.coef_ > 0.0
+    def runCompilationScript(self):
 
-            # Select topK values
-            # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
-            # - Partition the data to extract the set of relevant items
-            # - Sort only the relevant items
-            # - Get the original item index
-            relevant_items_partition = (-self.model.coef_).argpartition(self.topK)[0:self.topK]
-            relevant_items_partition_sorting = np.argsort(-self.model.coef_[relevant_items_partition])
-            ranking = relevant_items_partition[relevant_items_partition_sorting]
+        # Run compile script setting the working directory to ensure the compiled file are contained in the
+        # appropriate subfolder and not the project root
 
-            notZerosMask = self.model.coef_[ranking] > 0.0
-            ranking = ranking[notZerosMask]
+        compiledModuleSubfolder = "/SLIM_ElasticNet/Cython"
+        fileToCompile_list = ['SLIM_ElasticNet_Cython_Epoch.pyx']
 
-            values.extend(self.model.coef_[ranking])
-            rows.extend(ranking)
-            cols.extend([currentItem]*len(ranking))
+        for fileToCompile in fileToCompile_list:
 
-            # finally, replace the original values of the j-th column
-            X.data[startptr:endptr] = bak
+            command = ['python',
+                       'compileCython.py',
+                       fileToCompile,
+                       'build_ext',
+                       '--inplace'
+                       ]
 
 
-            if time.time() - start_time_printBatch > 300:
-                print("Processed {} ( {:.2f}% ) in {:.2f} minutes. Columns per second: {:.0f}".format(
-                                  currentItem,
-                                  100.0* float(currentItem)/n_items,
-                                  (time.time()-start_time)/60,
-                                  float(currentItem)/(time.time()-start_time)))
+            output = subprocess.check_output(' '.join(command), shell=True, cwd=os.getcwd() + compiledModuleSubfolder)
 
-                sys.stdout.flush()
-                sys.stderr.flush()
+            try:
 
-                start_time_printBatch = time.time()
+                command = ['cython',
+                           fileToCompile,
+                           '-a'
+                           ]
 
+                output = subprocess.check_output(' '.join(command), shell=True, cwd=os.getcwd() + compiledModuleSubfolder)
 
-        # generate the sparse weight matrix
-        self.W_sparse = sps.csc_matrix((values, (rows, cols)), shape=(n_items, n_items), dtype=np.float32)
+            except:
+                pass
+
+
+        print("Compiled module saved in subfolder: {}".format(compiledModuleSubfolder))
+
+        # Command to run compilation script
+        # python compileCython.py SLIM_ElasticNet_Cython_Epoch.pyx build_ext --inplace
+
+        # Command to generate html report
+        # cython -a SLIM_ElasticNet_Cython_Epoch.pyx
 
 
 
 
 
 
-import multiprocessing
 from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 from functools import partial
 import threading
 
+
+
+def _get_shared_array(array):
+    """
+    Copies a numpy array in a shared memory buffer, which is inherited by the workers without pickling it
+    :param array:
+    :return: the shared buffer
+    """
+
+    shared_array = RawArray(np.ctypeslib.as_ctypes_type(array.dtype), array.size)
+    np.frombuffer(shared_array, dtype=array.dtype)[:] = array
+
+    return shared_array
+
+
+
+# Data of each worker process of MultiThreadSLIM_ElasticNet, set once by _init_worker
+_worker_data = {}
+
+
+def _init_worker(shared_data, shared_indices, shared_indptr, index_dtype, shape, column_norms,
+                 l1_ratio, positive_only, topK, max_iter, tol):
+    """
+    Builds the CSC URM of the worker as read only views on the shared memory, no array of the URM is copied
+    """
+
+    data = np.frombuffer(shared_data, dtype=np.float32)
+    indices = np.frombuffer(shared_indices, dtype=index_dtype)
+    indptr = np.frombuffer(shared_indptr, dtype=index_dtype)
+
+    for array in [data, indices, indptr]:
+        array.setflags(write=False)
+
+    _worker_data["X"] = sps.csc_matrix((data, indices, indptr), shape=shape, copy=False)
+    _worker_data["column_norms"] = column_norms
+    _worker_data["topK"] = topK
+    _worker_data["positive_only"] = positive_only
+    _worker_data["max_iter"] = max_iter
+    _worker_data["tol"] = tol
+
+    # Same scaling of sklearn ElasticNet with alpha = 1.0, whose loss is divided by the number of samples
+    _worker_data["l1_reg"] = l1_ratio * shape[0]
+    _worker_data["l2_reg"] = (1.0 - l1_ratio) * shape[0]
+
+
+
+def _fit_item_coordinate_descent(X, column_norms, target_item, l1_reg, l2_reg, positive_only, max_iter, tol):
+    """
+    Cyclic coordinate descent of the ElasticNet model of target_item, with the same objective of sklearn ElasticNet
+    with alpha = 1.0, on a residual vector. The coefficient of the target column is fixed to zero, so X is only read.
+    With positive_only and non negative data, the items that never co-occur with the target have non positive gradient
+    and their coefficient stays zero, therefore only the co-occurring items are updated.
+    Stops when the largest coefficient update is below tol times the largest coefficient, without a duality gap check
+    :return: items and values of the nonzero coefficients
+    """
+
+    start_pos = X.indptr[target_item]
+    end_pos = X.indptr[target_item + 1]
+
+    # The residual of the all zero model is the target column
+    residual = np.zeros(X.shape[0], dtype=np.float64)
+    residual[X.indices[start_pos:end_pos]] = X.data[start_pos:end_pos]
+
+    if positive_only:
+        # X.T is a CSR view on the same arrays
+        features = np.flatnonzero(X.T.dot(residual) > 0.0)
+    else:
+        features = np.flatnonzero(column_norms > 0.0)
+
+    features = features[features != target_item]
+
+    # Rows and data of each feature are views on X
+    feature_columns = [(X.indices[X.indptr[item]:X.indptr[item + 1]],
+                        X.data[X.indptr[item]:X.indptr[item + 1]],
+                        column_norms[item]) for item in features.tolist()]
+
+    coef = [0.0] * len(features)
+
+    for n_iter in range(max_iter):
+
+        max_delta = 0.0
+        max_coef = 0.0
+
+        for feature_index, (item_rows, item_data, item_norm) in enumerate(feature_columns):
+
+            coef_old = coef[feature_index]
+
+            # Gradient with the contribution of the item removed from the residual
+            gradient = item_data.dot(residual.take(item_rows)) + coef_old * item_norm
+
+            # Soft thresholding
+            if gradient > l1_reg:
+                coef_new = (gradient - l1_reg) / (item_norm + l2_reg)
+            elif gradient < -l1_reg and not positive_only:
+                coef_new = (gradient + l1_reg) / (item_norm + l2_reg)
+            else:
+                coef_new = 0.0
+
+            delta = coef_new - coef_old
+
+            if delta != 0.0:
+                coef[feature_index] = coef_new
+                residual[item_rows] -= delta * item_data
+
+            max_delta = max(max_delta, abs(delta))
+            max_coef = max(max_coef, abs(coef_new))
+
+        if max_coef == 0.0 or max_delta / max_coef < tol:
+            break
+
+    coef = np.array(coef, dtype=np.float64)
+    nonzero_mask = coef != 0.0
+
+    return features[nonzero_mask], coef[nonzero_mask].astype(np.float32)
+
+
+
+def _partial_fit_block(item_block):
+    """
+    Fits the ElasticNet models of a block of items
+    :param item_block:
+    :return: rows, cols and values of the topK coefficients of each item, as int32 and float32 arrays
+    """
+
+    X = _worker_data["X"]
+    topK = _worker_data["topK"]
+
+    rows_list, cols_list, values_list = [], [], []
+
+    for currentItem in item_block:
+
+        nonzero_model_coef_index, nonzero_model_coef_value = _fit_item_coordinate_descent(
+            X, _worker_data["column_norms"], currentItem, _worker_data["l1_reg"], _worker_data["l2_reg"],
+            _worker_data["positive_only"], _worker_data["max_iter"], _worker_data["tol"])
+
+        # let's keep only the topK positive coefficients
+        local_topK = min(len(nonzero_model_coef_value), topK)
+
+        if local_topK < len(nonzero_model_coef_value):
+            relevant_items_partition = (-nonzero_model_coef_value).argpartition(local_topK-1)[0:local_topK]
+        else:
+            relevant_items_partition = np.arange(len(nonzero_model_coef_value))
+
+        relevant_items_partition = relevant_items_partition[nonzero_model_coef_value[relevant_items_partition] > 0.0]
+
+        rows_list.append(nonzero_model_coef_index[relevant_items_partition].astype(np.int32))
+        cols_list.append(np.full(len(relevant_items_partition), currentItem, dtype=np.int32))
+        values_list.append(nonzero_model_coef_value[relevant_items_partition].astype(np.float32))
+
+    return np.concatenate(rows_list), np.concatenate(cols_list), np.concatenate(values_list)
+
+
+
+
 class MultiThreadSLIM_ElasticNet(SLIM_ElasticNet, Similarity_Matrix_Recommender):
+    """
+    Fits the ElasticNet model of each item in parallel over a pool of processes.
+    The CSC URM is placed once in shared memory and only read by the workers, which fit each model with
+    coordinate descent on a residual vector, keeping the coefficient of the target item fixed to zero.
+    Items are distributed in blocks of block_size, each block returns the rows, cols and values of its coefficients
+    """
 
     def __init__(self, URM_train):
 
@@ -285,53 +531,15 @@ class MultiThreadSLIM_ElasticNet(SLIM_ElasticNet, Similarity_Matrix_Recommender)
             self.l1_penalty, self.l2_penalty, self.positive_only, self.workers
         )
 
-    def _partial_fit(self, currentItem, X, topK):
-        model = ElasticNet(alpha=1.0,
-                                l1_ratio=self.l1_ratio,
-                                positive=self.positive_only,
-                                fit_intercept=False,
-                                copy_X=False,
-                                precompute=True,
-                                selection='random',
-                                max_iter=100,
-                                tol=1e-4)
-
-        # WARNING: make a copy of X to avoid race conditions on column j
-        # TODO: We can probably come up with something better here.
-        X_j = X.copy()
-        # get the target column
-        y = X_j[:, currentItem].toarray()
-        # set the j-th column of X to zero
-        X_j.data[X_j.indptr[currentItem]:X_j.indptr[currentItem + 1]] = 0.0
-        # fit one ElasticNet model per column
-        model.fit(X_j, y)
-        # self.model.coef_ contains the coefficient of the ElasticNet model
-        # let's keep only the non-zero values
-        #nnz_idx = model.coef_ > 0.0
-
-        relevant_items_partition = (-model.coef_).argpartition(topK)[0:topK]
-        relevant_items_partition_sorting = np.argsort(-model.coef_[relevant_items_partition])
-        ranking = relevant_items_partition[relevant_items_partition_sorting]
-
-        notZerosMask = model.coef_[ranking] > 0.0
-        ranking = ranking[notZerosMask]
-
-        values = model.coef_[ranking]
-        rows = ranking
-        cols = [currentItem] * len(ranking)
-
-        #
-        # values = model.coef_[nnz_idx]
-        # rows = np.arange(X.shape[1])[nnz_idx]
-        # cols = np.ones(nnz_idx.sum()) * currentItem
-        #
-        return values, rows, cols
 
     def fit(self,l1_penalty=0.1,
                  l2_penalty=0.1,
                  positive_only=True,
                  topK = 100,
-                 workers=multiprocessing.cpu_count()):
+                 workers=multiprocessing.cpu_count(),
+                 block_size = 100,
+                 max_iter = 100,
+                 tol = 1e-4):
 
 
         self.l1_penalty = l1_penalty
@@ -343,31 +551,62 @@ class MultiThreadSLIM_ElasticNet(SLIM_ElasticNet, Similarity_Matrix_Recommender)
         self.workers = workers
 
 
+        URM_train = check_matrix(self.URM_train, 'csc', dtype=np.float32)
+        URM_train.sort_indices()
+
+        n_items = URM_train.shape[1]
+        index_dtype = URM_train.indices.dtype
+
+        column_norms = np.asarray(URM_train.power(2).sum(axis=0), dtype=np.float64).ravel()
 
+        shared_data = _get_shared_array(URM_train.data)
+        shared_indices = _get_shared_array(URM_train.indices)
+        shared_indptr = _get_shared_array(URM_train.indptr.astype(index_dtype))
 
-        self.URM_train = check_matrix(self.URM_train, 'csc', dtype=np.float32)
-        n_items = self.URM_train.shape[1]
-        # fit item's factors in parallel
-        
-        #oggetto riferito alla funzione nel quale predefinisco parte dell'input
-        _pfit = partial(self._partial_fit, X=self.URM_train, topK=self.topK)
-        
-        #creo un pool con un certo numero di processi
-        pool = Pool(processes=self.workers)
-        
-        #avvio il pool passando la funzione (con la parte fissa dell'input) 
-        #e il rimanente parametro, variabile
-        res = pool.map(_pfit, np.arange(n_items))
+        # Keep only the copy in shared memory
+        self.URM_train = sps.csc_matrix((np.frombuffer(shared_data, dtype=np.float32),
+                                         np.frombuffer(shared_indices, dtype=index_dtype),
+                                         np.frombuffer(shared_indptr, dtype=index_dtype)),
+                                        shape=URM_train.shape, copy=False)
+        del URM_train
 
-        # res contains a vector of (values, rows, cols) tuples
-        values, rows, cols = [], [], []
-        for values_, rows_, cols_ in res:
-            values.extend(values_)
-            rows.extend(rows_)
-            cols.extend(cols_)
+
+        item_blocks = [np.arange(start_item, min(start_item + block_size, n_items)) for start_item in range(0, n_items, block_size)]
+
+        pool = Pool(processes=self.workers, initializer=_init_worker,
+                    initargs=(shared_data, shared_indices, shared_indptr, index_dtype, self.URM_train.shape,
+                              column_norms, self.l1_ratio, self.positive_only, self.topK, max_iter, tol))
+
+        rows_list, cols_list, values_list = [], [], []
+
+        start_time = time.time()
+        start_time_printBatch = start_time
+
+        for rows_, cols_, values_ in pool.imap_unordered(_partial_fit_block, item_blocks):
+
+            rows_list.append(rows_)
+            cols_list.append(cols_)
+            values_list.append(values_)
+
+            processed_items = min(len(rows_list)*block_size, n_items)
+
+            if time.time() - start_time_printBatch > 300 or len(rows_list) == len(item_blocks):
+                print("Processed {} ( {:.2f}% ) in {:.2f} minutes. Items per second: {:.0f}".format(
+                                  processed_items,
+                                  100.0* float(processed_items)/n_items,
+                                  (time.time()-start_time)/60,
+                                  float(processed_items)/(time.time()-start_time)))
+                sys.stdout.flush()
+                sys.stderr.flush()
+
+                start_time_printBatch = time.time()
+
+        pool.close()
+        pool.join()
 
         # generate the sparse weight matrix
-        self.W_sparse = sps.csc_matrix((values, (rows, cols)), shape=(n_items, n_items), dtype=np.float32)
+        self.W_sparse = sps.csc_matrix((np.concatenate(values_list), (np.concatenate(rows_list), np.concatenate(cols_list))),
+                                       shape=(n_items, n_items), dtype=np.float32)
 
     #
     # def fitThreading(self, X):
@@ -477,4 +716,42 @@ class MultiThreadSLIM_ElasticNet(SLIM_ElasticNet, Similarity_Matrix_Recommender)
 #         print('Thread: ' + str(self.numThread) + ' - terminated')
 #
 #     def get_components (self):
-#         return self.values, self.rows, self.cols
\ No newline at end of file
+#         return self.values, self.rows, self.cols
+
+
+
+if __name__ == '__main__':
+
+    # Fit-time benchmark of the Cython coordinate descent against the multiprocess sklearn ElasticNet
+
+    from data.Movielens_10m.Movielens10MReader import Movielens10MReader
+    from data.DataSplitter import DataSplitter_Warm
+
+    dataSplitter = DataSplitter_Warm(Movielens10MReader)
+    URM_train = dataSplitter.get_URM_train()
+
+    n_workers = multiprocessing.cpu_count()
+
+    output_file = open("results/SLIM_ElasticNet_fit_time_benchmark.txt", "a")
+
+    for recommender_class in [MultiThreadSLIM_ElasticNet, SLIM_ElasticNet_Cython]:
+
+        recommender = recommender_class(URM_train)
+
+        start_time = time.time()
+
+        if recommender_class is MultiThreadSLIM_ElasticNet:
+            recommender.fit(l1_penalty=1e-4, l2_penalty=1e-1, topK=100, workers=n_workers)
+        else:
+            recommender.fit(l1_penalty=1e-4, l2_penalty=1e-1, topK=100, n_threads=n_workers)
+
+        fit_time = time.time() - start_time
+
+        result_string = "{} on {}: {} workers, fit time {:.2f} sec, W nnz {}\n".format(
+            recommender_class.__name__, Movielens10MReader.DATASET_SUBFOLDER[:-1], n_workers, fit_time, recommender.W_sparse.nnz)
+
+        print(result_string)
+        output_file.write(result_string)
+        output_file.flush()
+
+    output_file.close()
@@ -8,7 +8,11 @@ Created on 01/01/2018
 
 import numpy as np
 import scipy.sparse as sps
-import pickle
+import pandas as pd
+import pickle, tempfile, os
+from functools import partial
+
+from data.ID_Mapper import ID_Mapper
 
 
 def split_big_CSR_in_columns(sparse_matrix_to_split, num_split = 2):
@@ -47,6 +51,27 @@ def split_big_CSR_in_columns(sparse_matrix_to_split, num_split = 2):
 
 
 
+def _map_ID_chunk(ID_index, chunk_IDs, add_new):
+    """
+    Maps the IDs of a chunk to their position in ID_index, with pd.factorize each distinct ID is looked up once
+    :param ID_index: pd.Index of the known IDs, the position is the index
+    :param add_new: if True the new IDs are appended to ID_index, otherwise they are mapped to -1
+    :return: index of each ID, updated ID_index
+    """
+
+    codes, unique_IDs = pd.factorize(chunk_IDs)
+
+    unique_index = ID_index.get_indexer(unique_IDs)
+
+    if add_new:
+        new_mask = unique_index == -1
+        unique_index[new_mask] = len(ID_index) + np.arange(new_mask.sum())
+        ID_index = ID_index.append(pd.Index(unique_IDs[new_mask]))
+
+    return unique_index[codes], ID_index
+
+
+
 def loadCSVintoSparse (filePath, header = False, separator="::"):
 
     values, rows, cols = [], [], []
@@ -206,48 +231,229 @@ def removeFeatures(ICM, minOccurrence = 5, maxPercOccurrence = 0.30, reconcile_m
 def reconcile_mapper_with_removed_tokens(mapper_dict, indices_to_remove):
     """
 
-    :param mapper_dict: must be a mapper of [token] -> index
+    :param mapper_dict: must be a mapper of [token] -> index, either a dict or an ID_Mapper
     :param indices_to_remove:
     :return:
     """
 
+    if isinstance(mapper_dict, ID_Mapper):
+        return mapper_dict.remove_indices(indices_to_remove)
+
     # When an index has to be removed:
     # - Delete the corresponding key
     # - Decrement all greater indices
 
-    indices_to_remove = set(indices_to_remove)
-    removed_indices = []
+    if len(mapper_dict) == 0:
+        return mapper_dict
+
+    mapper_keys = list(mapper_dict.keys())
+    mapper_indices = np.fromiter(mapper_dict.values(), dtype=np.int64, count=len(mapper_dict))
 
-    # Copy key set
-    dict_keys = list(mapper_dict.keys())
+    removed_mask = np.in1d(mapper_indices, np.asarray(list(indices_to_remove), dtype=np.int64))
+    removed_indices = np.sort(mapper_indices[removed_mask])
 
-    # Step 1, delete all values
-    for key in dict_keys:
+    # Every index has to be decremented by the number of deleted tokens with lower index
+    kept_indices = mapper_indices[~removed_mask]
+    kept_indices -= np.searchsorted(removed_indices, kept_indices, side='left')
 
-        if mapper_dict[key] in indices_to_remove:
+    kept_keys = [mapper_keys[position] for position in np.flatnonzero(~removed_mask)]
 
-            removed_indices.append(mapper_dict[key])
-            del mapper_dict[key]
+    # The mapper is modified in place
+    mapper_dict.clear()
+    mapper_dict.update(zip(kept_keys, kept_indices.tolist()))
 
+    return mapper_dict
 
-    removed_indices = np.array(removed_indices)
 
 
-    # Step 2, decrement all remaining indices to fill gaps
-    # Every index has to be decremented by the number of deleted tokens with lower index
-    for key in mapper_dict.keys():
+def _is_cache_valid(cache_file_path, source_file_path):
+    """
+    The cache is valid if it exists and is not older than the file it was created from, if any
+    """
+
+    if not os.path.isfile(cache_file_path):
+        return False
+
+    return not os.path.isfile(source_file_path) or os.path.getmtime(cache_file_path) >= os.path.getmtime(source_file_path)
+
+
+def save_sparse_binary(file_path, sparse_matrix):
+    """
+    Saves a CSR or CSC matrix as uncompressed .npy files, one for each component, so that it can be memory mapped
+    Other formats are saved as CSR
+    :param file_path: prefix of the files, e.g., "./data/Movielens_10m/original/URM_all"
+    :return:
+    """
+
+    if sparse_matrix.format not in ["csr", "csc"]:
+        sparse_matrix = sparse_matrix.tocsr()
+
+    np.save(file_path + ".data.npy", sparse_matrix.data)
+    np.save(file_path + ".indices.npy", sparse_matrix.indices)
+    np.save(file_path + ".indptr.npy", sparse_matrix.indptr)
+
+    # The shape is saved last, its presence marks the matrix as complete
+    np.save(file_path + ".shape.npy", np.array([sparse_matrix.shape[0], sparse_matrix.shape[1],
+                                                sparse_matrix.format == "csc"], dtype=np.int64))
+
+
+def load_sparse_binary(file_path, mmap_mode = "r"):
+    """
+    Loads a matrix saved with save_sparse_binary. With mmap_mode = "r" the components are read only memory maps,
+    only the pages actually accessed are read from disk
+    :return:
+    """
+
+    n_rows, n_cols, is_csc = np.load(file_path + ".shape.npy")
+
+    # asarray removes the memmap subclass, the resulting arrays still refer to the file
+    data = np.asarray(np.load(file_path + ".data.npy", mmap_mode = mmap_mode))
+    indices = np.asarray(np.load(file_path + ".indices.npy", mmap_mode = mmap_mode))
+    indptr = np.asarray(np.load(file_path + ".indptr.npy", mmap_mode = mmap_mode))
+
+    matrix_class = sps.csc_matrix if is_csc else sps.csr_matrix
+
+    return matrix_class((data, indices, indptr), shape=(int(n_rows), int(n_cols)), copy=False)
+
+
+def load_sparse_cached(file_path):
+    """
+    Loads the matrix from the binary cache, if the cache does not exist the matrix is read from the
+    .npz file and the cache is created
+    :param file_path: prefix of the files, without extension
+    :return:
+    """
+
+    if _is_cache_valid(file_path + ".shape.npy", file_path + ".npz"):
+        return load_sparse_binary(file_path)
+
+    sparse_matrix = sps.load_npz(file_path + ".npz")
+
+    try:
+        save_sparse_binary(file_path, sparse_matrix)
+    except OSError:
+        # Read only folder, the .npz will be used again next time
+        return sparse_matrix
+
+    return load_sparse_binary(file_path)
+
+
+def sparse_cache_exists(file_path):
+    return os.path.isfile(file_path + ".shape.npy") or os.path.isfile(file_path + ".npz")
+
+
+
+def save_mapper_binary(file_path, mapper_dict):
+    """
+    Saves a mapper of [token] -> index as two arrays sorted by token
+    :return: False if the tokens cannot be represented as a non object numpy array
+    """
+
+    if isinstance(mapper_dict, ID_Mapper):
+
+        if mapper_dict.sorted_IDs.dtype == object:
+            return False
+
+        np.save(file_path + ".values.npy", mapper_dict.sorted_indices)
+        np.save(file_path + ".keys.npy", mapper_dict.sorted_IDs)
+
+        return True
+
+    # Mixed types would be silently converted, e.g., int to str
+    if len(set(type(key) for key in mapper_dict.keys())) > 1:
+        return False
+
+    mapper_keys = np.array(list(mapper_dict.keys()))
+
+    if mapper_keys.dtype == object or mapper_keys.ndim != 1:
+        return False
+
+    mapper_values = np.fromiter(mapper_dict.values(), dtype=np.int64, count=len(mapper_dict))
+
+    sorting = np.argsort(mapper_keys, kind='stable')
+
+    np.save(file_path + ".values.npy", mapper_values[sorting])
+    np.save(file_path + ".keys.npy", mapper_keys[sorting])
+
+    return True
 
-        lower_index_elements = np.sum(removed_indices<mapper_dict[key])
-        mapper_dict[key] -= lower_index_elements
 
+def load_mapper_binary(file_path):
+    """
+    :return: an ID_Mapper, or a dict if the indices are not 0 ... n-1
+    """
+
+    mapper_keys = np.load(file_path + ".keys.npy")
+    mapper_values = np.load(file_path + ".values.npy")
+
+    try:
+        return ID_Mapper.from_sorted(mapper_keys, mapper_values)
+    except ValueError:
+        return dict(zip(mapper_keys.tolist(), mapper_values.tolist()))
+
+
+def load_mapper_cached(file_path):
+    """
+    Loads the mapper from the sorted arrays, if they do not exist the mapper is read from the pickle and
+    the arrays are created
+    """
+
+    if _is_cache_valid(file_path + ".keys.npy", file_path):
+        return load_mapper_binary(file_path)
+
+    mapper_dict = pickle.load(open(file_path, "rb"))
+
+    try:
+        # The mapper is loaded back from the arrays so that it has the same type as when the cache exists
+        if save_mapper_binary(file_path, mapper_dict):
+            return load_mapper_binary(file_path)
+    except OSError:
+        pass
 
     return mapper_dict
 
 
+def mapper_cache_exists(file_path):
+    return os.path.isfile(file_path + ".keys.npy") or os.path.isfile(file_path)
+
+
+
+
+class Lazy_Attributes_Object(object):
+    """
+    Attributes registered with _set_lazy_attribute are loaded only the first time they are accessed
+    """
+
+    def _set_lazy_attribute(self, attribute_name, load_function):
+
+        # The attribute must not exist, otherwise __getattr__ is never called
+        self.__dict__.pop(attribute_name, None)
+        self.__dict__.setdefault("_lazy_attributes", {})[attribute_name] = load_function
+
+
+    def __getattr__(self, attribute_name):
+
+        lazy_attributes = self.__dict__.get("_lazy_attributes", {})
+
+        if attribute_name not in lazy_attributes:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, attribute_name))
+
+        attribute_value = lazy_attributes.pop(attribute_name)()
+        setattr(self, attribute_name, attribute_value)
 
+        return attribute_value
 
 
-class DataReader(object):
+    def __setattr__(self, attribute_name, attribute_value):
+
+        # An explicit assignment replaces the pending load
+        self.__dict__.get("_lazy_attributes", {}).pop(attribute_name, None)
+        super(Lazy_Attributes_Object, self).__setattr__(attribute_name, attribute_value)
+
+
+
+
+class DataReader(Lazy_Attributes_Object):
     """
     Abstract class for the DataReaders, each shoud be implemented for a specific dataset
     DataReaders provide two functionalrity
@@ -310,7 +516,8 @@ class DataReader(object):
     def save_mappers(self):
         """
         Saves the mappers for the given dataset. Mappers associate the original ID of user, item, feature, to the
-        index in the sparse matrix
+        index in the sparse matrix. Mappers are saved as arrays sorted by original ID, mappers whose IDs
+        cannot be represented as a numpy array are pickled
         :param dataset_specific_mappers_list:
         :return:
         """
@@ -320,12 +527,19 @@ class DataReader(object):
 
         for mapper_name in mappers_list:
             mapper_data = self.__getattribute__(mapper_name)
-            pickle.dump(mapper_data, open(self.data_path + mapper_name + self.k_cores_name_suffix, "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+            mapper_path = self.data_path + mapper_name + self.k_cores_name_suffix
+
+            if not save_mapper_binary(mapper_path, mapper_data):
+                pickle.dump(mapper_data, open(mapper_path, "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+
+                if os.path.isfile(mapper_path + ".keys.npy"):
+                    os.remove(mapper_path + ".keys.npy")
 
 
     def load_mappers(self):
         """
         Loads all saved mappers for the given dataset. Mappers are the union of GLOBAL mappers and dataset specific ones
+        Mappers are loaded when first accessed
         :return:
         """
 
@@ -333,7 +547,12 @@ class DataReader(object):
         mappers_list.extend(self.DATASET_SPECIFIC_MAPPER)
 
         for mapper_name in mappers_list:
-            self.__setattr__(mapper_name, pickle.load(open(self.data_path + mapper_name + self.k_cores_name_suffix, "rb")))
+            mapper_path = self.data_path + mapper_name + self.k_cores_name_suffix
+
+            if not mapper_cache_exists(mapper_path):
+                raise FileNotFoundError("DataReader: mapper '{}' not found".format(mapper_path))
+
+            self._set_lazy_attribute(mapper_name, partial(load_mapper_cached, mapper_path))
 
 
 
@@ -361,23 +580,26 @@ class DataReader(object):
 
         self.data_path = "./data/" + self.DATASET_SUBFOLDER + splitSubfolder
 
-        try:
-            if splitSubfolder == DataReader.DATASET_SUBFOLDER_ORIGINAL:
-                self.URM_all = sps.load_npz(self.data_path + "URM_all{}.npz".format(self.k_cores_name_suffix))
-
-            else:
-                for URM_name in self.AVAILABLE_URM:
-                    setattr(self, URM_name, sps.load_npz(self.data_path + "{}{}.npz".format(URM_name, self.k_cores_name_suffix)))
+        if splitSubfolder == DataReader.DATASET_SUBFOLDER_ORIGINAL:
+            matrices_to_load = ["URM_all"]
+        else:
+            matrices_to_load = list(self.AVAILABLE_URM)
 
+        if ICM_to_load is None:
+            matrices_to_load.extend(self.AVAILABLE_ICM)
+        else:
+            matrices_to_load.append(ICM_to_load)
 
+        try:
+            # Only the presence of the files is checked here, matrices are memory mapped when first accessed
+            for matrix_name in matrices_to_load:
 
-            if ICM_to_load is None:
+                matrix_path = self.data_path + "{}{}".format(matrix_name, self.k_cores_name_suffix)
 
-                for ICM_name in self.AVAILABLE_ICM:
-                    setattr(self, ICM_name, sps.load_npz(self.data_path + "{}{}.npz".format(ICM_name, self.k_cores_name_suffix)))
+                if not sparse_cache_exists(matrix_path):
+                    raise FileNotFoundError("DataReader: '{}' not found".format(matrix_path))
 
-            else:
-                setattr(self, ICM_to_load, sps.load_npz(self.data_path + "{}{}.npz".format(ICM_to_load, self.k_cores_name_suffix)))
+                self._set_lazy_attribute(matrix_name, partial(load_sparse_cached, matrix_path))
 
 
             self.load_mappers()
@@ -446,6 +668,30 @@ class DataReader(object):
 
 
 
+    def _get_mapper_ID_index(self, original_ID_to_index, index_to_original_ID, dtype = object):
+        """
+        Returns the pd.Index of the IDs of the mapper, the position of each ID is its index
+        """
+
+        if isinstance(original_ID_to_index, ID_Mapper):
+            return pd.Index(original_ID_to_index.original_IDs, dtype=dtype)
+
+        return pd.Index([index_to_original_ID[index] for index in range(len(original_ID_to_index))], dtype=dtype)
+
+
+    def _update_mapper_from_ID_index(self, ID_index, original_ID_to_index, index_to_original_ID):
+        """
+        Adds to the mapper the IDs appended to ID_index after the ones already in the mapper
+        """
+
+        new_indices = range(len(original_ID_to_index), len(ID_index))
+        new_IDs = ID_index[new_indices].tolist()
+
+        original_ID_to_index.update(zip(new_IDs, new_indices))
+        index_to_original_ID.update(zip(new_indices, new_IDs))
+
+
+
     def _get_token_index_from_mapper(self, token_original_ID_to_index, token_id, if_new = "add", token_index_to_original_ID = None):
         """
         From the id in the input files returns the index to be used in the sparse matrix
@@ -599,7 +845,12 @@ class DataReader(object):
 
 
 
-    def loadCSVintoSparse_mapID (self, filePath, header = False, separator=",", if_new_user = "add", if_new_item = "add"):
+    def loadCSVintoSparse_mapID (self, filePath, header = False, separator=",", if_new_user = "add", if_new_item = "add",
+                                 chunksize = 10000000):
+        """
+        Loads the CSV (user ID, item ID, value) in chunks of chunksize rows, mapping the IDs to indices in order of
+        first appearance. Rows whose user or item is new are skipped if the corresponding if_new is 'ignore' or 'exception'
+        """
 
         if if_new_user not in ["add", "ignore", "exception"]:
             raise ValueError("DataReader: if_new_user parameter not recognized. Accepted values are 'add', 'ignore', 'exception', provided was '{}'".format(if_new_user))
@@ -607,71 +858,71 @@ class DataReader(object):
         if if_new_item not in ["add", "ignore", "exception"]:
             raise ValueError("DataReader: if_new_item parameter not recognized. Accepted values are 'add', 'ignore', 'exception', provided was '{}'".format(if_new_item))
 
-        if if_new_user == "ignore":
-            if_new_user_get_user_index = "exception"
-        else:
-            if_new_user_get_user_index = if_new_user
-
-        if if_new_item == "ignore":
-            if_new_item_get_item_index = "exception"
-        else:
-            if_new_item_get_item_index = if_new_item
+        # IDs are kept as strings to support alphanumeric IDs
+        # A multi character separator made of a repeated character, e.g., "::", is read as the single character one,
+        # the fields are then separated by empty columns
+        if len(separator) > 1 and separator == separator[0] * len(separator):
+            csv_separator = separator[0]
+            usecols = [0, len(separator), 2*len(separator)]
+            engine = "c"
 
+        elif len(separator) > 1:
+            csv_separator = separator
+            usecols = [0, 1, 2]
+            engine = "python"
 
+        else:
+            csv_separator = separator
+            usecols = [0, 1, 2]
+            engine = "c"
 
 
-        # Use array as it requires MUCH less space than lists
-        dataBlock = 10000000
+        chunk_iterator = pd.read_csv(filePath, sep=csv_separator, header=None, skiprows=1 if header else 0,
+                                     usecols=usecols, dtype={usecols[0]:str, usecols[1]:str, usecols[2]:np.float64},
+                                     engine=engine, chunksize=chunksize)
 
-        values = np.zeros(dataBlock, dtype=np.float64)
-        rows = np.zeros(dataBlock, dtype=np.int32)
-        cols = np.zeros(dataBlock, dtype=np.int32)
+        # The known IDs in order of index, new IDs of each chunk are appended in order of first appearance
+        user_ID_index = self._get_mapper_ID_index(self.user_original_ID_to_index, self.user_index_to_original_ID)
+        item_ID_index = self._get_mapper_ID_index(self.item_original_ID_to_index, self.item_index_to_original_ID)
 
         numCells = 0
 
-        fileHandle = open(filePath, "r")
-
+        # COO chunks are written on spill files and the sparse matrix is built once at the end
+        with tempfile.TemporaryDirectory() as spill_folder:
 
-        if header:
-            fileHandle.readline()
-
-        for line in fileHandle:
-            numCells += 1
-            if (numCells % 1000000 == 0):
-                print("Processed {} cells".format(numCells))
+            rows_file = open(spill_folder + "/rows", "wb")
+            cols_file = open(spill_folder + "/cols", "wb")
+            values_file = open(spill_folder + "/values", "wb")
 
-            if (len(line)) > 1:
-                line = line.split(separator)
+            for chunk in chunk_iterator:
 
-                line[-1] = line[-1].replace("\n", "")
+                user_index, user_ID_index = _map_ID_chunk(user_ID_index, chunk[usecols[0]].values, if_new_user == "add")
+                item_index, item_ID_index = _map_ID_chunk(item_ID_index, chunk[usecols[1]].values, if_new_item == "add")
 
-                # Do not transfor userID and itemID into integers to support
-                # alphanumeric IDs
-                try:
+                # Rows with an ID not in the mapper are skipped
+                valid_mask = np.logical_and(user_index >= 0, item_index >= 0)
 
-                    userIndex = self._get_user_index(line[0], if_new = if_new_user_get_user_index)
-                    movieIndex = self._get_item_index(line[1], if_new = if_new_item_get_item_index)
-
-
-                    if numCells == len(rows):
-                        rows = np.concatenate((rows, np.zeros(dataBlock, dtype=np.float64)))
-                        cols = np.concatenate((cols, np.zeros(dataBlock, dtype=np.int32)))
-                        values = np.concatenate((values, np.zeros(dataBlock, dtype=np.int32)))
+                user_index[valid_mask].astype(np.int32).tofile(rows_file)
+                item_index[valid_mask].astype(np.int32).tofile(cols_file)
+                chunk[usecols[2]].values[valid_mask].astype(np.float32).tofile(values_file)
 
+                numCells += len(chunk)
+                print("Processed {} cells".format(numCells))
 
-                    rows[numCells] = userIndex
-                    cols[numCells] = movieIndex
-                    values[numCells] = float(line[2])
-                    #
-                    # rows.append(userIndex)
-                    # cols.append(movieIndex)
-                    # values.append(float(line[2]))
+            rows_file.close()
+            cols_file.close()
+            values_file.close()
 
-                except KeyError:
-                    pass
+            rows = np.fromfile(spill_folder + "/rows", dtype=np.int32)
+            cols = np.fromfile(spill_folder + "/cols", dtype=np.int32)
+            values = np.fromfile(spill_folder + "/values", dtype=np.float32)
 
 
-        fileHandle.close()
+        # Mappers are updated with the new IDs
+        self._update_mapper_from_ID_index(user_ID_index, self.user_original_ID_to_index, self.user_index_to_original_ID)
+        self._update_mapper_from_ID_index(item_ID_index, self.item_original_ID_to_index, self.item_index_to_original_ID)
 
-        return  sps.csr_matrix((values[:numCells], (rows[:numCells], cols[:numCells])), dtype=np.float32)
+        self.n_users = len(self.user_original_ID_to_index)
+        self.n_items = len(self.item_original_ID_to_index)
 
+        return sps.csr_matrix((values, (rows, cols)), dtype=np.float32)
@@ -75,6 +75,191 @@ class MyTestCase(unittest.TestCase):
 
 
 
+    def test_loadCSVintoSparse_mapID(self):
+
+        import tempfile, os
+        from data.DataReader import DataReader
+
+        class CSV_DataReader(DataReader):
+
+            def _load_preprocessed_data(self):
+                raise FileNotFoundError()
+
+            def load_from_original_file(self):
+                pass
+
+
+        csv_file = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False)
+        csv_file.write("u7::i3::4.0\nu2::i3::1.5\nu7::i9::2.0\nu5::i1::3.0\nu2::i9::5.0\n")
+        csv_file.close()
+
+        dataReader = CSV_DataReader()
+
+        # Small chunks to check the mapping across chunks
+        URM = dataReader.loadCSVintoSparse_mapID(csv_file.name, separator="::", chunksize=2)
+
+        assert dataReader.user_original_ID_to_index == {"u7":0, "u2":1, "u5":2}, "user mapper not matching control"
+        assert dataReader.item_original_ID_to_index == {"i3":0, "i9":1, "i1":2}, "item mapper not matching control"
+        assert dataReader.item_index_to_original_ID == {0:"i3", 1:"i9", 2:"i1"}, "item inverse mapper not matching control"
+
+        URM_control = np.array([[4.0, 2.0, 0.0],
+                                [1.5, 5.0, 0.0],
+                                [0.0, 0.0, 3.0]])
+
+        assert URM.dtype == np.float32, "URM dtype is not float32"
+        assert np.allclose(URM.toarray(), URM_control), "URM not matching control"
+
+
+        # New users are skipped, new items added after the existing ones
+        csv_file = open(csv_file.name, "w")
+        csv_file.write("user,item,rating\nu5,i4,1.0\nu8,i3,2.0\nu7,i1,3.0\n")
+        csv_file.close()
+
+        URM = dataReader.loadCSVintoSparse_mapID(csv_file.name, header=True, separator=",", if_new_user="ignore")
+
+        assert dataReader.user_original_ID_to_index == {"u7":0, "u2":1, "u5":2}, "user mapper not matching control"
+        assert dataReader.item_original_ID_to_index == {"i3":0, "i9":1, "i1":2, "i4":3}, "item mapper not matching control"
+
+        URM_control = np.zeros((3, 4))
+        URM_control[2, 3] = 1.0
+        URM_control[0, 2] = 3.0
+
+        assert np.allclose(URM.toarray(), URM_control), "URM not matching control"
+
+        os.remove(csv_file.name)
+
+
+
+
+    def test_binary_cache(self):
+
+        import tempfile, os
+        from data.DataReader import load_sparse_cached, load_mapper_cached, save_mapper_binary, Lazy_Attributes_Object
+
+        temp_folder = tempfile.TemporaryDirectory()
+        matrix_path = os.path.join(temp_folder.name, "URM_all")
+
+        sparse_matrix = sps.random(50, 12, density=0.1, format='csc', dtype=np.float32)
+        sps.save_npz(matrix_path + ".npz", sparse_matrix)
+
+        # The first load creates the cache, the second memory maps it
+        for _ in range(2):
+            loaded_matrix = load_sparse_cached(matrix_path)
+
+            assert loaded_matrix.format == "csc", "format not matching control"
+            assert loaded_matrix.dtype == np.float32, "dtype not matching control"
+            assert np.allclose(sparse_matrix.toarray(), loaded_matrix.toarray()), "loaded_matrix not matching sparse_matrix"
+
+        assert os.path.isfile(matrix_path + ".data.npy"), "binary cache not created"
+
+
+        mapper_path = os.path.join(temp_folder.name, "item_original_ID_to_index")
+
+        assert save_mapper_binary(mapper_path, {"b":0, "a":2, "c":1}), "mapper not saved"
+        assert np.load(mapper_path + ".keys.npy").tolist() == ["a", "b", "c"], "keys not sorted"
+        assert dict(load_mapper_cached(mapper_path).items()) == {"b":0, "a":2, "c":1}, "mapper not matching control"
+
+        # Mixed key types cannot be saved as array
+        assert not save_mapper_binary(mapper_path, {"a":0, 5:1}), "mixed keys saved as array"
+
+
+        lazy_object = Lazy_Attributes_Object()
+        lazy_object._set_lazy_attribute("URM_all", lambda: load_sparse_cached(matrix_path))
+
+        assert "URM_all" not in lazy_object.__dict__, "attribute loaded before access"
+        assert lazy_object.URM_all.nnz == sparse_matrix.nnz, "lazy attribute not matching control"
+        assert "URM_all" in lazy_object.__dict__, "attribute not stored after access"
+
+        with self.assertRaises(AttributeError):
+            lazy_object.URM_train
+
+        del loaded_matrix, lazy_object
+        temp_folder.cleanup()
+
+
+
+
+    def test_cached_mapper_add(self):
+
+        import tempfile, os, pickle
+        import pandas as pd
+        from data.DataReader import DataReader, load_mapper_cached
+
+        class Cached_DataReader(DataReader):
+
+            def _load_preprocessed_data(self):
+                raise FileNotFoundError()
+
+            def load_from_original_file(self):
+                pass
+
+
+        temp_folder = tempfile.TemporaryDirectory()
+        mapper_path = os.path.join(temp_folder.name, "user_original_ID_to_index")
+
+        pickle.dump({"u7":0, "u2":1, "u5":2}, open(mapper_path, "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+
+        # The first load reads the pickle and creates the cache, the second one hits the cache
+        cold_mapper = load_mapper_cached(mapper_path)
+        warm_mapper = load_mapper_cached(mapper_path)
+
+        assert type(cold_mapper) is type(warm_mapper), "mapper type depends on the cache state"
+
+        dataReader = Cached_DataReader()
+        dataReader.user_original_ID_to_index = warm_mapper
+
+        assert dataReader._get_user_index("u2") == 1, "index not matching control"
+        assert dataReader._get_user_index("u9", if_new="add") == 3, "index not matching control"
+        assert dataReader.n_users == 4, "n_users not matching control"
+
+        ID_index = pd.Index(["u7", "u2", "u5", "u9", "u1", "u3"], dtype=object)
+        dataReader._update_mapper_from_ID_index(ID_index, dataReader.user_original_ID_to_index, dataReader.user_index_to_original_ID)
+
+        assert dict(dataReader.user_original_ID_to_index.items()) == {"u7":0, "u2":1, "u5":2, "u9":3, "u1":4, "u3":5}, "mapper not matching control"
+        assert dataReader.user_index_to_original_ID == {3:"u9", 4:"u1", 5:"u3"}, "inverse mapper not matching control"
+
+        with self.assertRaises(ValueError):
+            dataReader.user_original_ID_to_index["u8"] = 10
+
+        temp_folder.cleanup()
+
+
+
+
+
+    def test_ID_Mapper(self):
+
+        from data.ID_Mapper import ID_Mapper
+        from data.DataReader import reconcile_mapper_with_removed_tokens
+
+        mapper = ID_Mapper()
+
+        indices = mapper.map(np.array(["u7", "u2", "u7", "u5"], dtype=object), if_new="add")
+
+        assert np.array_equal(indices, [0, 1, 0, 2]), "indices not matching control"
+        assert mapper.to_dict() == {"u7":0, "u2":1, "u5":2}, "mapper not matching control"
+
+        assert np.array_equal(mapper.map(["u5", "u9", "u2"]), [2, -1, 1]), "indices not matching control"
+        assert np.array_equal(mapper.inverse_map([2, 0]), ["u5", "u7"]), "original IDs not matching control"
+
+        assert mapper["u2"] == 1 and "u9" not in mapper and mapper.get("u9") is None, "dict lookup not matching control"
+
+        with self.assertRaises(KeyError):
+            mapper.map(["u9"], if_new="exception")
+
+
+        original_mapper = {"a":0, "b":1, "c":2, "d":3, "e":4}
+
+        for indices_to_remove in [[0], [4], [0,2], [0,1,2,3,4]]:
+
+            reconciled_mapper = reconcile_mapper_with_removed_tokens(ID_Mapper.from_dict(original_mapper), indices_to_remove)
+            reconciled_mapper_control = reconcile_mapper_with_removed_tokens(original_mapper.copy(), indices_to_remove)
+
+            assert reconciled_mapper.to_dict() == reconciled_mapper_control, "reconciled_mapper not matching control"
+
+
+
+
 if __name__ == '__main__':
 
 
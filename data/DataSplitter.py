@@ -11,10 +11,12 @@ import numpy as np
 import traceback
 
 from Base.Recommender_utils import check_matrix
+from data.DataReader import Lazy_Attributes_Object, load_sparse_cached, sparse_cache_exists
+from functools import partial
 
 
 
-class DataSplitter(object):
+class DataSplitter(Lazy_Attributes_Object):
     """
     The splitter tries to load from the specific folder related to a dataset, a split in the format corresponding to
     the splitter class. Basically each split is in a different subfolder
@@ -105,7 +107,7 @@ class DataSplitter(object):
 
     def _load_split_data_and_attributes(self):
         """
-        Loads all URM and ICM
+        Loads all URM and ICM, the matrices are memory mapped from the binary cache when first accessed
         :return:
         """
 
@@ -113,17 +115,23 @@ class DataSplitter(object):
 
         data_path = "./data/" + self.dataReader_class.DATASET_SUBFOLDER + self.SPLIT_SUBFOLDER
 
-        for urm_to_load_name in self.dataReader_class.AVAILABLE_URM:
-            setattr(self, urm_to_load_name, sps.load_npz(data_path + "{}{}.npz".format(urm_to_load_name, self.k_cores_name_suffix)))
-
+        matrices_to_load = list(self.dataReader_class.AVAILABLE_URM)
 
         for icm_to_load_name in self.ICM_to_load:
 
             for icm_suffix in self.ICM_SPLIT_SUFFIX:
 
-                ICM_name_complete = "{}{}".format(icm_to_load_name, icm_suffix)
+                matrices_to_load.append("{}{}".format(icm_to_load_name, icm_suffix))
+
+
+        for matrix_name in matrices_to_load:
+
+            matrix_path = data_path + "{}{}".format(matrix_name, self.k_cores_name_suffix)
+
+            if not sparse_cache_exists(matrix_path):
+                raise FileNotFoundError("DataSplitter: '{}' not found".format(matrix_path))
 
-                setattr(self, ICM_name_complete, sps.load_npz(data_path + "{}{}.npz".format(ICM_name_complete, self.k_cores_name_suffix)))
+            self._set_lazy_attribute(matrix_name, partial(load_sparse_cached, matrix_path))
 
 
         split_attributes_file = np.load(data_path + "split_attributes{}.npz".format(self.k_cores_name_suffix))
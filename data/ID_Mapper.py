@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 19/10/2026
+
+@author: Maurizio Ferrari Dacrema
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class ID_Mapper(object):
+    """
+    Compact mapper of [original ID] -> index, replacing the dict mappers of the DataReaders.
+
+    The original IDs are stored in an array in index order, used for the inverse mapping,
+    and in a sorted array with the int32 index of each ID, used to map the IDs with a binary search.
+    Lookups of single IDs behave as a dict, map and inverse_map work on arrays of IDs.
+    New IDs can only be added with the next free index, either with map(if_new="add"), append, update or mapper[ID] = index.
+    """
+
+    def __init__(self, original_IDs = None):
+
+        super(ID_Mapper, self).__init__()
+
+        if original_IDs is None:
+            original_IDs = []
+
+        self.original_IDs = self._to_compact_array(original_IDs)
+        self._build_sorted_IDs()
+
+
+    @classmethod
+    def from_dict(cls, mapper_dict):
+        """
+        :param mapper_dict: must be a mapper of [token] -> index, with the indices in 0 ... len(mapper_dict)-1
+        """
+
+        mapper_keys = np.array(list(mapper_dict.keys()), dtype=object)
+        mapper_indices = np.fromiter(mapper_dict.values(), dtype=np.int64, count=len(mapper_dict))
+
+        if not _is_permutation(mapper_indices):
+            raise ValueError("ID_Mapper: the indices of the mapper must be 0 ... {}".format(len(mapper_dict) - 1))
+
+        original_IDs = np.empty(len(mapper_dict), dtype=object)
+        original_IDs[mapper_indices] = mapper_keys
+
+        return cls(original_IDs)
+
+
+    @classmethod
+    def from_sorted(cls, sorted_IDs, sorted_indices):
+        """
+        Builds the mapper from the arrays of sorted IDs and corresponding indices, as saved on disk, without sorting again
+        """
+
+        if not _is_permutation(sorted_indices):
+            raise ValueError("ID_Mapper: the indices of the mapper must be 0 ... {}".format(len(sorted_indices) - 1))
+
+        mapper = cls.__new__(cls)
+
+        mapper.sorted_IDs = np.asarray(sorted_IDs)
+        mapper.sorted_indices = np.asarray(sorted_indices, dtype=np.int32)
+
+        mapper.original_IDs = np.empty_like(mapper.sorted_IDs)
+        mapper.original_IDs[mapper.sorted_indices] = mapper.sorted_IDs
+
+        return mapper
+
+
+    def _to_compact_array(self, original_IDs):
+
+        original_IDs = np.asarray(original_IDs)
+
+        # Object arrays, e.g., from a pd.Index, are converted to fixed width when the IDs have a single type
+        if original_IDs.dtype == object and len(original_IDs) > 0:
+
+            inferred_type = pd.api.types.infer_dtype(original_IDs, skipna=False)
+
+            if inferred_type == "string":
+                original_IDs = original_IDs.astype(str)
+            elif inferred_type == "integer":
+                original_IDs = original_IDs.astype(np.int64)
+
+        return original_IDs
+
+
+    def _build_sorted_IDs(self):
+
+        sorting = np.argsort(self.original_IDs, kind='stable')
+
+        self.sorted_IDs = self.original_IDs[sorting]
+        self.sorted_indices = sorting.astype(np.int32)
+
+        if len(self.sorted_IDs) > 1 and np.any(self.sorted_IDs[1:] == self.sorted_IDs[:-1]):
+            raise ValueError("ID_Mapper: the original IDs contain duplicates")
+
+
+
+    def map(self, original_IDs, if_new = "ignore"):
+        """
+        Maps an array of original IDs to their indices
+        :param if_new: "ignore" maps the unknown IDs to -1, "add" appends them in order of first appearance,
+                        "exception" raises a KeyError
+        :return: int32 array of indices
+        """
+
+        if if_new not in ["add", "ignore", "exception"]:
+            raise ValueError("ID_Mapper: if_new parameter not recognized. Accepted values are 'add', 'ignore', 'exception', provided was '{}'".format(if_new))
+
+        original_IDs = np.asarray(original_IDs)
+        indices = np.full(len(original_IDs), -1, dtype=np.int32)
+
+        if len(self.sorted_IDs) > 0:
+
+            positions = np.searchsorted(self.sorted_IDs, original_IDs)
+            positions[positions == len(self.sorted_IDs)] = 0
+
+            found_mask = self.sorted_IDs[positions] == original_IDs
+            indices[found_mask] = self.sorted_indices[positions[found_mask]]
+
+        new_mask = indices == -1
+
+        if not np.any(new_mask):
+            return indices
+
+        if if_new == "exception":
+            raise KeyError("ID_Mapper: {} IDs not in the mapper, e.g., '{}'".format(np.sum(new_mask), original_IDs[new_mask][0]))
+
+        elif if_new == "add":
+            n_IDs_before = len(self.original_IDs)
+            new_codes, new_IDs = pd.factorize(original_IDs[new_mask])
+
+            self.append(new_IDs)
+            indices[new_mask] = n_IDs_before + new_codes
+
+        return indices
+
+
+    def inverse_map(self, indices):
+        """
+        :return: array of the original IDs of the given indices
+        """
+        return self.original_IDs[indices]
+
+
+    def append(self, new_IDs):
+        """
+        Adds the new IDs after the existing ones
+        """
+
+        new_IDs = self._to_compact_array(new_IDs)
+
+        if len(self.original_IDs) == 0:
+            self.original_IDs = new_IDs
+        else:
+            self.original_IDs = self._to_compact_array(np.concatenate((self.original_IDs, new_IDs)))
+
+        self._build_sorted_IDs()
+
+
+    def remove_indices(self, indices_to_remove):
+        """
+        Bulk renumbering after some indices are removed, e.g., by k-cores. The remaining IDs keep their relative order,
+        so each index is decremented by the number of removed indices lower than itself
+        :return: a new ID_Mapper
+        """
+
+        kept_mask = np.ones(len(self.original_IDs), dtype=bool)
+        kept_mask[np.asarray(list(indices_to_remove), dtype=np.int64)] = False
+
+        return ID_Mapper(self.original_IDs[kept_mask])
+
+
+
+    def _get_position(self, original_ID):
+
+        if len(self.sorted_IDs) == 0:
+            return -1
+
+        try:
+            position = np.searchsorted(self.sorted_IDs, original_ID)
+        except TypeError:
+            return -1
+
+        if position < len(self.sorted_IDs) and self.sorted_IDs[position] == original_ID:
+            return position
+
+        return -1
+
+
+    def __getitem__(self, original_ID):
+
+        position = self._get_position(original_ID)
+
+        if position == -1:
+            raise KeyError(original_ID)
+
+        return int(self.sorted_indices[position])
+
+
+    def get(self, original_ID, default = None):
+
+        position = self._get_position(original_ID)
+
+        if position == -1:
+            return default
+
+        return int(self.sorted_indices[position])
+
+
+    def __setitem__(self, original_ID, index):
+        self.update([(original_ID, index)])
+
+
+    def update(self, new_items):
+        """
+        Adds the pairs of [original ID] -> index, as dict or iterable of pairs. IDs already in the mapper must keep
+        their index and the new IDs must have the indices len(self) ... len(self) + n_new - 1, in any order
+        """
+
+        if isinstance(new_items, (dict, ID_Mapper)):
+            new_items = new_items.items()
+
+        new_IDs_dict = {}
+
+        for original_ID, index in new_items:
+
+            current_index = self.get(original_ID)
+
+            if current_index is None:
+                new_IDs_dict[original_ID] = index
+
+            elif current_index != index:
+                raise ValueError("ID_Mapper: ID '{}' is already mapped to index {}, cannot be mapped to {}".format(original_ID, current_index, index))
+
+        if len(new_IDs_dict) == 0:
+            return
+
+        new_indices = np.fromiter(new_IDs_dict.values(), dtype=np.int64, count=len(new_IDs_dict)) - len(self.original_IDs)
+
+        if not _is_permutation(new_indices):
+            raise ValueError("ID_Mapper: the indices of the new IDs must be {} ... {}".format(len(self.original_IDs), len(self.original_IDs) + len(new_IDs_dict) - 1))
+
+        new_IDs = np.empty(len(new_IDs_dict), dtype=object)
+        new_IDs[new_indices] = list(new_IDs_dict.keys())
+
+        self.append(new_IDs)
+
+
+    def __contains__(self, original_ID):
+        return self._get_position(original_ID) != -1
+
+    def __len__(self):
+        return len(self.original_IDs)
+
+    def __iter__(self):
+        return iter(self.original_IDs.tolist())
+
+    def keys(self):
+        return self.original_IDs.tolist()
+
+    def values(self):
+        return range(len(self.original_IDs))
+
+    def items(self):
+        return zip(self.original_IDs.tolist(), range(len(self.original_IDs)))
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+
+
+def _is_permutation(indices):
+    """
+    True if the indices contain each value in 0 ... len(indices)-1 exactly once
+    """
+
+    indices = np.asarray(indices)
+
+    if len(indices) == 0:
+        return True
+
+    if indices.min() < 0 or indices.max() >= len(indices):
+        return False
+
+    return np.all(np.bincount(indices, minlength=len(indices)) == 1)
@@ -9,11 +9,64 @@ Created on 06/01/18
 
 import numpy as np
 import scipy.sparse as sps
-import zipfile
+import pandas as pd
+import zipfile, time, resource, multiprocessing
 
 
-from data.DataReader import DataReader, reconcile_mapper_with_removed_tokens
+from data.DataReader import DataReader, reconcile_mapper_with_removed_tokens, _map_ID_chunk
 from data.URM_Dense_K_Cores import select_k_cores
+from data.ID_Mapper import ID_Mapper
+
+
+
+def _load_split_interactions(zip_file_path, split_file_name, chunksize = 5000000):
+    """
+    Parses a combined_data file reading it directly from the zip, in vectorized chunks.
+    Rows are either 'item_id:' or 'user_id,rating,date', the interactions belong to the last item_id row
+    :return: user ID index, user position of each interaction, item ID index, item position of each interaction,
+             rating of each interaction
+    """
+
+    user_ID_index = pd.Index([], dtype=object)
+    item_ID_index = pd.Index([], dtype=np.int64)
+
+    user_position_list, item_position_list, rating_list = [], [], []
+
+    # Item of the last 'item_id:' row of the previous chunk, -1 if none
+    current_item_ID = -1
+
+    with zipfile.ZipFile(zip_file_path) as dataFile, dataFile.open(split_file_name) as split_file:
+
+        for chunk in pd.read_csv(split_file, header=None, names=["user_id", "rating", "date"], usecols=[0, 1],
+                                 dtype={"user_id":str, "rating":np.float32}, chunksize=chunksize):
+
+            row_ID = chunk["user_id"].values
+
+            # 'item_id:' rows have no rating
+            is_item_row = chunk["rating"].isna().values
+            item_row_position = np.flatnonzero(is_item_row)
+
+            chunk_item_ID = np.array([current_item_ID] + [int(ID[:-1]) for ID in row_ID[is_item_row]], dtype=np.int64)
+
+            # Position among the item rows of the last one preceding each row, 0 is the item of the previous chunk
+            last_item_row = np.searchsorted(item_row_position, np.arange(len(row_ID)), side='right')
+            row_item_ID = chunk_item_ID[last_item_row]
+
+            current_item_ID = chunk_item_ID[-1]
+
+            interaction_mask = np.logical_and(~is_item_row, row_item_ID != -1)
+
+            user_position, user_ID_index = _map_ID_chunk(user_ID_index, row_ID[interaction_mask], True)
+            item_position, item_ID_index = _map_ID_chunk(item_ID_index, row_item_ID[interaction_mask], True)
+
+            user_position_list.append(user_position.astype(np.int32))
+            item_position_list.append(item_position.astype(np.int32))
+            rating_list.append(chunk["rating"].values[interaction_mask].astype(np.uint8))
+
+    print("NetflixPrizeReader: loaded {}".format(split_file_name))
+
+    return user_ID_index, np.concatenate(user_position_list), item_ID_index, np.concatenate(item_position_list), \
+           np.concatenate(rating_list)
 
 
 
@@ -25,7 +78,12 @@ class NetflixPrizeReader(DataReader):
     DATASET_SPECIFIC_MAPPER = []
 
 
-    def __init__(self, apply_k_cores = None):
+    def __init__(self, apply_k_cores = None, n_processes = 1):
+        """
+        :param n_processes: number of combined_data files parsed in parallel when loading from the original zip
+        """
+
+        self.n_processes = n_processes
 
         super(NetflixPrizeReader, self).__init__(apply_k_cores = apply_k_cores)
 
@@ -56,6 +114,9 @@ class NetflixPrizeReader(DataReader):
         self.item_original_ID_to_index = reconcile_mapper_with_removed_tokens(self.item_original_ID_to_index, removedItems)
         self.user_original_ID_to_index = reconcile_mapper_with_removed_tokens(self.user_original_ID_to_index, removedUsers)
 
+        self.item_index_to_original_ID = self.item_original_ID_to_index.original_IDs
+        self.user_index_to_original_ID = self.user_original_ID_to_index.original_IDs
+
 
         print("NetflixPrizeReader: saving URM_train and URM_test")
         sps.save_npz(self.data_path + "URM_all.npz", self.URM_all)
@@ -70,73 +131,68 @@ class NetflixPrizeReader(DataReader):
 
 
     def _loadUserInteractions(self):
+        """
+        Streams the four combined_data files from the zip, using n_processes, and merges their interactions.
+        Indices are int32 and ratings uint8 until the final URM is built
+        """
 
+        start_time = time.time()
 
-        # Use array as for datasets this big lists would require more than 10GB of RAM
-        dataBlock = 10000000
-
-        values = np.zeros(dataBlock)
-        rows = np.zeros(dataBlock)
-        cols = np.zeros(dataBlock)
-
-        numCells = 0
-
-        for current_split in [1, 2, 3, 4]:
-
-            current_split_path = self.dataFile.extract("combined_data_{}.txt".format(current_split), path=self.dataSubfolder + "netflix-prize-data/")
-
-            fileHandle = open(current_split_path, "r")
-
-            print("NetflixPrizeReader: loading split {}".format(current_split))
-
-            currentMovie_id = None
-
-            for line in fileHandle:
-
+        split_file_name_list = ["combined_data_{}.txt".format(current_split) for current_split in [1, 2, 3, 4]]
 
-                if numCells % 1000000 == 0 and numCells!=0:
-                    print("Processed {} cells".format(numCells))
+        zip_file_path = self.dataFile.filename
 
-                if (len(line)) > 1:
+        if self.n_processes > 1:
+            pool = multiprocessing.Pool(processes=self.n_processes)
+            split_result_list = pool.starmap(_load_split_interactions,
+                                             [(zip_file_path, split_file_name) for split_file_name in split_file_name_list])
+            pool.close()
+            pool.join()
 
-                    line_split = line.split(",")
+        else:
+            split_result_list = [_load_split_interactions(zip_file_path, split_file_name)
+                                 for split_file_name in split_file_name_list]
 
-                    # If line has 3 components, it is a 'user_id,rating,date' row
-                    if len(line_split) == 3 and currentMovie_id!= None:
 
-                        if numCells == len(rows):
-                            rows = np.concatenate((rows, np.zeros(dataBlock)))
-                            cols = np.concatenate((cols, np.zeros(dataBlock)))
-                            values = np.concatenate((values, np.zeros(dataBlock)))
+        # The IDs of each split are mapped to the global indices in order of first appearance, as if read sequentially
+        user_ID_index = self._get_mapper_ID_index(self.user_original_ID_to_index, self.user_index_to_original_ID)
+        item_ID_index = self._get_mapper_ID_index(self.item_original_ID_to_index, self.item_index_to_original_ID, dtype=np.int64)
 
+        rows, cols, values = [], [], []
 
+        for split_user_ID_index, user_position, split_item_ID_index, item_position, ratings in split_result_list:
 
-                        userIndex = self._get_user_index(line_split[0], if_new = "add")
+            split_user_index, user_ID_index = _map_ID_chunk(user_ID_index, split_user_ID_index.values, True)
+            split_item_index, item_ID_index = _map_ID_chunk(item_ID_index, split_item_ID_index.values, True)
 
-                        rows[numCells] = userIndex
-                        cols[numCells] = currentMovie_id
-                        values[numCells] = float(line_split[1])
+            rows.append(split_user_index[user_position].astype(np.int32))
+            cols.append(split_item_index[item_position].astype(np.int32))
+            values.append(ratings)
 
-                        numCells += 1
+        del split_result_list
 
-                    # If line has 1 component, it MIGHT be a 'item_id:' row
-                    elif len(line_split) == 1:
-                        line_split = line.split(":")
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        values = np.concatenate(values)
 
-                        # Confirm it is a 'item_id:' row
-                        if len(line_split) == 2:
-                            currentMovie_id = int(line_split[0])
-                            currentMovie_id = self._get_item_index(currentMovie_id, if_new = "add")
 
-                        else:
-                            print("Unexpected row: '{}'".format(line))
+        # Array backed mappers, as dicts they would take several GB for the whole dataset
+        self.user_original_ID_to_index = ID_Mapper(user_ID_index.values)
+        self.item_original_ID_to_index = ID_Mapper(item_ID_index.values)
 
-                    else:
-                        print("Unexpected row: '{}'".format(line))
+        self.user_index_to_original_ID = self.user_original_ID_to_index.original_IDs
+        self.item_index_to_original_ID = self.item_original_ID_to_index.original_IDs
 
+        self.n_users = len(self.user_original_ID_to_index)
+        self.n_items = len(self.item_original_ID_to_index)
 
-            fileHandle.close()
+        URM_all = sps.csr_matrix((values, (rows, cols)), shape=(self.n_users, self.n_items), dtype=np.float32)
 
+        # ru_maxrss is in KB, the parsing processes are children of this one
+        peak_memory_GB = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1e+06
 
-        return  sps.csr_matrix((values[:numCells], (rows[:numCells], cols[:numCells])), dtype=np.float32)
+        print("NetflixPrizeReader: loaded {} interactions in {:.2f} minutes with {} processes, peak memory {:.2f} GB".format(
+            URM_all.nnz, (time.time() - start_time) / 60, self.n_processes, peak_memory_GB))
 
+        return URM_all
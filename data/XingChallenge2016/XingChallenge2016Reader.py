@@ -9,13 +9,116 @@ Created on 14/09/17
 
 import numpy as np
 import scipy.sparse as sps
-import zipfile
+import pandas as pd
+import zipfile, os, io, multiprocessing
 import ast, csv, pickle
 
-from data.DataReader import DataReader, removeFeatures, removeZeroRatingRowAndCol
+from data.DataReader import DataReader, removeFeatures, removeZeroRatingRowAndCol, _map_ID_chunk
 from data.URM_Dense_K_Cores import select_k_cores
 from Base.Recommender_utils import reshapeSparse
 from data.DataReader import reconcile_mapper_with_removed_tokens
+from data.ID_Mapper import ID_Mapper
+
+
+def _get_byte_ranges(file_path, block_size):
+    """
+    Splits the file, header excluded, in ranges of block_size bytes
+    :return: list of (start, end)
+    """
+
+    with open(file_path, "rb") as fileHandle:
+        header_size = len(fileHandle.readline())
+        file_size = os.fstat(fileHandle.fileno()).st_size
+
+    return [(start, min(start + block_size, file_size)) for start in range(header_size, file_size, block_size)]
+
+
+
+def _read_byte_range(file_path, start, end):
+    """
+    Reads the lines of the file which start in the byte range [start, end)
+    """
+
+    with open(file_path, "rb") as fileHandle:
+
+        if start > 0:
+            # The line containing byte start - 1 belongs to the previous range
+            fileHandle.seek(start - 1)
+            fileHandle.readline()
+
+        position = fileHandle.tell()
+
+        if position >= end:
+            return b""
+
+        block_bytes = fileHandle.read(end - position)
+
+        # The last line is completed even if it ends after the range
+        if not block_bytes.endswith(b"\n"):
+            block_bytes += fileHandle.readline()
+
+        return block_bytes
+
+
+
+def _empty_block():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object), \
+           np.zeros(0, dtype=np.int8)
+
+
+
+def _parse_impressions_block(block):
+    """
+    Parses the impressions in a byte range, item lists are exploded with a single split of their concatenation
+    :param block: (file_path, start, end)
+    :return: user and item codes of each impression, distinct user and item IDs of the block, values
+    """
+
+    block_bytes = _read_byte_range(*block)
+
+    if len(block_bytes) == 0:
+        return _empty_block()
+
+    table = pd.read_csv(io.BytesIO(block_bytes), header=None, delim_whitespace=True, usecols=[0, 3],
+                        names=["user_id", "year", "week", "items"], dtype=str).dropna()
+
+    n_items_per_row = table["items"].str.count(",").values + 1
+
+    user_IDs = np.repeat(table["user_id"].values, n_items_per_row)
+    item_IDs = np.array(",".join(table["items"].values).split(","), dtype=object)
+
+    user_codes, block_user_IDs = pd.factorize(user_IDs)
+    item_codes, block_item_IDs = pd.factorize(item_IDs)
+
+    return user_codes, block_user_IDs, item_codes, block_item_IDs, np.ones(len(user_codes), dtype=np.int8)
+
+
+
+def _parse_interactions_block(block):
+    """
+    Parses the interactions in a byte range, interaction_type 4 (deleted recommendation) is turned into -1
+    :param block: (file_path, start, end)
+    :return: user and item codes of each interaction, distinct user and item IDs of the block, values
+    """
+
+    block_bytes = _read_byte_range(*block)
+
+    if len(block_bytes) == 0:
+        return _empty_block()
+
+    table = pd.read_csv(io.BytesIO(block_bytes), header=None, sep="\t", usecols=[0, 1, 2],
+                        names=["user_id", "item_id", "interaction_type", "created_at"],
+                        dtype={"user_id":str, "item_id":str, "interaction_type":np.int8})
+
+    values = table["interaction_type"].values
+    values[values == 4] = -1
+
+    user_codes, block_user_IDs = pd.factorize(table["user_id"].values)
+    item_codes, block_item_IDs = pd.factorize(table["item_id"].values)
+
+    return user_codes, block_user_IDs, item_codes, block_item_IDs, values
+
+
 
 
 class XingChallenge2016Reader(DataReader):
@@ -27,11 +130,17 @@ class XingChallenge2016Reader(DataReader):
 
 
 
-    def __init__(self, apply_k_cores = None):
+    # Size of the blocks of the impressions and interactions files parsed by each process
+    BLOCK_SIZE_BYTES = 256 * 1024 * 1024
+
+
+    def __init__(self, apply_k_cores = None, n_processes = 1):
         """
-        :param splitSubfolder:
+        :param n_processes: number of processes parsing the blocks of the impressions and interactions files
         """
 
+        self.n_processes = n_processes
+
         super(XingChallenge2016Reader, self).__init__(apply_k_cores = apply_k_cores)
 
 
@@ -84,6 +193,9 @@ class XingChallenge2016Reader(DataReader):
         self.item_original_ID_to_index = reconcile_mapper_with_removed_tokens(self.item_original_ID_to_index, removedItems)
         self.user_original_ID_to_index = reconcile_mapper_with_removed_tokens(self.user_original_ID_to_index, removedUsers)
 
+        self.item_index_to_original_ID = self.item_original_ID_to_index.original_IDs
+        self.user_index_to_original_ID = self.user_original_ID_to_index.original_IDs
+
         print("XingChallenge2016Reader: Removed {} users and {} items with no interactions".format(len(removedUsers), len(removedItems)))
 
         ICM_filter_mask = np.ones(self.n_items, dtype=np.bool)
@@ -112,111 +224,47 @@ class XingChallenge2016Reader(DataReader):
 
 
     def _load_impressions(self, impressions_path, if_new_user ="add", if_new_item ="ignore"):
+        """
+        Which items were shown by the existing XING job recommender to which user in which week of the year.
 
+        user_id     ID of the user (points to users.id)
+        year
+        week        of the year
+        items       is a comma-separated list (not set) of items that were displayed to the user (point to items.id)
+        """
 
-
-        if if_new_user not in ["add", "ignore", "exception"]:
-            raise ValueError("DataReader: if_new_user parameter not recognized. Accepted values are 'add', 'ignore', 'exception', provided was '{}'".format(if_new_user))
-
-        if if_new_item not in ["add", "ignore", "exception"]:
-            raise ValueError("DataReader: if_new_item parameter not recognized. Accepted values are 'add', 'ignore', 'exception', provided was '{}'".format(if_new_item))
-
-        if if_new_user == "ignore":
-            if_new_user_get_user_index = "exception"
-        else:
-            if_new_user_get_user_index = if_new_user
-
-        if if_new_item == "ignore":
-            if_new_item_get_item_index = "exception"
-        else:
-            if_new_item_get_item_index = if_new_item
-
-
-
-
-
-        fileHandle = open(impressions_path, "r")
-
-        # Use array as for datasets this big lists would require more than 10GB of RAM
-        dataBlock = 10000000
-
-        values = np.zeros(dataBlock)
-        rows = np.zeros(dataBlock)
-        cols = np.zeros(dataBlock)
-
-        numCells = 0
-
-        # Remove header
-        fileHandle.readline()
-
-
-        for line in fileHandle:
-
-            line = line.split(" ")
-
-            """
-            Which items were shown by the existing XING job recommender to which user in which week of the year.
-            
-            user_id     ID of the user (points to users.id)
-            year
-            week        of the year
-            items       is a comma-separated list (not set) of items that were displayed to the user (point to items.id)
-            """
-
-
-
-            user_id = line[0]
-            year = line[1]
-            week = line[2]
-            item_list = line[3]
-
-
-            try:
-                user_index = self._get_user_index(user_id, if_new = if_new_user_get_user_index)
-            except KeyError:
-                # Go to next line
-                print("XingChallenge2016Reader: Impressions contains user which is not in ICM: {}. Skipping...".format(user_id))
-                continue
-
-
-
-            item_list = item_list.split(",")
-
-            for item_id in item_list:
-
-                if numCells % 1000000 == 0 and numCells!=0:
-                    print("Processed {} cells".format(numCells))
-
-                try:
-                    item_index = self._get_item_index(item_id, if_new = if_new_item_get_item_index)
-                except KeyError:
-                    # Go to next line
-                    print("XingChallenge2016Reader: Impressions contains item which is not in ICM: {}. Skipping...".format(item_id))
-                    continue
-
-
-                if numCells == len(rows):
-                    rows = np.concatenate((rows, np.zeros(dataBlock)))
-                    cols = np.concatenate((cols, np.zeros(dataBlock)))
-                    values = np.concatenate((values, np.zeros(dataBlock)))
-
-                rows[numCells] = int(user_index)
-                cols[numCells] = int(item_index)
-                values[numCells] = True
-
-                numCells += 1
+        return self._load_URM_parallel(impressions_path, _parse_impressions_block, "Impressions",
+                                       if_new_user = if_new_user, if_new_item = if_new_item)
 
 
-        fileHandle.close()
 
-        return sps.csr_matrix((values[:numCells], (rows[:numCells], cols[:numCells])), dtype=np.float32)
 
+    def _load_interactions(self, interactions_path, if_new_user ="add", if_new_item ="ignore"):
+        """
+        Interactions that the user performed on the job posting items. Fields:
+
+        user_id             ID of the user who performed the interaction (points to users.id)
+        item_id             ID of the item on which the interaction was performed (points to items.id)
+        interaction_type    the type of interaction that was performed on the item:
+            1 = the user clicked on the item
+            2 = the user bookmarked the item on XING
+            3 = the user clicked on the reply button or application form button that is shown on some job postings
+            4 = the user deleted a recommendation from his/her list of recommendation (clicking on "x") which has the effect that the recommendation will no longer been shown to the user and that a new recommendation item will be loaded and displayed to the user
+        created_at          a unix time stamp timestamp representing the time when the interaction got created
+        """
 
+        return self._load_URM_parallel(interactions_path, _parse_interactions_block, "Interactions",
+                                       if_new_user = if_new_user, if_new_item = if_new_item)
 
 
-    def _load_interactions(self, impressions_path, if_new_user ="add", if_new_item ="ignore"):
 
 
+    def _load_URM_parallel(self, file_path, parse_block_function, file_description, if_new_user ="add", if_new_item ="ignore"):
+        """
+        Parses the blocks of the file with n_processes and maps their IDs, in file order, with the mappers.
+        Rows with a user or item not in the mapper are skipped if the corresponding if_new is 'ignore' or 'exception',
+        their number is reported at the end
+        """
 
         if if_new_user not in ["add", "ignore", "exception"]:
             raise ValueError("DataReader: if_new_user parameter not recognized. Accepted values are 'add', 'ignore', 'exception', provided was '{}'".format(if_new_user))
@@ -224,101 +272,66 @@ class XingChallenge2016Reader(DataReader):
         if if_new_item not in ["add", "ignore", "exception"]:
             raise ValueError("DataReader: if_new_item parameter not recognized. Accepted values are 'add', 'ignore', 'exception', provided was '{}'".format(if_new_item))
 
-        if if_new_user == "ignore":
-            if_new_user_get_user_index = "exception"
-        else:
-            if_new_user_get_user_index = if_new_user
 
-        if if_new_item == "ignore":
-            if_new_item_get_item_index = "exception"
-        else:
-            if_new_item_get_item_index = if_new_item
+        block_list = [(file_path, start, end) for start, end in _get_byte_ranges(file_path, self.BLOCK_SIZE_BYTES)]
 
+        if self.n_processes > 1:
+            pool = multiprocessing.Pool(processes=self.n_processes)
+            block_result_iterator = pool.imap(parse_block_function, block_list)
+        else:
+            pool = None
+            block_result_iterator = map(parse_block_function, block_list)
 
 
+        user_ID_index = self._get_mapper_ID_index(self.user_original_ID_to_index, self.user_index_to_original_ID)
+        item_ID_index = self._get_mapper_ID_index(self.item_original_ID_to_index, self.item_index_to_original_ID)
 
-
-        fileHandle = open(impressions_path, "r")
-
-        # Use array as for datasets this big lists would require more than 10GB of RAM
-        dataBlock = 10000000
-
-        values = np.zeros(dataBlock)
-        rows = np.zeros(dataBlock)
-        cols = np.zeros(dataBlock)
-
+        rows, cols, values = [], [], []
         numCells = 0
+        n_unknown_user_cells = 0
+        n_unknown_item_cells = 0
 
-        # Remove header
-        fileHandle.readline()
+        for user_codes, block_user_IDs, item_codes, block_item_IDs, block_values in block_result_iterator:
 
+            # Each distinct ID of the block is looked up once in the mapper
+            block_user_index, user_ID_index = _map_ID_chunk(user_ID_index, block_user_IDs, if_new_user == "add")
+            block_item_index, item_ID_index = _map_ID_chunk(item_ID_index, block_item_IDs, if_new_item == "add")
 
-        for line in fileHandle:
+            user_index = block_user_index[user_codes]
+            item_index = block_item_index[item_codes]
 
+            n_unknown_user_cells += np.sum(user_index == -1)
+            n_unknown_item_cells += np.sum(np.logical_and(user_index != -1, item_index == -1))
 
-            if numCells % 1000000 == 0 and numCells!=0:
-                print("Processed {} cells".format(numCells))
+            valid_mask = np.logical_and(user_index != -1, item_index != -1)
 
+            rows.append(user_index[valid_mask].astype(np.int32))
+            cols.append(item_index[valid_mask].astype(np.int32))
+            values.append(block_values[valid_mask])
 
-            line = line.split("\t")
+            numCells += len(user_codes)
+            print("Processed {} cells".format(numCells))
 
-            """
-            
-            Interactions that the user performed on the job posting items. Fields:
-
-            user_id             ID of the user who performed the interaction (points to users.id)
-            item_id             ID of the item on which the interaction was performed (points to items.id)
-            interaction_type    the type of interaction that was performed on the item:
-                1 = the user clicked on the item
-                2 = the user bookmarked the item on XING
-                3 = the user clicked on the reply button or application form button that is shown on some job postings
-                4 = the user deleted a recommendation from his/her list of recommendation (clicking on "x") which has the effect that the recommendation will no longer been shown to the user and that a new recommendation item will be loaded and displayed to the user
-            created_at          a unix time stamp timestamp representing the time when the interaction got created
-            """
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-            user_id = line[0]
-            item_id = line[1]
 
-            # transform negative interactions into a negative number
-            interaction_type = int(line[2])
-            if interaction_type == 4:
-                interaction_type = -1
+        # Array backed mappers, as dicts they would take several GB for the whole dataset
+        self.user_original_ID_to_index = ID_Mapper(user_ID_index.values)
+        self.item_original_ID_to_index = ID_Mapper(item_ID_index.values)
 
-            created_at = line[3]
+        self.user_index_to_original_ID = self.user_original_ID_to_index.original_IDs
+        self.item_index_to_original_ID = self.item_original_ID_to_index.original_IDs
 
+        self.n_users = len(self.user_original_ID_to_index)
+        self.n_items = len(self.item_original_ID_to_index)
 
+        if n_unknown_user_cells > 0 or n_unknown_item_cells > 0:
+            print("XingChallenge2016Reader: {} contains {} cells with users not in the mapper and {} cells with items not in ICM. Skipped".format(
+                file_description, n_unknown_user_cells, n_unknown_item_cells))
 
-            try:
-                user_index = self._get_user_index(user_id, if_new = if_new_user_get_user_index)
-            except KeyError:
-                # Go to next line
-                print("XingChallenge2016Reader: Interactions contains user which is not in ICM: {}. Skipping...".format(user_id))
-                continue
-
-
-            try:
-                item_index = self._get_item_index(item_id, if_new = if_new_item_get_item_index)
-            except KeyError:
-                # Go to next line
-                print("XingChallenge2016Reader: Interactions contains item which is not in ICM: {}. Skipping...".format(item_id))
-                continue
-
-
-            if numCells == len(rows):
-                rows = np.concatenate((rows, np.zeros(dataBlock)))
-                cols = np.concatenate((cols, np.zeros(dataBlock)))
-                values = np.concatenate((values, np.zeros(dataBlock)))
-
-            rows[numCells] = int(user_index)
-            cols[numCells] = int(item_index)
-            values[numCells] = interaction_type
-
-            numCells += 1
-
-
-        fileHandle.close()
-
-        return sps.csr_matrix((values[:numCells], (rows[:numCells], cols[:numCells])), dtype=np.float32)
+        return sps.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), dtype=np.float32)
 
 
 